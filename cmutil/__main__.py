@@ -22,50 +22,419 @@
 # Sebastian Spaar sebastian.spaar@ariadne.ai
 
 
+import contextlib
 import json
+import os
 import sys
 
 from cmutil import declxml
 from cmutil.parser import parser, fill_arguments
-from cmutil import convert
-from cmutil.nml import things_processor
+from cmutil import binary, convert, parallel, pipeline
+from cmutil.fileio import (open_source, sniff_format, content_hash, file_hash,
+                           gzip_compress, write_atomic, write_if_changed)
+from cmutil.journal import Journal
+from cmutil.progress import stderr_progress
+from cmutil.serve import serve
+from cmutil.stream import NmlParser, scan_nml
+from cmutil.transform import Affine, FROM_NML
+from cmutil.validate import validate
+from cmutil import diff, index, stats
+from cmutil.merge import Merger, duplicates_csv
+from cmutil.watch import watch
 
 args = parser.parse_args()
 
-# If no source file is specified, read input from stdin
-if args.source is '':
-    input_string = sys.stdin.read()
-else:
-    with open(args.source) as f:
-        input_string = f.read()
 
-try:
-    # Depending on args.convert, decide whether to
-    #
-    # - parse (CATMAID) JSON into NML (XML)
-    if args.convert == 'nml':
-        catmaid_objects = convert.parse_catmaid_json(input_string)
-        things = convert.prepare_nml(catmaid_objects)
-        output = declxml.serialize_to_string(things_processor, things,
-                                             indent=' ')
-    #
-    # - parse NML (XML) into (CATMAID) JSON
+def report(problems):
+    """Prints problems found by `validate', and returns how many there were."""
+    count = 0
+    for problem in problems:
+        print('{}: {}: {}'.format(args.source or '<stdin>', *problem),
+              file=sys.stderr)
+        count += 1
+    return count
+
+
+if args.sources and args.stats is None and not (args.merge or args.index):
+    parser.error('several input files can only be given with -stats, -merge '
+                 'or -index')
+
+# In server mode, the output format is chosen per request
+if args.serve is not None:
+    serve(args.serve, workers=args.workers, backlog=args.backlog,
+          user_id=args.user)
+    sys.exit(0)
+
+if args.validate:
+    with open_source(args.source) as chunks:
+        input_format, chunks = sniff_format(chunks)
+        count = report(validate(chunks, input_format, args.pyknossos))
+    if count > 0:
+        print('{} problem(s) found.'.format(count), file=sys.stderr)
+        sys.exit(-1)
+    sys.exit(0)
+
+if args.diff is not None:
+    skeletons = []
+    try:
+        for source in (args.source, args.diff):
+            with open_source(source) as chunks:
+                input_format, chunks = sniff_format(chunks)
+                skeletons.append(diff.load(chunks, input_format, args.pyknossos))
+    except (json.JSONDecodeError, declxml.XmlError) as error:
+        print('{}: {}'.format(source or '<stdin>', error), file=sys.stderr)
+        sys.exit(-1)
+    count = 0
+    for id_a, id_b, message in diff.diff(*skeletons):
+        if id_a is None or id_b is None or id_a == id_b:
+            print('skeleton {}: {}'.format(id_b if id_a is None else id_a, message))
+        else:
+            print('skeleton {} / {}: {}'.format(id_a, id_b, message))
+        count += 1
+    if count > 0:
+        print('{} difference(s) found.'.format(count), file=sys.stderr)
+        sys.exit(1)
+    sys.exit(0)
+
+if args.stats is not None:
+    files = []
+    names = [source or '<stdin>' for source in [args.source] + args.sources]
+    for source, name in zip([args.source] + args.sources, names):
+        try:
+            with open_source(source) as chunks:
+                input_format, chunks = sniff_format(chunks)
+                files.append(stats.stats(chunks, input_format, args.pyknossos,
+                                         name))
+        except (SyntaxError, ValueError, KeyError, AssertionError,
+                declxml.XmlError) as error:
+            print('{}: {}'.format(name, error), file=sys.stderr)
+            sys.exit(-1)
+    if args.stats == 'csv':
+        output = stats.to_csv(files)
+    else:
+        output = stats.to_json(files, names) + '\n'
+    if args.output is None:
+        sys.stdout.write(output)
+    else:
+        write_atomic(args.output, output)
+    sys.exit(0)
+
+if args.index:
+    if not args.source:
+        parser.error('-index needs an input file')
+    for source in [args.source] + args.sources:
+        try:
+            count = index.build(source)
+        except (OSError, ValueError, KeyError) as error:
+            print('{}: {}'.format(source, error), file=sys.stderr)
+            sys.exit(-1)
+        print('{}: {} thing(s) indexed.'.format(source, count), file=sys.stderr)
+    sys.exit(0)
+
+if args.convert is None:
+    parser.error('the following arguments are required: -convert')
+
+tolerances = args.simplify or [None]
+transform = None
+if args.scale is not None or args.offset is not None:
+    transform = Affine(args.scale, args.offset)
+if len(tolerances) > 1 and args.output is None and args.watch is None:
+    parser.error('several -simplify tolerances need an output file (-o)')
+if args.shards is not None and (args.convert != 'nml' or args.output is None):
+    parser.error('-shards needs -convert nml and an output file (-o)')
+if args.convert == 'binary' and args.output is None and sys.stdout.isatty():
+    parser.error('-convert binary needs an output file (-o) or redirected output')
+if args.pipeline and (args.workers or args.shards is not None):
+    parser.error('-pipeline cannot be combined with -workers or -shards')
+if args.merge and (args.stream or args.pipeline or args.workers
+                   or args.shards is not None):
+    parser.error('-merge cannot be combined with -stream, -pipeline, '
+                 '-workers or -shards')
+if args.dedup_map is not None and not args.merge:
+    parser.error('-dedup-map needs -merge')
+if args.resume and args.shards is None and args.watch is None:
+    parser.error('-resume needs -shards or -watch')
+if args.resume and args.shards is not None and not args.source:
+    parser.error('-resume needs an input file')
+if args.stream:
+    if args.convert != 'catmaid' or not args.source:
+        parser.error('-stream needs -convert catmaid and an input file')
+    if args.simplify or args.things:
+        parser.error('-stream cannot be combined with -simplify or -things')
+
+# In watch mode, keep converting files until interrupted
+if args.watch is not None:
+    # Unless it is fixed, the creation time is that of each conversion
+    fixed_timestamp = args.timestamp is not None or args.deterministic
+    if args.convert == 'catmaid':
+        args = fill_arguments(args)
+    try:
+        watch(args.watch, args.output or args.watch, args.convert,
+              args.user, args.pyknossos, args.workers, args.interval,
+              args.resume, args.timestamp if fixed_timestamp else None,
+              args.deterministic, tolerances, args.intern_labels, transform)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(-1)
+    sys.exit(0)
+
+# With -check, the input is read twice. Stdin can only be read once, so
+# it is kept in memory in that case.
+stdin_data = None
+if args.check and not args.source:
+    stdin_data = sys.stdin.buffer.read()
+
+
+@contextlib.contextmanager
+def open_input():
+    """Opens the input, and tells its format."""
+    if stdin_data is not None:
+        yield sniff_format([stdin_data])
+    else:
+        # If no source file is specified, read input from stdin
+        with open_source(args.source) as chunks:
+            yield sniff_format(chunks)
+
+
+if args.check:
+    with open_input() as (input_format, chunks):
+        count = report(validate(chunks, input_format, args.pyknossos))
+    if count > 0:
+        print('{} problem(s) found, not converting.'.format(count),
+              file=sys.stderr)
+        sys.exit(-1)
+
+
+def output_path(level, shard=0):
+    """Names the output file for each tolerance and shard, e.g.
+    out.lod0.json, out.lod1.json, ... or out.shard0.nml, out.shard1.nml, ...
+    """
+    root, extension = os.path.splitext(args.output)
+    if extension == '.gz':
+        root, inner = os.path.splitext(root)
+        extension = inner + extension
+    path = root
+    if len(tolerances) > 1:
+        path += '.lod{}'.format(level)
+    if args.shards is not None:
+        path += '.shard{}'.format(shard)
+    return path + extension
+
+
+def report_hash(path, digest, written):
+    if args.deterministic:
+        if path is None:
+            print('sha256 {}'.format(digest), file=sys.stderr)
+        else:
+            print('{}: {} (sha256 {})'.format(
+                path, 'written' if written else 'unchanged', digest),
+                file=sys.stderr)
+
+
+def convert_pipelined(chunks, input_format):
+    """Converts with reading, converting and writing overlapping (see
+    `pipeline'), writing each output as it is created."""
+    if not isinstance(chunks, (binary.SkeletonStore, index.IndexedFile)):
+        chunks = pipeline.read_ahead(chunks)
+    nml = convert.load_nml(chunks, input_format, args.pyknossos, progress,
+                           args.things, transform)
+    for level, tolerance in enumerate(tolerances):
+        write_pieces(convert.iter_output(
+            nml, args.convert, tolerance, args.user, args.timestamp,
+            args.intern_labels, progress, transform), level)
+
+
+def convert_streamed(chunks):
+    """Converts NML into CATMAID JSON one <thing> at a time (see
+    `convert.iter_catmaid'). A first pass over the file finds the IDs of
+    all nodes, so that the objects get the same IDs as without -stream."""
+    catmaid = convert.create_generator(args.user, args.timestamp,
+                                       args.intern_labels, transform)
+    with open_source(args.source) as first_pass:
+        _, count = scan_nml(first_pass, catmaid.used_ids)
+    if progress is not None:
+        progress.start('converting', count)
+    if args.pipeline:
+        chunks = pipeline.read_ahead(chunks)
+    events = convert.iter_parsed(NmlParser(args.pyknossos), chunks, progress)
+    write_pieces(convert.iter_catmaid(events, catmaid, progress))
+
+
+def write(path, output):
+    if path.endswith('.gz'):
+        output = gzip_compress(output)
+    if not args.deterministic:
+        write_atomic(path, output)
+        return
+    report_hash(path, *write_if_changed(path, output))
+
+
+def convert_sharded(chunks):
+    """Converts CATMAID JSON into NML shards, and writes each shard as soon
+    as it is complete. Written shards are recorded in a journal next to the
+    output, which is deleted once all shards are written; with -resume,
+    the shards it lists are not converted again, as long as their files
+    are unchanged."""
+    run = {'source': os.path.abspath(args.source) if args.source else None,
+           'arguments': [arg for arg in sys.argv[1:] if arg != '-resume']}
+    if args.source:
+        info = os.stat(args.source)
+        run.update(size=info.st_size, mtime_ns=info.st_mtime_ns)
+    journal = Journal(args.output + '.journal', run, args.resume, key='shard')
+    done = {entry['shard'] for entry in journal.entries
+            if all(file_hash(path) == digest
+                   for path, digest in entry['outputs'])}
+    if done:
+        print('{} of {} shard(s) already written.'.format(len(done), args.shards),
+              file=sys.stderr)
+    with journal:
+        for shard, documents in parallel.iter_shards(
+                convert.parse_catmaid_json(chunks, progress), tolerances,
+                args.workers, args.shards, progress=progress,
+                thing_ids=args.things, transform=transform, skip=done):
+            written = []
+            for level, document in enumerate(documents):
+                path = output_path(level, shard)
+                write(path, document)
+                written.append([path, file_hash(path)])
+            journal.record(shard=shard, outputs=written)
+    journal.remove()
+
+
+def write_pieces(pieces, level=0):
+    """Writes an output piece by piece, as it is created."""
+    if args.output is None:
+        digest, _ = pipeline.write_behind(pieces)
+        if args.convert != 'binary':
+            # Like print()
+            sys.stdout.buffer.write(b'\n')
+        report_hash(None, digest, True)
+    else:
+        path = output_path(level)
+        report_hash(path, *pipeline.write_behind(
+            pieces, path, compress=path.endswith('.gz'),
+            keep_unchanged=args.deterministic))
+
+
+@contextlib.contextmanager
+def open_indexed(source):
+    """Like `open_input', but for any input file, and only the parts with
+    the selected things are read if the file has an up-to-date index."""
+    indexed = None
+    if args.things and source:
+        indexed = index.open_index(source)
+    if indexed is None:
+        with open_source(source) as chunks:
+            yield sniff_format(chunks)
     else:
-        nml_dict = convert.nml2dict(input_string, args.pyknossos)
+        with indexed:
+            yield indexed.format, indexed
+
+
+def merge_inputs():
+    """Loads all input files, and merges them into one NML dict, keeping
+    only one copy of identical skeletons (see `merge.Merger')."""
+    merger = Merger()
+    sources = [args.source] + args.sources
+    missing = 0
+    for source in sources:
+        with open_indexed(source) as (input_format, chunks):
+            try:
+                nml = convert.load_nml(chunks, input_format, args.pyknossos,
+                                       thing_ids=args.things,
+                                       transform=transform)
+            except convert.ThingsNotFound:
+                # The selected things only need to be in one of the inputs
+                missing += 1
+                if missing == len(sources):
+                    raise
+                continue
+            merger.add(nml, source or '<stdin>')
+    if merger.duplicates:
+        print('{} duplicate skeleton(s) dropped.'.format(len(merger.duplicates)),
+              file=sys.stderr)
+    if args.dedup_map is not None:
+        write_atomic(args.dedup_map, duplicates_csv(merger.duplicates))
+    return merger.nml
+
+
+progress = None
+if args.progress or args.heartbeat:
+    progress = stderr_progress(args.source, args.heartbeat, args.interval,
+                               quiet=not args.progress)
+
+try:
+    # Depending on args.convert, either parse (CATMAID) JSON into NML (XML),
+    # or parse NML (XML) into (CATMAID) JSON
+    if args.convert == 'catmaid':
         args = fill_arguments(args)
-        output = convert.create_catmaid(nml_dict,
-                                        args.user,
-                                        args.timestamp) \
-            .to_json()
+    # outputs[level][shard] holds the output for each tolerance and shard
+    outputs = None
+    if args.merge:
+        outputs = [[output] for output in convert.serialize_levels(
+            merge_inputs(), args.convert, tolerances, args.user,
+            args.timestamp, args.intern_labels, progress, transform)]
+    else:
+        with contextlib.ExitStack() as stack:
+            input_format, chunks = stack.enter_context(
+                open_input() if stdin_data is not None
+                else open_indexed(args.source))
+            if args.shards is not None and input_format != 'catmaid':
+                parser.error('-shards needs CATMAID JSON input')
+            if FROM_NML in (args.scale, args.offset) and input_format != 'nml':
+                parser.error('-scale nml and -offset nml need NML input')
+            if (input_format == 'binary' and args.source
+                    and not args.source.endswith('.gz')):
+                # Uncompressed binary files are memory-mapped, and only the
+                # selected skeletons are read. Compressed ones are read
+                # whole from the decompressed chunks (see `convert.load_nml').
+                chunks = stack.enter_context(binary.SkeletonStore(args.source))
+            if args.stream:
+                if input_format != 'nml':
+                    parser.error('-stream needs NML input')
+                convert_streamed(chunks)
+            elif args.pipeline:
+                convert_pipelined(chunks, input_format)
+            elif (args.convert == 'nml' and input_format == 'catmaid'
+                    and (args.workers or args.shards)):
+                if isinstance(chunks, index.IndexedFile):
+                    chunks = [chunks.extract(args.things)]
+                if args.shards is not None:
+                    convert_sharded(chunks)
+                else:
+                    outputs = parallel.serialize_nml(
+                        convert.parse_catmaid_json(chunks, progress),
+                        tolerances, args.workers, progress=progress,
+                        thing_ids=args.things, transform=transform)
+            else:
+                outputs = [[output] for output in convert.convert_levels(
+                    chunks, args.convert, tolerances, args.user,
+                    args.timestamp, args.pyknossos,
+                    args.intern_labels, progress, input_format, args.things,
+                    transform)]
 except (json.JSONDecodeError, declxml.XmlError):
     sys.exit(-1)
+except (binary.FormatError, ValueError) as error:
+    print(error, file=sys.stderr)
+    sys.exit(-1)
 except AssertionError:
     print("This doesn't seem to be a valid CATMAID JSON file.",
           file=sys.stderr)
     sys.exit(-1)
 
-if args.output is None:
-    print(output)
-else:
-    with open(args.output, 'w') as fw:
-        fw.write(output)
+if progress is not None:
+    progress.finish()
+
+
+# With -pipeline and -shards, the output has been written already
+if outputs is not None and args.output is None:
+    if isinstance(outputs[0][0], bytes):
+        sys.stdout.buffer.write(outputs[0][0])
+    else:
+        print(outputs[0][0])
+    report_hash(None, content_hash(outputs[0][0]), True)
+elif outputs is not None:
+    # One file per level of detail and shard
+    for level, shards in enumerate(outputs):
+        for shard, output in enumerate(shards):
+            write(output_path(level, shard), output)
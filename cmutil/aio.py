@@ -0,0 +1,203 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import asyncio
+import itertools
+
+from . import convert
+from .stream import NmlParser, CatmaidParser, collect_nml
+
+# How much to read from a source at once
+CHUNK_SIZE = 64 * 1024
+# How many nodes to add to a CatmaidGenerator per executor call
+NODES_PER_CALL = 10000
+# How many encoded JSON pieces to join per executor call
+PIECES_PER_CALL = 10000
+
+
+# All CPU-bound work below runs on `executor' (the event loop's default
+# executor if None), split into many small calls. That way a large upload
+# takes turns with the small ones instead of blocking an executor thread
+# for its whole conversion. The coroutines must run inside an event loop
+# (Python 3.7 or newer, see `asyncio.get_running_loop').
+
+
+async def _feed(reader, parser, executor):
+    loop = asyncio.get_running_loop()
+    parsed = []
+    while True:
+        chunk = await reader.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        parsed.extend(await loop.run_in_executor(executor, parser.feed, chunk))
+    parsed.extend(await loop.run_in_executor(executor, parser.close))
+    return parsed
+
+
+async def parse_catmaid_json(reader, executor=None):
+    """Asynchronous variant of `convert.parse_catmaid_json'.
+
+    :param reader: An `asyncio.StreamReader', or any object with a
+        coroutine `read(n)' returning bytes or str
+    :rtype: []
+    """
+    return await _feed(reader, CatmaidParser(), executor)
+
+
+async def nml2dict(reader, is_pyknossos=False, executor=None):
+    """Asynchronous variant of `convert.nml2dict'.
+
+    :param reader: See `parse_catmaid_json'
+    :param bool is_pyknossos: Whether to parse NML files generated from PyKNOSSOS.
+    :rtype: dict
+    """
+    return collect_nml(await _feed(reader, NmlParser(is_pyknossos), executor))
+
+
+async def create_catmaid(nml_dict, user_id, timestamp, intern_labels=False,
+                         executor=None):
+    """Asynchronous variant of `convert.create_catmaid'.
+
+    :rtype: CatmaidGenerator
+    """
+    loop = asyncio.get_running_loop()
+    catmaid = convert.create_generator(user_id, timestamp, intern_labels)
+    things = nml_dict['things']
+    for batch in _batches(things):
+        await loop.run_in_executor(executor, convert.reserve_node_ids, catmaid, batch)
+    for batch in _batches(things):
+        await loop.run_in_executor(executor, _add_things, catmaid, batch)
+    await loop.run_in_executor(executor, convert.add_comments, catmaid,
+                               nml_dict['comments'])
+    return catmaid
+
+
+async def prepare_nml(catmaid_objects, executor=None):
+    """Asynchronous variant of `convert.prepare_nml'.
+
+    :rtype: dict
+    """
+    loop = asyncio.get_running_loop()
+    skeletons, node_comments, comments = await loop.run_in_executor(
+        executor, convert.index_catmaid, catmaid_objects)
+    branchpoints = []
+    for batch in _batches(skeletons, _treenode_count):
+        branchpoints.extend(await loop.run_in_executor(
+            executor, _fill_things, batch, node_comments))
+    return {'things': [thing for thing, _ in skeletons],
+            'comments': comments,
+            'branchpoints': branchpoints}
+
+
+async def write_catmaid(catmaid, writer, executor=None):
+    """Encodes the CATMAID JSON of a CatmaidGenerator into `writer'.
+
+    :param writer: An `asyncio.StreamWriter', or any object with `write'
+        (taking bytes) and, optionally, a coroutine `drain'
+    """
+    await _write(catmaid.iter_json(), PIECES_PER_CALL, writer, executor)
+
+
+async def write_nml(nml, writer, executor=None):
+    """Serializes the output of `prepare_nml' into `writer', one `<thing>'
+    per executor call. See `write_catmaid'.
+    """
+    await _write(convert.iter_nml(nml), 1, writer, executor)
+
+
+async def convert_stream(reader, writer, output_format, user_id=None,
+                         timestamp=None, is_pyknossos=False,
+                         intern_labels=False, executor=None):
+    """Asynchronous variant of `convert.convert', which reads the input
+    from `reader' and writes the output to `writer'.
+
+    :param str output_format: Either 'nml' or 'catmaid'
+    """
+    if output_format == 'nml':
+        catmaid_objects = await parse_catmaid_json(reader, executor)
+        nml = await prepare_nml(catmaid_objects, executor)
+        await write_nml(nml, writer, executor)
+    else:
+        nml_dict = await nml2dict(reader, is_pyknossos, executor)
+        catmaid = await create_catmaid(nml_dict, user_id, timestamp,
+                                       intern_labels, executor)
+        await write_catmaid(catmaid, writer, executor)
+
+
+def _add_things(catmaid, things):
+    for thing in things:
+        convert.add_thing(catmaid, thing)
+
+
+def _fill_things(skeletons, node_comments):
+    """Fills in the things of (thing, treenodes) tuples from
+    `convert.index_catmaid', and returns their branchpoints."""
+    branchpoints = []
+    for thing, treenodes in skeletons:
+        convert.fill_thing(thing, treenodes, node_comments)
+        branchpoints.extend(convert.find_branchpoints(thing))
+    return branchpoints
+
+
+def _node_count(thing):
+    return len(thing['nodes'])
+
+
+def _treenode_count(skeleton):
+    return len(skeleton[1])
+
+
+def _batches(things, count=_node_count):
+    """Splits `things' into lists of about NODES_PER_CALL nodes each.
+
+    :param count: Tells the number of nodes of each item
+    """
+    batch = []
+    nodes = 0
+    for thing in things:
+        batch.append(thing)
+        nodes += count(thing)
+        if nodes >= NODES_PER_CALL:
+            yield batch
+            batch = []
+            nodes = 0
+    if batch:
+        yield batch
+
+
+def _join(pieces, count):
+    """Returns the next `count' pieces as bytes, or None when done."""
+    batch = list(itertools.islice(pieces, count))
+    return ''.join(batch).encode() if batch else None
+
+
+async def _write(pieces, count, writer, executor):
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(executor, _join, pieces, count)
+        if data is None:
+            break
+        writer.write(data)
+        if hasattr(writer, 'drain'):
+            await writer.drain()
@@ -0,0 +1,526 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+from array import array
+from collections import namedtuple
+import io
+import math
+import mmap
+import struct
+import sys
+
+from .topology import Topology
+
+# Compact binary skeleton files, which load with a few bulk reads instead
+# of parsing text, and which can be opened as a `SkeletonStore' to read
+# single skeletons without touching the rest of the file.
+#
+# All numbers are little-endian, and every section starts at a multiple of 8
+# bytes:
+#
+# - header: magic `CMSK', format version, flags (unused)
+# - one block per skeleton: thing ID, neuron ID, skeleton ID (0 if unknown),
+#   colour, node count n, and the type of the coordinates ('q' for integers,
+#   'd' for floats); then the arrays of node IDs (int64), parent indices
+#   (int64, -1 for roots), interleaved x, y, z coordinates, radii (float64)
+#   and comment indices (int32, -1 for none)
+# - string table: count, then length (uint32) and UTF-8 bytes of each string
+# - comments: count, node IDs (int64) and string indices (int64) of the
+#   <comments> of an NML file
+# - branchpoints: count, node IDs (int64)
+# - index: count, then for each skeleton its thing, neuron and skeleton ID,
+#   the byte range of its block, its node count and its bounding box
+# - trailer: number of skeletons and offsets of the last four sections
+#
+# Like in CATMAID, a skeleton is stored as a tree (see `topology.Topology'),
+# and coordinates use the KNOSSOS convention, like NML. NML parameters and
+# the `inVp', `inMag' and `time' attributes of nodes are not stored.
+
+MAGIC = b'CMSK'
+VERSION = 2
+
+_HEADER = struct.Struct('<4sHH')
+_SKELETON = struct.Struct('<qqqdddQc7x')
+_COUNT = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+_INDEX_ENTRY = struct.Struct('<qqqQQQdddddd')
+_TRAILER = struct.Struct('<QQQQQ8s')
+_END = b'CMSKEND\0'
+
+SkeletonInfo = namedtuple('SkeletonInfo', ['id', 'neuron_id', 'skeleton_id',
+                                           'offset', 'length', 'nodes',
+                                           'bbox_min', 'bbox_max'])
+SkeletonInfo.__doc__ = """Index entry of a skeleton: its IDs (0 if
+unknown), the byte range of its block, its number of nodes, and the
+smallest and largest x, y, z of its nodes (NaN if it has none)."""
+
+SkeletonArrays = namedtuple('SkeletonArrays', ['ids', 'parents', 'coordinates',
+                                               'radii', 'comments'])
+SkeletonArrays.__doc__ = """The arrays of a skeleton block: node IDs, parent
+indices (-1 for roots), interleaved x, y, z coordinates, radii and comment
+indices into the string table (-1 for none)."""
+
+
+class FormatError(ValueError):
+    """Raised for files that are not valid binary skeleton files."""
+
+
+def dumps(nml):
+    """Returns an NML dict (see `convert.nml2dict' and
+    `convert.prepare_nml') in the binary format.
+
+    :type nml: dict
+    :rtype: bytes
+    """
+    f = io.BytesIO()
+    dump(nml, f)
+    return f.getvalue()
+
+
+def dump(nml, f):
+    """Writes an NML dict to a binary file object in the binary format."""
+    strings = {}
+    index = []
+    position = _write(f, _HEADER.pack(MAGIC, VERSION, 0))
+    for thing in nml['things']:
+        block, bbox = _skeleton_block(thing, strings)
+        index.append(_INDEX_ENTRY.pack(
+            int(thing['id']), thing.get('neuron_id') or 0,
+            thing.get('skeleton_id') or 0, position, len(block),
+            len(thing['nodes']), *bbox))
+        position += _write(f, block)
+
+    comments = nml.get('comments') or []
+    comment_nodes = array('q', (comment['node'] for comment in comments))
+    comment_strings = array('q', (_string_index(strings, comment['content'])
+                                  for comment in comments))
+    branchpoints = array('q', (branchpoint['id']
+                               for branchpoint in nml.get('branchpoints') or []))
+
+    strings_offset = position
+    table = [_COUNT.pack(len(strings))]
+    for string in strings:
+        encoded = string.encode()
+        table.append(_LENGTH.pack(len(encoded)))
+        table.append(encoded)
+    position += _write(f, _pad(b''.join(table)))
+
+    comments_offset = position
+    position += _write(f, _COUNT.pack(len(comments)) + _tobytes(comment_nodes)
+                       + _tobytes(comment_strings))
+
+    branchpoints_offset = position
+    position += _write(f, _COUNT.pack(len(branchpoints)) + _tobytes(branchpoints))
+
+    index_offset = position
+    position += _write(f, _COUNT.pack(len(index)) + b''.join(index))
+
+    f.write(_TRAILER.pack(len(nml['things']), strings_offset, comments_offset,
+                          branchpoints_offset, index_offset, _END))
+
+
+def _skeleton_block(thing, strings):
+    """Returns the block of a thing, and its bounding box."""
+    nodes = thing['nodes']
+    topology = Topology.from_thing(thing)
+    try:
+        typecode = 'q'
+        coordinates = array('q', _coordinates(nodes))
+    except TypeError:
+        # PyKNOSSOS coordinates are floats
+        typecode = 'd'
+        coordinates = array('d', _coordinates(nodes))
+    radii = array('d', (node.get('radius', 1.0) for node in nodes))
+    comments = array('i', (_string_index(strings, node['comment'])
+                           if node.get('comment') else -1
+                           for node in nodes))
+
+    if nodes:
+        axes = [coordinates[axis::3] for axis in range(3)]
+        bbox = [min(values) for values in axes] + [max(values) for values in axes]
+    else:
+        bbox = [math.nan] * 6
+
+    header = _SKELETON.pack(int(thing['id']), thing.get('neuron_id') or 0,
+                            thing.get('skeleton_id') or 0,
+                            thing.get('color.r') or 0.0,
+                            thing.get('color.g') or 0.0,
+                            thing.get('color.b') or 0.0,
+                            len(nodes), typecode.encode())
+    block = _pad(b''.join((header, _tobytes(topology.ids),
+                           _tobytes(topology.parents), _tobytes(coordinates),
+                           _tobytes(radii), _tobytes(comments))))
+    return block, bbox
+
+
+def _coordinates(nodes):
+    for node in nodes:
+        yield node['x']
+        yield node['y']
+        yield node['z']
+
+
+def _string_index(strings, string):
+    index = strings.get(string)
+    if index is None:
+        index = strings[string] = len(strings)
+    return index
+
+
+def loads(data):
+    """Reads a binary skeleton file into an NML dict, like the one
+    `convert.nml2dict' returns.
+
+    :param data: The whole file, or an iterable of chunks of it (e.g. from
+        `fileio.open_source')
+    :type data: bytes or memoryview or iterable
+    :rtype: dict
+    """
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = read_all(data)
+    data = memoryview(data)
+    trailer = _read_trailer(data)
+    try:
+        strings = read_strings(data, trailer.strings)
+        things = []
+        offset = _HEADER.size
+        for _ in range(trailer.count):
+            thing, offset = read_skeleton(data, offset, strings)
+            things.append(thing)
+        comments = read_comments(data, trailer.comments, strings)
+        branchpoints = read_branchpoints(data, trailer.branchpoints)
+    except (struct.error, IndexError) as error:
+        raise FormatError('Corrupt binary skeleton file: {}'.format(error))
+
+    return {'things': things, 'comments': comments, 'branchpoints': branchpoints}
+
+
+_Trailer = namedtuple('_Trailer', ['count', 'strings', 'comments',
+                                   'branchpoints', 'index'])
+
+
+def _read_trailer(data):
+    if len(data) < _HEADER.size + _TRAILER.size:
+        raise FormatError('File too short for a binary skeleton file')
+    magic, version, _ = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise FormatError('Not a binary skeleton file')
+    if version != VERSION:
+        raise FormatError('Unsupported binary skeleton file version {}'.format(version))
+    trailer = _TRAILER.unpack_from(data, len(data) - _TRAILER.size)
+    if trailer[-1] != _END:
+        raise FormatError('Binary skeleton file is truncated')
+    return _Trailer(*trailer[:-1])
+
+
+def read_all(chunks, progress=None):
+    """Copies all chunks into one buffer.
+
+    :param progress.Progress progress: If given, counts the bytes read
+    :rtype: bytearray
+    """
+    data = bytearray()
+    for chunk in chunks:
+        data += chunk
+        if progress is not None:
+            progress.update(nbytes=len(chunk))
+    return data
+
+
+def read_strings(data, offset):
+    """Reads the string table starting at `offset'."""
+    strings = []
+    n = _COUNT.unpack_from(data, offset)[0]
+    offset += _COUNT.size
+    for _ in range(n):
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        strings.append(str(data[offset:offset + length], 'utf-8'))
+        offset += length
+    return strings
+
+
+def read_comments(data, offset, strings):
+    """Reads the <comments> section starting at `offset'."""
+    n = _COUNT.unpack_from(data, offset)[0]
+    offset += _COUNT.size
+    nodes = _array('q', data, offset, n)
+    contents = _array('q', data, offset + 8 * n, n)
+    return [{'node': node, 'content': strings[content]}
+            for node, content in zip(nodes, contents)]
+
+
+def read_branchpoints(data, offset):
+    """Reads the branchpoints section starting at `offset'."""
+    n = _COUNT.unpack_from(data, offset)[0]
+    return [{'id': node_id}
+            for node_id in _array('q', data, offset + _COUNT.size, n)]
+
+
+def read_skeleton(data, offset, strings):
+    """Reads the skeleton block starting at `offset' into an NML `thing'.
+
+    :returns: The thing, and the offset of the next block
+    :rtype: tuple
+    """
+    header, arrays, end = read_arrays(data, offset)
+    thing_id, neuron_id, skeleton_id, r, g, b, n, _ = header
+    ids, parents, coordinates, radii, comments = arrays
+
+    nodes = []
+    edges = []
+    for i in range(n):
+        comment = comments[i]
+        nodes.append({'id': ids[i], 'radius': radii[i],
+                      'x': coordinates[3 * i],
+                      'y': coordinates[3 * i + 1],
+                      'z': coordinates[3 * i + 2],
+                      'comment': strings[comment] if comment >= 0 else ''})
+        if parents[i] >= 0:
+            edges.append({'source': ids[parents[i]], 'target': ids[i]})
+
+    thing = {'id': thing_id, 'color.r': r, 'color.g': g, 'color.b': b,
+             'nodes': nodes, 'edges': edges}
+    if neuron_id:
+        thing['neuron_id'] = neuron_id
+    if skeleton_id:
+        thing['skeleton_id'] = skeleton_id
+    return thing, end
+
+
+def iter_arrays(data):
+    """Iterates over the skeleton blocks of a whole binary skeleton file
+    without creating NML dicts, e.g. to compute statistics.
+
+    :type data: bytes or memoryview
+    :returns: The unpacked block header and the `SkeletonArrays' of each
+        block (see `read_arrays')
+    :rtype: iterator of tuple
+    """
+    data = memoryview(data)
+    trailer = _read_trailer(data)
+    offset = _HEADER.size
+    try:
+        for _ in range(trailer.count):
+            header, arrays, offset = read_arrays(data, offset)
+            yield header, arrays
+    except (struct.error, IndexError) as error:
+        raise FormatError('Corrupt binary skeleton file: {}'.format(error))
+
+
+def read_comment_nodes(data):
+    """Returns the node IDs of the <comments> section of a whole binary
+    skeleton file, one per comment.
+
+    :rtype: array.array
+    """
+    data = memoryview(data)
+    offset = _read_trailer(data).comments
+    try:
+        n = _COUNT.unpack_from(data, offset)[0]
+    except struct.error as error:
+        raise FormatError('Corrupt binary skeleton file: {}'.format(error))
+    return _array('q', data, offset + _COUNT.size, n)
+
+
+def read_arrays(data, offset, copy=True):
+    """Reads the skeleton block starting at `offset'.
+
+    :param bool copy: If False, the arrays are memoryviews into `data'
+        instead of copies (on little-endian machines)
+    :returns: The unpacked block header, a `SkeletonArrays', and the offset
+        of the next block
+    :rtype: tuple
+    """
+    header = _SKELETON.unpack_from(data, offset)
+    n = header[6]
+    read = _array if copy or sys.byteorder == 'big' else _view
+    offset += _SKELETON.size
+    ids = read('q', data, offset, n)
+    offset += 8 * n
+    parents = read('q', data, offset, n)
+    offset += 8 * n
+    coordinates = read(header[7].decode(), data, offset, 3 * n)
+    offset += 8 * 3 * n
+    radii = read('d', data, offset, n)
+    offset += 8 * n
+    comments = read('i', data, offset, n)
+    offset += _padded(4 * n)
+    return header, SkeletonArrays(ids, parents, coordinates, radii, comments), offset
+
+
+class SkeletonStore:
+    """Random access to the skeletons of a binary skeleton file.
+
+    The file is memory-mapped, and only the index at its end is read when
+    it is opened. Looking up a skeleton reads its block and nothing else;
+    `arrays' even returns views into the mapped file without copying.
+    Skeletons can be looked up by thing ID, neuron ID or skeleton ID.
+
+    Use it as a context manager, or call `close'. The file can only be
+    unmapped once all views returned by `arrays' are released.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise FormatError('File too short for a binary skeleton file')
+        self._data = memoryview(self._mmap)
+        try:
+            self._trailer = _read_trailer(self._data)
+            offset = self._trailer.index
+            n = _COUNT.unpack_from(self._data, offset)[0]
+            self._infos = []
+            for entry in _INDEX_ENTRY.iter_unpack(
+                    self._data[offset + _COUNT.size:
+                               offset + _COUNT.size + n * _INDEX_ENTRY.size]):
+                self._infos.append(SkeletonInfo(*entry[:6], entry[6:9], entry[9:]))
+        except (FormatError, struct.error) as error:
+            self.close()
+            if isinstance(error, struct.error):
+                error = FormatError('Corrupt binary skeleton file: {}'.format(error))
+            raise error
+        self._strings = None
+
+        # Thing IDs take precedence over neuron IDs over skeleton IDs
+        self._lookup = {}
+        for key in ('skeleton_id', 'neuron_id', 'id'):
+            for info in self._infos:
+                if getattr(info, key):
+                    self._lookup[getattr(info, key)] = info
+
+    def close(self):
+        self._data.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Views returned by `arrays' are still around; the mapping is
+            # closed once they are gone.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._infos)
+
+    def __iter__(self):
+        """Iterates over the `SkeletonInfo' of all skeletons, in file order."""
+        return iter(self._infos)
+
+    def __contains__(self, id_):
+        return id_ in self._lookup
+
+    def info(self, id_):
+        """Returns the `SkeletonInfo' of a skeleton.
+
+        :param int id_: Thing, neuron or skeleton ID
+        :raises KeyError: If there is no such skeleton
+        """
+        return self._lookup[id_]
+
+    def arrays(self, id_):
+        """Returns the arrays of a skeleton as a `SkeletonArrays', without
+        copying them out of the file."""
+        info = self.info(id_)
+        return read_arrays(self._data, info.offset, copy=False)[1]
+
+    def thing(self, id_):
+        """Returns a skeleton as an NML `thing' dict."""
+        return read_skeleton(self._data, self.info(id_).offset, self.strings())[0]
+
+    def strings(self):
+        """Returns the string table, i.e. all comment texts."""
+        if self._strings is None:
+            self._strings = read_strings(self._data, self._trailer.strings)
+        return self._strings
+
+    def load(self, ids=None):
+        """Reads some or all skeletons into an NML dict, like `loads'.
+
+        :param ids: Read the skeletons whose thing, neuron or skeleton ID
+            is one of these; all of them if None
+        :rtype: dict
+        """
+        strings = self.strings()
+        comments = read_comments(self._data, self._trailer.comments, strings)
+        branchpoints = read_branchpoints(self._data, self._trailer.branchpoints)
+        if ids is None:
+            infos = self._infos
+        else:
+            ids = set(ids)
+            infos = [info for info in self._infos
+                     if info.id in ids or info.neuron_id in ids
+                     or info.skeleton_id in ids]
+
+        things = [read_skeleton(self._data, info.offset, strings)[0]
+                  for info in infos]
+        if ids is not None:
+            node_ids = {node['id'] for thing in things for node in thing['nodes']}
+            comments = [c for c in comments if c['node'] in node_ids]
+            branchpoints = [b for b in branchpoints if b['id'] in node_ids]
+        return {'things': things, 'comments': comments, 'branchpoints': branchpoints}
+
+
+def _array(typecode, data, offset, n):
+    values = array(typecode)
+    end = offset + n * values.itemsize
+    if end > len(data):
+        raise FormatError('Binary skeleton file is truncated')
+    values.frombytes(data[offset:end])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _view(typecode, data, offset, n):
+    end = offset + n * struct.calcsize(typecode)
+    if end > len(data):
+        raise FormatError('Binary skeleton file is truncated')
+    return data[offset:end].cast(typecode)
+
+
+def _tobytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _padded(size):
+    return (size + 7) & ~7
+
+
+def _pad(block):
+    return block + bytes(_padded(len(block)) - len(block))
+
+
+def _write(f, block):
+    f.write(block)
+    return len(block)
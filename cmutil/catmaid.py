@@ -24,6 +24,9 @@
 
 import json
 
+from .idset import IdSet
+from .transform import Affine
+
 
 class CatmaidGenerator:
     """This class is used to generate CATMAID JSON files from NML files.
@@ -33,32 +36,44 @@ class CatmaidGenerator:
 
     """
 
-    used_ids = set()
-
-    # I assume you are familiar with CATMAID's JSON syntax. Basically,
-    # a JSON array of lots of JSON objects, all of them belonging to a specific
-    # `catmaid' namespace, e.g. `catmaid.class', `catmaid.relation', and so on.
-    # The following fields hold all of these.
-    classes = {}
-    relations = {}
-
-    neurons = []
-    skeletons = []
-    classinstanceclassinstances = []
-    treenodes = []
-    tags = []
-    treenodeclassinstances = []
-    users = []
-
-    @staticmethod
-    def create_id():
+    def create_id(self):
         # Create an ID by incrementing IDs we already know
-        return (1 if len(CatmaidGenerator.used_ids) == 0
-                else max(CatmaidGenerator.used_ids) + 1)
+        return (1 if len(self.used_ids) == 0
+                else self.used_ids.max() + 1)
+
+    def __init__(self, user_id, timestamp, intern_labels=False, transform=None):
+        # All state lives on the instance, so that a long-running process
+        # can convert one file after another without IDs or objects of a
+        # previous conversion leaking into the next one.
+        # Every ID of every kind of object, as a bitmap
+        self.used_ids = IdSet()
+
+        # I assume you are familiar with CATMAID's JSON syntax. Basically,
+        # a JSON array of lots of JSON objects, all of them belonging to a
+        # specific `catmaid' namespace, e.g. `catmaid.class',
+        # `catmaid.relation', and so on. The following fields hold all of these.
+        self.classes = {}
+        self.relations = {}
+
+        self.neurons = []
+        self.skeletons = []
+        self.classinstanceclassinstances = []
+        self.treenodes = []
+        self.tags = []
+        self.treenodeclassinstances = []
+        self.users = []
+
+        # If labels are interned, there is only one label per distinct
+        # comment text. This maps each text to the ID of its label.
+        self.intern_labels = intern_labels
+        self.label_ids = {}
+
+        # Transforms the KNOSSOS coordinates of NML nodes into CATMAID
+        # coordinates, which `add_treenode' expects
+        self.transform = transform or Affine()
 
-    def __init__(self, user_id, timestamp):
         self.user_id = user_id
-        CatmaidGenerator.used_ids.add(user_id)
+        self.used_ids.add(user_id)
         self.users.append(
             {'model': 'auth.user',
              'pk': self.user_id,
@@ -69,16 +84,43 @@ class CatmaidGenerator:
         )
         self.timestamp = timestamp
 
+    def objects(self):
+        """Returns all CATMAID objects in the order they are written."""
+        return [*self.classes.values(), *self.relations.values(),
+                *self.neurons, *self.classinstanceclassinstances,
+                *self.skeletons, *self.treenodes,
+                *self.tags, *self.treenodeclassinstances,
+                *self.users]
+
     def to_json(self):
-        return json.dumps([*self.classes.values(), *self.relations.values(),
-                           *self.neurons, *self.classinstanceclassinstances,
-                           *self.skeletons, *self.treenodes,
-                           *self.tags, *self.treenodeclassinstances,
-                           *self.users],
-                          indent=4)
+        return json.dumps(self.objects(), indent=4)
+
+    def iter_json(self):
+        """Encodes the same JSON as `to_json', piece by piece."""
+        return json.JSONEncoder(indent=4).iterencode(self.objects())
+
+    def take_skeleton_objects(self):
+        """Returns the neurons, links, skeletons, treenodes, tags and label
+        links added since the last call, in the order of `objects', and
+        forgets them. This allows writing CATMAID JSON one skeleton at a
+        time (see `convert.iter_catmaid'); `objects' then only returns what
+        hasn't been taken yet.
+
+        :rtype: list
+        """
+        objects = [*self.neurons, *self.classinstanceclassinstances,
+                   *self.skeletons, *self.treenodes,
+                   *self.tags, *self.treenodeclassinstances]
+        self.neurons = []
+        self.classinstanceclassinstances = []
+        self.skeletons = []
+        self.treenodes = []
+        self.tags = []
+        self.treenodeclassinstances = []
+        return objects
 
     def add_class(self, class_id, class_name, description):
-        CatmaidGenerator.used_ids.add(class_id)
+        self.used_ids.add(class_id)
         self.classes[class_name] = {
             'model': 'catmaid.class',
             'pk': class_id,
@@ -91,7 +133,7 @@ class CatmaidGenerator:
         }
 
     def add_relation(self, relation_id, relation_name, description, is_reciprocal=False):
-        CatmaidGenerator.used_ids.add(relation_id)
+        self.used_ids.add(relation_id)
         self.relations[relation_name] = {
             'model': 'catmaid.relation',
             'pk': relation_id,
@@ -106,7 +148,7 @@ class CatmaidGenerator:
         }
 
     def add_neuron(self, neuron_id):
-        CatmaidGenerator.used_ids.add(neuron_id)
+        self.used_ids.add(neuron_id)
         self.neurons.append(
             {'model': 'catmaid.classinstance',
              'pk': neuron_id,
@@ -120,7 +162,7 @@ class CatmaidGenerator:
         )
 
     def add_skeleton(self, skeleton_id):
-        CatmaidGenerator.used_ids.add(skeleton_id)
+        self.used_ids.add(skeleton_id)
         self.skeletons.append(
             {'model': 'catmaid.classinstance',
              'pk': skeleton_id,
@@ -135,7 +177,7 @@ class CatmaidGenerator:
 
     def add_classinstanceclassinstance(self, neuron_id, skeleton_id):
         class_id = self.create_id()
-        CatmaidGenerator.used_ids.add(class_id)
+        self.used_ids.add(class_id)
         self.classinstanceclassinstances.append(
             {'model': 'catmaid.classinstanceclassinstance',
              'pk': class_id,
@@ -150,7 +192,7 @@ class CatmaidGenerator:
         )
 
     def add_treenode(self, node_id, skeleton_id, parent, x, y, z):
-        CatmaidGenerator.used_ids.add(node_id)
+        self.used_ids.add(node_id)
         self.treenodes.append(
             {'model': 'catmaid.treenode',
              'pk': node_id,
@@ -159,9 +201,9 @@ class CatmaidGenerator:
                  'creation_time': self.timestamp,
                  'edition_time': self.timestamp,
                  'editor': self.user_id,
-                 'location_x': x - 1,
-                 'location_y': y - 1,
-                 'location_z': z - 1,
+                 'location_x': x,
+                 'location_y': y,
+                 'location_z': z,
                  'parent': parent,
                  'radius': -1.0,
                  'confidence': 5,
@@ -170,7 +212,7 @@ class CatmaidGenerator:
         )
 
     def add_tag(self, tag_id, comment):
-        CatmaidGenerator.used_ids.add(tag_id)
+        self.used_ids.add(tag_id)
         self.tags.append(
             {'model': 'catmaid.classinstance',
              'pk': tag_id,
@@ -185,7 +227,7 @@ class CatmaidGenerator:
 
     def add_treenodeclassinstance(self, relation_id, treenode_id, target_id):
         instance_id = self.create_id()
-        CatmaidGenerator.used_ids.add(instance_id)
+        self.used_ids.add(instance_id)
         self.treenodeclassinstances.append(
             {'model': 'catmaid.treenodeclassinstance',
              'pk': instance_id,
@@ -198,3 +240,22 @@ class CatmaidGenerator:
                  'class_instance': target_id}
              }
         )
+
+
+def iter_json_array(groups):
+    """Encodes a JSON array given as consecutive groups of its items, one
+    group at a time. Joined together, the pieces are identical to what
+    `json.dumps' creates for the whole array with an indent of 4.
+
+    :param groups: Iterable of lists
+    :rtype: iterator of str
+    """
+    empty = True
+    yield '['
+    for group in groups:
+        if not group:
+            continue
+        # Strip the brackets of the encoded group, keeping the indentation
+        yield ('\n' if empty else ',\n') + json.dumps(group, indent=4)[2:-2]
+        empty = False
+    yield ']' if empty else '\n]'
@@ -25,46 +25,88 @@
 import json
 import sys
 
-from . import declxml
-from .nml import things_processor, pyknossos_things_processor
-from .catmaid import CatmaidGenerator
-
-
-def parse_catmaid_json(json_str):
+from . import binary, declxml
+from .nml import (things_processor, pyknossos_things_processor,
+                  thing_processor, comments_processor, branchpoints_processor)
+from .nml import parameters as parameters_processor
+from .catmaid import CatmaidGenerator, iter_json_array
+from .index import IndexedFile
+from .simplify import simplify
+from .stream import NmlParser, CatmaidParser, collect_nml
+from .topology import Topology
+from .transform import Affine
+
+
+def parse_catmaid_json(json_str, progress=None):
     """All CATMAID JSON files consist of a JSON array of JSON objects,
     so this function should always return a list of dicts.
 
-    :type json_str: str
+    :param json_str: The whole document, or an iterable of chunks of it
+        (e.g. from `fileio.open_source')
+    :type json_str: str or bytes or iterable
+    :param progress.Progress progress: If given, counts the bytes read
     :rtype: []
     """
     try:
-        _ = json.loads(json_str)
-        assert (all(isinstance(x, dict) for x in _))
-        return _
+        if isinstance(json_str, (str, bytes)):
+            if progress is not None:
+                progress.update(nbytes=len(json_str))
+            _ = json.loads(json_str)
+            assert (all(isinstance(x, dict) for x in _))
+            return _
+        return _feed(CatmaidParser(), json_str, progress)
     except json.JSONDecodeError as error:
         print(error, file=sys.stderr)
         raise
 
 
-def create_catmaid(nml_dict, user_id, timestamp):
+def create_catmaid(nml_dict, user_id, timestamp, intern_labels=False,
+                   progress=None, transform=None):
     """Creates a CatmaidGenerator object from a Python dict of NML tags.
 
     :type nml_dict: dict
     :type project_id: int
     :type user_id: int
     :type timestamp: str
+    :param bool intern_labels: Create only one CATMAID label per distinct
+        comment text, and link all nodes with that comment to it (this is
+        how CATMAID itself models tags). Otherwise, every comment becomes a
+        label of its own.
+    :param progress.Progress progress: If given, counts the things added
+    :param transform.Affine transform: Coordinate transform; by default,
+        coordinates are only shifted by one voxel
     :rtype: CatmaidGenerator
     """
 
+    if transform is not None:
+        transform = transform.bind(nml_dict.get('parameters'))
+    catmaid = create_generator(user_id, timestamp, intern_labels, transform)
+
     # First of all, we need the IDs of all nodes so that we don't
     # accidentally duplicate an ID when we add a CATMAID object
+    reserve_node_ids(catmaid, nml_dict['things'])
+
+    # Let's start. Every `thing' in `things' is a CATMAID neuron.
+    if progress is not None:
+        progress.start('converting', len(nml_dict['things']))
     for thing in nml_dict['things']:
-        for node in thing['nodes']:
-            CatmaidGenerator.used_ids.add(node['id'])
+        add_thing(catmaid, thing)
+        if progress is not None:
+            progress.update(things=1, nodes=len(thing['nodes']))
+
+    add_comments(catmaid, nml_dict['comments'])
+
+    return catmaid
+
+
+def create_generator(user_id, timestamp, intern_labels=False, transform=None):
+    """Creates a CatmaidGenerator holding the CATMAID boilerplate objects
+    (classes, relations).
 
-    catmaid = CatmaidGenerator(user_id, timestamp)
+    :rtype: CatmaidGenerator
+    """
+    catmaid = CatmaidGenerator(user_id, timestamp, intern_labels, transform)
 
-    # Add CATMAID boilerplate objects (classes, relations).
     # The ID (the first argument) of the following lines can vary.
     # However, I exported some example CATMAID data, and decided to re-use the
     # IDs that I found in those files.
@@ -75,74 +117,116 @@ def create_catmaid(nml_dict, user_id, timestamp):
     catmaid.add_relation(54, 'model_of', 'Marks something as a model of something else.')
     catmaid.add_relation(56, 'labeled_as', 'Something is labeled by sth. else.')
 
-    things = nml_dict['things']
-    # Let's start. Every `thing' in `things' is a CATMAID neuron.
-    for thing in things:
-        # In NML (and unlike CATMAID JSON), `thing' IDs and `node' IDs can
-        # overlap. To map back to CATMAID neurons, we hope that each `thing'
-        # has additional properties specifying a neuron and skeleton ID.
-        # Re-use these IDs if they are not already used.
-        if ('neuron_id' in thing
-                and thing['neuron_id'] != 0
-                and thing['neuron_id'] not in CatmaidGenerator.used_ids):
-            neuron_id = thing['neuron_id']
-        elif thing['id'] in CatmaidGenerator.used_ids:
-            neuron_id = CatmaidGenerator.create_id()
-        else:
-            neuron_id = thing['id']
-        catmaid.add_neuron(neuron_id)
-
-        # For every neuron, create a skeleton.
-        # Re-use `skeleton_id' if it exists, and is not yet used.
-        if ('skeleton_id' in thing
-                and thing['skeleton_id'] != 0
-                and thing['skeleton_id'] not in CatmaidGenerator.used_ids):
-            skeleton_id = thing['skeleton_id']
-        else:
-            skeleton_id = CatmaidGenerator.create_id()
-        catmaid.add_skeleton(skeleton_id)
+    return catmaid
 
-        # For every skeleton, create a `classinstanceclassinstance'.
-        # This will create an ID for `classinstanceclassinstance' automatically.
-        catmaid.add_classinstanceclassinstance(neuron_id, skeleton_id)
 
-        # Create a lookup map to hold each node's parent.
-        edges = {edge['target']: edge['source'] for edge in thing['edges']}
+def reserve_node_ids(catmaid, things):
+    """Marks the IDs of all nodes of `things' as used. This has to happen
+    for all things before the first thing is added.
 
+    :type catmaid: CatmaidGenerator
+    """
+    for thing in things:
         for node in thing['nodes']:
-            node_id = node['id']
-            catmaid.add_treenode(node_id, skeleton_id,
-                                 edges[node_id] if node_id in edges else None,
-                                 node['x'], node['y'], node['z'])
-
-            # Does the node have a comment?
-            if 'comment' in node and node['comment'] != '':
-                tag_id = CatmaidGenerator.create_id()
-                catmaid.add_tag(tag_id, node['comment'])
-                catmaid.add_treenodeclassinstance(catmaid.relations['labeled_as']['pk'],
-                                                  node_id, tag_id)
-
-    # Check for the <comments> tag found in older NML versions.
-    if len(nml_dict['comments']) > 0:
-        for comment in nml_dict['comments']:
-            tag_id = CatmaidGenerator.create_id()
-            catmaid.add_tag(tag_id, comment['content'])
-            catmaid.add_treenodeclassinstance(catmaid.relations['labeled_as']['pk'],
-                                              comment['node'], tag_id)
+            catmaid.used_ids.add(node['id'])
+
+
+def add_thing(catmaid, thing):
+    """Adds a `thing' as a CATMAID neuron, skeleton and treenodes.
+
+    :type catmaid: CatmaidGenerator
+    :type thing: dict
+    """
+    # In NML (and unlike CATMAID JSON), `thing' IDs and `node' IDs can
+    # overlap. To map back to CATMAID neurons, we hope that each `thing'
+    # has additional properties specifying a neuron and skeleton ID.
+    # Re-use these IDs if they are not already used.
+    if ('neuron_id' in thing
+            and thing['neuron_id'] != 0
+            and thing['neuron_id'] not in catmaid.used_ids):
+        neuron_id = thing['neuron_id']
+    elif thing['id'] in catmaid.used_ids:
+        neuron_id = catmaid.create_id()
+    else:
+        neuron_id = thing['id']
+    catmaid.add_neuron(neuron_id)
+
+    # For every neuron, create a skeleton.
+    # Re-use `skeleton_id' if it exists, and is not yet used.
+    if ('skeleton_id' in thing
+            and thing['skeleton_id'] != 0
+            and thing['skeleton_id'] not in catmaid.used_ids):
+        skeleton_id = thing['skeleton_id']
+    else:
+        skeleton_id = catmaid.create_id()
+    catmaid.add_skeleton(skeleton_id)
+
+    # For every skeleton, create a `classinstanceclassinstance'.
+    # This will create an ID for `classinstanceclassinstance' automatically.
+    catmaid.add_classinstanceclassinstance(neuron_id, skeleton_id)
+
+    # The topology knows each node's parent, and picks roots if the edges
+    # don't form a proper tree.
+    parents = Topology.from_thing(thing).parent_ids()
+
+    # All coordinates of the skeleton are transformed at once
+    locations = catmaid.transform.to_catmaid(
+        [(node['x'], node['y'], node['z']) for node in thing['nodes']])
+
+    for node, parent, (x, y, z) in zip(thing['nodes'], parents, locations):
+        node_id = node['id']
+        catmaid.add_treenode(node_id, skeleton_id, parent, x, y, z)
+
+        # Does the node have a comment?
+        if 'comment' in node and node['comment'] != '':
+            add_label(catmaid, node_id, node['comment'])
+
+
+def add_comments(catmaid, comments):
+    """Adds the <comments> tag found in older NML versions as CATMAID labels.
+
+    :type catmaid: CatmaidGenerator
+    :type comments: list
+    """
+    for comment in comments:
+        add_label(catmaid, comment['node'], comment['content'])
 
-    return catmaid
 
+def add_label(catmaid, node_id, comment):
+    """Labels a treenode with a comment.
 
-def nml2dict(xml_str, is_pyknossos=False):
+    :type catmaid: CatmaidGenerator
+    :type node_id: int
+    :type comment: str
+    """
+    if catmaid.intern_labels and comment in catmaid.label_ids:
+        tag_id = catmaid.label_ids[comment]
+    else:
+        tag_id = catmaid.create_id()
+        catmaid.add_tag(tag_id, comment)
+        if catmaid.intern_labels:
+            catmaid.label_ids[comment] = tag_id
+    catmaid.add_treenodeclassinstance(catmaid.relations['labeled_as']['pk'],
+                                      node_id, tag_id)
+
+
+def nml2dict(xml_str, is_pyknossos=False, progress=None):
     """Converts NML into a Python dict.
 
-    :type xml_str: str
+    :param xml_str: The whole document, or an iterable of chunks of it
+        (e.g. from `fileio.open_source')
+    :type xml_str: str or bytes or iterable
     :param bool is_pyknossos: Whether to parse NML files generated from PyKNOSSOS.
+    :param progress.Progress progress: If given, counts the bytes read
     :returns: Python dict of NML tags
     :rtype: dict
     """
 
     try:
+        if not isinstance(xml_str, (str, bytes)):
+            return collect_nml(_feed(NmlParser(is_pyknossos), xml_str, progress))
+        if progress is not None:
+            progress.update(nbytes=len(xml_str))
         if is_pyknossos:
             _ = declxml.parse_from_string(pyknossos_things_processor, xml_str)
         else:
@@ -153,7 +237,77 @@ def nml2dict(xml_str, is_pyknossos=False):
         raise
 
 
-def prepare_nml(catmaid_objects):
+def _feed(parser, chunks, progress=None):
+    return list(iter_parsed(parser, chunks, progress))
+
+
+def iter_parsed(parser, chunks, progress=None):
+    """Feeds chunks into an incremental parser (see `stream'), and yields
+    what it parsed as soon as it is complete.
+
+    :param progress.Progress progress: If given, counts the bytes read
+    """
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if progress is not None:
+            progress.update(nbytes=len(chunk))
+    yield from parser.close()
+
+
+def prepare_nml(catmaid_objects, progress=None, transform=None):
+    skeletons, node_comments, comments = index_catmaid(catmaid_objects)
+    if transform is not None:
+        transform = transform.bind(None)
+
+    branchpoints = []
+    for thing in _fill_things(skeletons, node_comments, transform, progress):
+        branchpoints.extend(find_branchpoints(thing))
+
+    nml = {'things': [thing for thing, _ in skeletons],
+           'comments': comments,
+           'branchpoints': branchpoints}
+    # Scale and offset go into the NML file, so that it can be converted back
+    if transform is not None and not transform.is_default:
+        nml['parameters'] = transform.parameters()
+    return nml
+
+
+def iter_things(catmaid_objects, progress=None, transform=None):
+    """Converts CATMAID objects into NML <thing>s like `prepare_nml', but
+    yields each thing as soon as its nodes and edges are filled in, for
+    callers that use the things directly instead of writing NML. The
+    comment of each node is in its `comment' key.
+
+    :param list catmaid_objects: E.g. from `parse_catmaid_json'
+    :param progress.Progress progress: If given, counts the things filled
+    :param transform.Affine transform: Transform into NML coordinates
+    :rtype: iterator of dict
+    """
+    skeletons, node_comments, _ = index_catmaid(catmaid_objects)
+    if transform is not None:
+        transform = transform.bind(None)
+    yield from _fill_things(skeletons, node_comments, transform, progress)
+
+
+def _fill_things(skeletons, node_comments, transform, progress):
+    if progress is not None:
+        progress.start('converting', len(skeletons))
+    for thing, treenodes in skeletons:
+        fill_thing(thing, treenodes, node_comments, transform)
+        if progress is not None:
+            progress.update(things=1, nodes=len(treenodes))
+        yield thing
+
+
+def index_catmaid(catmaid_objects):
+    """Sorts CATMAID objects into one empty <thing> per neuron, with the
+    treenodes of its skeleton, and looks up the comment of each treenode.
+
+    :returns: A list of (thing, treenodes) tuples, a dict mapping treenode
+        IDs to their comment, and the list of all comments as <comments>
+        entries
+    :rtype: tuple
+    """
     classes = {}
     relations = {}
     classinstances = []
@@ -194,29 +348,342 @@ def prepare_nml(catmaid_objects):
     comments = {comment['pk']: comment
                 for comment in classinstances
                 if comment['fields']['class_column'] == classes['label']['pk']}
+    # Lots of nodes share the same few comments ("ending", "soma", ...),
+    # so keep only one copy of each text around.
+    for comment in comments.values():
+        comment['fields']['name'] = sys.intern(comment['fields']['name'])
 
     # Create a map of treenodes IDs to comments
     treenode_map = {_['fields']['treenode']: _['fields']['class_instance']
                     for _ in treenodeclassinstances
                     if _['fields']['relation'] == relations['labeled_as']['pk']}
+    node_comments = {node: comments[label]['fields']['name']
+                     for node, label in treenode_map.items()}
 
+    skeleton_treenodes = {skeleton_id: [] for skeleton_id in skeletons}
     for node in treenodes:
-        skeleton_id = node['fields']['skeleton']
-        skeletons[skeleton_id]['nodes'].append({
-            'x': int(node['fields']['location_x']) + 1,
-            'y': int(node['fields']['location_y']) + 1,
-            'z': int(node['fields']['location_z']) + 1,
-            'id': node['pk'],
-            'comment': comments[treenode_map[node['pk']]]['fields']['name'] if node['pk'] in treenode_map else ''
+        skeleton_treenodes[node['fields']['skeleton']].append(node)
+
+    return ([(thing, skeleton_treenodes[thing['skeleton_id']]
+              if skeletons[thing['skeleton_id']] is thing else [])
+             for thing in things.values()],
+            node_comments,
+            [{'node': _, 'content': node_comments[_]} for _ in node_comments])
+
+
+def fill_thing(thing, treenodes, node_comments, transform=None):
+    """Adds the nodes and edges of a skeleton to its <thing>.
+
+    :type thing: dict
+    :param list treenodes: The skeleton's `catmaid.treenode' objects
+    :param dict node_comments: Comments by treenode ID
+    :param transform.Affine transform: Coordinate transform; by default,
+        coordinates are only shifted by one voxel
+    """
+    fill_nodes(thing, [node['pk'] for node in treenodes],
+               [node['fields']['parent'] for node in treenodes],
+               [(node['fields']['location_x'], node['fields']['location_y'],
+                 node['fields']['location_z']) for node in treenodes],
+               node_comments, transform)
+
+
+def fill_nodes(thing, ids, parents, locations, node_comments, transform=None):
+    """Like `fill_thing', but takes the treenodes as separate lists, e.g.
+    from `shm.read'.
+
+    :param list ids: Treenode IDs
+    :param list parents: Parent treenode IDs, or None for the root
+    :param list locations: (x, y, z) CATMAID coordinates of the treenodes
+    """
+    # All coordinates of the skeleton are transformed at once
+    positions = (transform or Affine()).to_knossos(locations)
+
+    for node_id, parent, (x, y, z) in zip(ids, parents, positions):
+        thing['nodes'].append({
+            'x': x,
+            'y': y,
+            'z': z,
+            'id': node_id,
+            'comment': node_comments.get(node_id, '')
         })
 
-        if node['fields']['parent'] is not None:
-            skeletons[skeleton_id]['edges'].append({
-                'target': node['pk'],
-                'source': node['fields']['parent']
+        if parent is not None:
+            thing['edges'].append({
+                'target': node_id,
+                'source': parent
             })
 
-    return {'things': things.values(),
-            'comments': [{'node': _,
-                          'content': comments[treenode_map[_]]['fields']['name']}
-                         for _ in treenode_map]}
+
+def find_branchpoints(thing):
+    """Returns every node with more than one child as a <branchpoint>."""
+    topology = Topology.from_thing(thing)
+    return [{'id': topology.ids[i]} for i in topology.branch_nodes]
+
+
+def iter_catmaid(events, catmaid, progress=None):
+    """Converts NML into CATMAID JSON one skeleton at a time. Unlike
+    `CatmaidGenerator.iter_json', all objects of a skeleton (neuron, link,
+    skeleton, treenodes and labels) are written together, right after the
+    classes and relations, and dropped before the next thing is added. The
+    labels of the <comments> section follow the last skeleton.
+
+    The objects and their IDs are the same as with `create_catmaid', as
+    long as the IDs of all nodes are marked as used beforehand (see
+    `reserve_node_ids' and `stream.scan_nml').
+
+    :param events: `(tag, value)' tuples, as from `stream.NmlParser'
+    :param catmaid: See `create_generator'
+    :type catmaid: CatmaidGenerator
+    :param progress.Progress progress: If given, counts the things added
+    :rtype: iterator of str
+    """
+    return iter_json_array(iter_skeleton_objects(events, catmaid, progress))
+
+
+def iter_skeleton_objects(events, catmaid, progress=None):
+    """Creates the CATMAID objects for NML events, grouped like
+    `iter_catmaid' writes them: the classes and relations, then one list
+    per skeleton, then the labels of the <comments> section, and finally
+    the users. Each list is handed out before the next thing is added.
+
+    :param events: `(tag, value)' tuples, as from `stream.NmlParser'
+    :type catmaid: CatmaidGenerator
+    :rtype: iterator of lists of dicts
+    """
+    yield [*catmaid.classes.values(), *catmaid.relations.values()]
+    comments = []
+    bound = False
+    for tag, value in events:
+        if tag == 'parameters':
+            catmaid.transform = catmaid.transform.bind(value)
+            bound = True
+        elif tag == 'thing':
+            if not bound:
+                catmaid.transform = catmaid.transform.bind(None)
+                bound = True
+            add_thing(catmaid, value)
+            if progress is not None:
+                progress.update(things=1, nodes=len(value['nodes']))
+            yield catmaid.take_skeleton_objects()
+        elif tag == 'comments':
+            comments.extend(value)
+    add_comments(catmaid, comments)
+    yield catmaid.take_skeleton_objects()
+    yield catmaid.users
+
+
+def iter_catmaid_objects(nml_dict, user_id, timestamp, intern_labels=False,
+                         progress=None, transform=None):
+    """Converts an NML dict into CATMAID objects like `create_catmaid',
+    but yields the object dicts one skeleton at a time (see
+    `iter_skeleton_objects'), for callers that use the objects directly
+    instead of writing JSON. The objects and their IDs are the same as
+    with `create_catmaid'.
+
+    :type nml_dict: dict
+    :param progress.Progress progress: If given, counts the things added
+    :rtype: iterator of dict
+    """
+    catmaid = create_generator(user_id, timestamp, intern_labels, transform)
+    reserve_node_ids(catmaid, nml_dict['things'])
+    events = [('thing', thing) for thing in nml_dict['things']]
+    if 'parameters' in nml_dict:
+        events.insert(0, ('parameters', nml_dict['parameters']))
+    events.append(('comments', nml_dict['comments']))
+
+    if progress is not None:
+        progress.start('converting', len(nml_dict['things']))
+    for objects in iter_skeleton_objects(events, catmaid, progress):
+        yield from objects
+
+
+def iter_nml(nml, indent=' '):
+    """Serializes the output of `prepare_nml' piece by piece. Joined
+    together, the pieces are identical to what `declxml.serialize_to_string'
+    creates for the whole document, but each `<thing>' is serialized on its
+    own, so that callers can interleave serialization with other work.
+
+    :type nml: dict
+    :rtype: iterator of str
+    """
+    fragments = (declxml.serialize_to_fragment(thing_processor, thing, indent)
+                 for thing in nml['things'])
+    return splice_nml(fragments, nml.get('comments'), nml.get('branchpoints'),
+                      nml.get('parameters'), indent)
+
+
+def splice_nml(fragments, comments, branchpoints, parameters=None, indent=' '):
+    """Assembles an NML document from already serialized `<thing>'
+    fragments (see `declxml.serialize_to_fragment').
+
+    :rtype: iterator of str
+    """
+    yield '<?xml version="1.0" ?>\n<things>\n'
+    if parameters:
+        yield declxml.serialize_to_fragment(parameters_processor, parameters, indent)
+    yield from fragments
+    yield declxml.serialize_to_fragment(comments_processor, comments, indent)
+    yield declxml.serialize_to_fragment(branchpoints_processor, branchpoints, indent)
+    yield '</things>\n'
+
+
+def convert(input_string, output_format, user_id=None, timestamp=None,
+            is_pyknossos=False, tolerance=None, intern_labels=False,
+            progress=None, input_format=None, transform=None):
+    """Converts a whole NML or CATMAID JSON document in one go. This is what
+    the command line does for a single file; it is also used by the
+    long-running modes, which convert many files in one process.
+
+    :param input_string: CATMAID JSON if `output_format' is 'nml', NML
+        otherwise (unless `input_format' says otherwise). Either the whole
+        document, or an iterable of chunks.
+    :type input_string: str or bytes or iterable
+    :param str output_format: Either 'nml', 'catmaid' or 'binary'
+    :param int user_id: (Only for creating CATMAID JSON) CATMAID user ID
+    :param str timestamp: (Only for creating CATMAID JSON) Creation time
+    :param bool is_pyknossos: Whether to parse NML files generated from PyKNOSSOS.
+    :param float tolerance: If given, skeletons are simplified with this
+        tolerance (see `simplify.simplify')
+    :param bool intern_labels: (Only for creating CATMAID JSON) See
+        `create_catmaid'
+    :param progress.Progress progress: If given, reports on the conversion
+    :param str input_format: Either 'nml', 'catmaid' or 'binary' (see
+        `binary'), e.g. from `fileio.sniff_format'
+    :param transform.Affine transform: Transform between NML and CATMAID
+        coordinates; by default, coordinates are only shifted by one voxel
+    :returns: The converted document
+    :rtype: str (bytes for 'binary')
+    """
+    return convert_levels(input_string, output_format, [tolerance], user_id,
+                          timestamp, is_pyknossos, intern_labels, progress,
+                          input_format, transform=transform)[0]
+
+
+def convert_levels(input_string, output_format, tolerances, user_id=None,
+                   timestamp=None, is_pyknossos=False, intern_labels=False,
+                   progress=None, input_format=None, thing_ids=None,
+                   transform=None):
+    """Like `convert', but creates one output per simplification tolerance
+    (levels of detail) while parsing the input only once.
+
+    :param list tolerances: Tolerances for `simplify.simplify'. None stands
+        for the unsimplified skeletons.
+    :param thing_ids: If given, only the things with these IDs are
+        converted (see `load_nml')
+    :returns: The converted documents, in the order of `tolerances'
+    :rtype: list
+    """
+    if input_format is None:
+        input_format = 'catmaid' if output_format == 'nml' else 'nml'
+    things = load_nml(input_string, input_format, is_pyknossos, progress,
+                      thing_ids, transform)
+    return serialize_levels(things, output_format, tolerances, user_id,
+                            timestamp, intern_labels, progress, transform)
+
+
+def serialize_levels(things, output_format, tolerances, user_id=None,
+                     timestamp=None, intern_labels=False, progress=None,
+                     transform=None):
+    """Converts an NML dict (see `load_nml') into one output per
+    simplification tolerance. See `convert_levels'.
+
+    :rtype: list
+    """
+    if output_format == 'nml':
+        return [declxml.serialize_to_string(things_processor,
+                                            simplify(things, tolerance),
+                                            indent=' ')
+                for tolerance in tolerances]
+    if output_format == 'binary':
+        return [binary.dumps(simplify(things, tolerance))
+                for tolerance in tolerances]
+    return [create_catmaid(simplify(things, tolerance), user_id,
+                           timestamp, intern_labels, progress,
+                           transform).to_json()
+            for tolerance in tolerances]
+
+
+def iter_output(nml, output_format, tolerance=None, user_id=None,
+                timestamp=None, intern_labels=False, progress=None,
+                transform=None):
+    """Converts an NML dict (see `load_nml') like `convert_levels' does for
+    a single tolerance, but returns the output piece by piece, so that
+    writing it can start before it is complete.
+
+    :rtype: iterator of str (bytes for 'binary')
+    """
+    nml = simplify(nml, tolerance)
+    if output_format == 'nml':
+        return iter_nml(nml)
+    if output_format == 'binary':
+        return iter([binary.dumps(nml)])
+    return create_catmaid(nml, user_id, timestamp, intern_labels,
+                          progress, transform).iter_json()
+
+
+class ThingsNotFound(ValueError):
+    """Raised when none of the things selected by their IDs exist."""
+
+    def __init__(self, thing_ids):
+        super().__init__('No thing with ID {}'.format(
+            ', '.join(str(thing_id) for thing_id in sorted(thing_ids))))
+        self.thing_ids = thing_ids
+
+
+def load_nml(input_string, input_format, is_pyknossos=False, progress=None,
+             thing_ids=None, transform=None):
+    """Reads NML, CATMAID JSON or a binary skeleton file into an NML dict.
+
+    :param input_string: The whole document, or an iterable of chunks. For
+        binary files, this can also be a `binary.SkeletonStore', from which
+        only the selected things are read, and for NML and CATMAID JSON an
+        `index.IndexedFile', from which only the selected things are parsed.
+    :param str input_format: Either 'nml', 'catmaid' or 'binary'
+    :param thing_ids: If given, only the things with these IDs are kept.
+        Each ID can be the ID of an NML <thing>, or a CATMAID neuron or
+        skeleton ID. Raises `ThingsNotFound' if none of them exist.
+    :param transform.Affine transform: (Only for CATMAID JSON) Transform
+        into NML coordinates, see `prepare_nml'
+    :rtype: dict
+    """
+    if isinstance(input_string, binary.SkeletonStore):
+        nml = input_string.load(thing_ids)
+        if thing_ids is not None and not nml['things']:
+            raise ThingsNotFound(set(thing_ids))
+        return nml
+    if isinstance(input_string, IndexedFile):
+        input_string = input_string.extract(thing_ids)
+    if input_format == 'catmaid':
+        nml = prepare_nml(parse_catmaid_json(input_string, progress), progress,
+                          transform)
+    elif input_format == 'binary':
+        if isinstance(input_string, bytes):
+            input_string = [input_string]
+        nml = binary.loads(binary.read_all(input_string, progress))
+    else:
+        nml = nml2dict(input_string, is_pyknossos, progress)
+    return nml if thing_ids is None else select_things(nml, thing_ids)
+
+
+def select_things(nml, thing_ids):
+    """Returns a copy of an NML dict with only the given things, and the
+    comments and branchpoints of their nodes. See `load_nml'.
+
+    :raises ThingsNotFound: If none of the things exist
+    """
+    thing_ids = set(thing_ids)
+    selected = dict(nml)
+    selected['things'] = [thing for thing in nml['things']
+                          if thing['id'] in thing_ids
+                          or thing.get('neuron_id') in thing_ids
+                          or thing.get('skeleton_id') in thing_ids]
+    if not selected['things']:
+        raise ThingsNotFound(thing_ids)
+    node_ids = {node['id'] for thing in selected['things']
+                for node in thing['nodes']}
+    selected['comments'] = [comment for comment in nml.get('comments') or []
+                            if comment['node'] in node_ids]
+    selected['branchpoints'] = [branchpoint for branchpoint
+                                in nml.get('branchpoints') or []
+                                if branchpoint['id'] in node_ids]
+    return selected
@@ -28,14 +28,23 @@ dictionaries, arrays, and user objects.
 
 Parsing
 ----------
+.. autofunction:: declxml.parse_from_element
 .. autofunction:: declxml.parse_from_file
 .. autofunction:: declxml.parse_from_string
 
 Serialization
 ---------------
 .. autofunction:: declxml.serialize_to_file
+.. autofunction:: declxml.serialize_to_fragment
 .. autofunction:: declxml.serialize_to_string
 
+Backends
+------------
+XML is parsed and serialized with lxml if it is installed, and with the standard library's
+ElementTree and minidom otherwise. Both backends produce the same results.
+
+.. autofunction:: declxml.set_backend
+
 Exceptions
 ------------
 .. autoexception:: declxml.XmlError
@@ -44,10 +53,19 @@ Exceptions
 .. autoexception:: declxml.MissingValue
 """
 from collections import namedtuple
+import io
 import warnings
 import xml.dom.minidom as minidom
 import xml.etree.ElementTree as ET
 
+try:
+    from lxml import etree as lxml_etree
+    # Pretty printing needs lxml 4.5
+    if not hasattr(lxml_etree, 'indent'):  # pragma: no cover
+        lxml_etree = None
+except ImportError:  # pragma: no cover
+    lxml_etree = None
+
 
 class XmlError(Exception):
     """Base error class representing errors processing XML data"""
@@ -65,6 +83,24 @@ class MissingValue(XmlError):
     """Represents errors due to missing required values"""
 
 
+def parse_from_element(processor, element):
+    """
+    Parses an element that has already been parsed into an ElementTree element, e.g. by an
+    incremental parser.
+
+    :param processor: Processor of the element. This does not need to be a root processor.
+    :param element: The ElementTree element to parse.
+
+    :return: Parsed value.
+    """
+    state = _ProcessorState()
+    state.push_location(processor.element_path)
+    parsed_value = processor.parse_at_element(element, state)
+    state.pop_location()
+
+    return parsed_value
+
+
 def parse_from_file(root_processor, xml_file_path):
     """
     Parses the XML file using the processor starting from the root of the document.
@@ -93,7 +129,7 @@ def parse_from_string(root_processor, xml_string):
     if not _is_valid_root_processor(root_processor):
         raise InvalidRootProcessor('Invalid root processor')
 
-    root = ET.fromstring(xml_string)
+    root = backend.fromstring(xml_string)
     _xml_namespace_strip(root)
 
     state = _ProcessorState()
@@ -133,14 +169,163 @@ def serialize_to_string(root_processor, value, indent=None):
 
     state.pop_location()
 
-    serialized_value = ET.tostring(root)
-
-    # Since element tree does not support pretty printing XML, we use minidom to do the pretty
-    # printing
     if indent:
-        serialized_value = minidom.parseString(serialized_value).toprettyxml(indent=indent)
+        return backend.pretty_document(root, indent)
+
+    return backend.tostring(root)
 
-    return serialized_value
+
+def serialize_to_fragment(processor, value, indent, level=1):
+    """
+    Serializes the value to a pretty printed XML fragment, exactly as it would appear at the
+    given nesting level inside a document serialized by :func:`declxml.serialize_to_string` with
+    the same indent. This allows to serialize large documents piece by piece.
+
+    :param processor: Processor of the value. This does not need to be a root processor.
+    :param value: Value to serialize.
+    :param indent: Indentation used for each nesting level.
+    :param level: Nesting level of the fragment. The children of the root element are at level 1.
+
+    :return: The serialized XML fragment, including a trailing newline.
+    """
+    state = _ProcessorState()
+    state.push_location(processor.element_path)
+
+    element = processor.serialize(value, state)
+
+    state.pop_location()
+
+    return backend.pretty_fragment(element, indent, level)
+
+
+def set_backend(name):
+    """
+    Selects the XML library used for parsing and serializing.
+
+    :param name: Either 'lxml' or 'stdlib' (ElementTree and minidom).
+
+    :return: The backend that was selected before.
+    """
+    global backend
+    previous = backend.name
+    if name == 'lxml':
+        if lxml_etree is None:
+            raise ValueError('lxml is not installed')
+        backend = _LxmlBackend()
+    elif name == 'stdlib':
+        backend = _StdlibBackend()
+    else:
+        raise ValueError('Unknown XML backend "{}"'.format(name))
+    return previous
+
+
+class _StdlibBackend(object):
+    """Parses with ElementTree, and pretty prints with minidom, since ElementTree does not
+    support pretty printing XML."""
+
+    name = 'stdlib'
+    ParseError = ET.ParseError
+    Element = ET.Element
+
+    def fromstring(self, xml_string):
+        return ET.fromstring(xml_string)
+
+    def pull_parser(self, events):
+        return ET.XMLPullParser(events=events)
+
+    def error_message(self, error):
+        """Returns the message of a ParseError without the position, which ends it."""
+        return str(error).rsplit(': line ', 1)[0]
+
+    def tostring(self, element):
+        return ET.tostring(element)
+
+    def pretty_document(self, element, indent):
+        return minidom.parseString(self.tostring(element)).toprettyxml(indent=indent)
+
+    def pretty_fragment(self, element, indent, level):
+        writer = io.StringIO()
+        minidom.parseString(self.tostring(element)).documentElement.writexml(
+            writer, indent=indent * level, addindent=indent, newl='\n')
+        return writer.getvalue()
+
+
+class _LxmlBackend(object):
+    """Parses and pretty prints with lxml. The output is the same as that of the standard library
+    backend; where lxml escapes differently (whitespace in attribute values), minidom takes over."""
+
+    name = 'lxml'
+    # Characters that minidom writes as they are, but lxml escapes
+    _ESCAPED = ('&#9;', '&#10;', '&#13;')
+
+    def __init__(self):
+        options = dict(remove_comments=True, remove_pis=True, resolve_entities=False,
+                       no_network=True, huge_tree=True)
+        self.ParseError = lxml_etree.XMLSyntaxError
+        self.Element = lxml_etree.Element
+        self._options = options
+        self._parser = lxml_etree.XMLParser(**options)
+        # ElementTree ignores the declared encoding of str documents, lxml refuses to parse them
+        self._str_parser = lxml_etree.XMLParser(encoding='utf-8', **options)
+
+    def fromstring(self, xml_string):
+        if isinstance(xml_string, str):
+            return lxml_etree.fromstring(xml_string.encode('utf-8'), self._str_parser)
+        return lxml_etree.fromstring(xml_string, self._parser)
+
+    def pull_parser(self, events):
+        return _LxmlPullParser(lxml_etree.XMLPullParser(events=events, **self._options))
+
+    def error_message(self, error):
+        if isinstance(error, ET.ParseError):
+            return _StdlibBackend().error_message(error)
+        # lxml adds the position as ", line 4, column 1"
+        return error.msg.rsplit(', line ', 1)[0]
+
+    def tostring(self, element):
+        # ElementTree writes empty elements as `<a />'
+        return ET.tostring(self._to_stdlib(element))
+
+    def pretty_document(self, element, indent):
+        serialized = self._pretty(element, indent, 0)
+        if serialized is None:
+            return _StdlibBackend().pretty_document(self._to_stdlib(element), indent)
+        return '<?xml version="1.0" ?>\n' + serialized + '\n'
+
+    def pretty_fragment(self, element, indent, level):
+        serialized = self._pretty(element, indent, level)
+        if serialized is None:
+            return _StdlibBackend().pretty_fragment(self._to_stdlib(element), indent, level)
+        return indent * level + serialized + '\n'
+
+    def _pretty(self, element, indent, level):
+        """Pretty prints with lxml, or returns None if the result would differ from minidom's."""
+        serialized = lxml_etree.tostring(element, encoding='unicode')
+        if any(escaped in serialized for escaped in self._ESCAPED):
+            return None
+        lxml_etree.indent(element, space=indent, level=level)
+        return lxml_etree.tostring(element, encoding='unicode')
+
+    def _to_stdlib(self, element):
+        return ET.fromstring(lxml_etree.tostring(element))
+
+
+class _LxmlPullParser(object):
+    """lxml's pull parser, accepting any bytes-like chunks like ElementTree's does."""
+
+    def __init__(self, parser):
+        self._parser = parser
+
+    def feed(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self._parser.feed(data)
+
+    def read_events(self):
+        return self._parser.read_events()
+
+    def close(self):
+        self._parser.close()
 
 
 def array(item_processor, alias=None, nested=None, omit_empty=False):
@@ -712,7 +897,7 @@ def _element_append_path(start_element, element_names):
     """
     end_element = start_element
     for element_name in element_names:
-        new_element = ET.Element(element_name)
+        new_element = backend.Element(element_name)
         end_element.append(new_element)
         end_element = new_element
 
@@ -768,7 +953,7 @@ def _element_path_create_new(element_path):
     """
     element_names = element_path.split('/')
 
-    start_element = ET.Element(element_names[0])
+    start_element = backend.Element(element_names[0])
     end_element = _element_append_path(start_element, element_names[1:])
 
     return (start_element, end_element)
@@ -868,3 +1053,6 @@ def _xml_namespace_strip(root):
             # We should never get here. If there is a namespace, then the namespace should be
             # included in all elements.
             pass
+
+
+backend = _LxmlBackend() if lxml_etree is not None else _StdlibBackend()
@@ -0,0 +1,215 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import hashlib
+import struct
+
+from . import convert
+from .topology import Topology
+
+
+class Skeleton:
+    """A skeleton in a format-independent form, with a Merkle hash over
+    each of its subtrees.
+
+    Positions use the KNOSSOS convention (CATMAID locations + 1), and the
+    comments of a node are all texts attached to it, from node attributes
+    as well as from <comments> or CATMAID labels. The hash of a subtree
+    covers the ID, position and comments of its root and the hashes of the
+    subtrees below it, regardless of the order of nodes and children in
+    the file. The hash of the whole skeleton does not depend on the ID of
+    its <thing>, so renumbered skeletons are still recognised.
+    """
+
+    def __init__(self, thing, comments):
+        """
+        :param dict thing: NML `thing' dict
+        :param dict comments: Sets of comment texts by node ID
+        """
+        self.id = thing['id']
+        self.topology = Topology.from_thing(thing)
+        self.index = {node_id: i for i, node_id in enumerate(self.topology.ids)}
+        self.positions = [(node['x'], node['y'], node['z']) for node in thing['nodes']]
+        self.comments = [frozenset(comments.get(node['id'], ()))
+                         for node in thing['nodes']]
+
+        self.digests, self.digest = tree_digests(self.topology, self.record)
+
+    def record(self, i):
+        """Returns node `i' as bytes, for hashing."""
+        record = struct.pack('<qddd', self.topology.ids[i],
+                             *(float(_) for _ in self.positions[i]))
+        for comment in sorted(self.comments[i]):
+            record += comment.encode() + b'\0'
+        return record
+
+    def parent_id(self, i):
+        parent = self.topology.parents[i]
+        return None if parent < 0 else self.topology.ids[parent]
+
+
+def tree_digests(topology, record):
+    """Computes a Merkle hash over each subtree of a skeleton, and one over
+    the whole skeleton, regardless of the order of nodes and children.
+
+    :type topology: topology.Topology
+    :param record: Function returning node `i' as bytes
+    :returns: The hash of the subtree below each node, and the hash of the
+        skeleton
+    :rtype: tuple
+    """
+    digests = [None] * len(topology)
+    for i in reversed(topology.order):
+        digest = hashlib.sha256(record(i))
+        for child in sorted(digests[c] for c in topology.children_of(i)):
+            digest.update(child)
+        digests[i] = digest.digest()
+
+    digest = hashlib.sha256()
+    for root in sorted(digests[r] for r in topology.roots):
+        digest.update(root)
+    return digests, digest.digest()
+
+
+def node_comments(nml):
+    """Collects the comments of each node of an NML dict, from node
+    attributes as well as from <comments>.
+
+    :returns: Sets of comment texts by node ID
+    :rtype: dict
+    """
+    comments = {}
+    for thing in nml['things']:
+        for node in thing['nodes']:
+            if node.get('comment'):
+                comments.setdefault(node['id'], set()).add(node['comment'])
+    for comment in nml.get('comments') or []:
+        comments.setdefault(comment['node'], set()).add(comment['content'])
+    return comments
+
+
+def load(chunks, input_format, is_pyknossos=False):
+    """Reads all skeletons of an NML, CATMAID JSON or binary document.
+
+    :param chunks: Chunks of the document (e.g. from `fileio.open_source')
+    :param str input_format: 'nml', 'catmaid' or 'binary'
+    :rtype: list of Skeleton
+    """
+    nml = convert.load_nml(chunks, input_format, is_pyknossos)
+    comments = node_comments(nml)
+    return [Skeleton(thing, comments) for thing in nml['things']]
+
+
+def diff(skeletons_a, skeletons_b):
+    """Compares two lists of skeletons.
+
+    Skeletons with identical hashes are paired up first. The remaining
+    skeletons are paired by <thing> ID, and then by shared node IDs; only
+    for those pairs are the nodes compared, skipping every subtree whose
+    hash is the same on both sides.
+
+    :returns: Generator of (skeleton ID in a or None, skeleton ID in b or
+        None, message) tuples, one per difference
+    """
+    unmatched_b = {}
+    for skeleton in skeletons_b:
+        unmatched_b.setdefault(skeleton.digest, []).append(skeleton)
+    unmatched_a = []
+    for skeleton in skeletons_a:
+        same = unmatched_b.get(skeleton.digest)
+        if same:
+            same.pop(0)
+        else:
+            unmatched_a.append(skeleton)
+    remaining_b = [skeleton for same in unmatched_b.values() for skeleton in same]
+
+    pairs = []
+    by_id = {skeleton.id: skeleton for skeleton in remaining_b}
+    rest = []
+    for a in unmatched_a:
+        b = by_id.pop(a.id, None)
+        if b is None:
+            rest.append(a)
+        else:
+            pairs.append((a, b))
+    by_node = {}
+    for b in by_id.values():
+        for node_id in b.topology.ids:
+            by_node.setdefault(node_id, b)
+    only_a = []
+    for a in rest:
+        b = next((by_node[node_id] for node_id in a.topology.ids
+                  if node_id in by_node and by_node[node_id].id in by_id), None)
+        if b is None:
+            only_a.append(a)
+        else:
+            del by_id[b.id]
+            pairs.append((a, b))
+
+    for a, b in pairs:
+        for message in diff_nodes(a, b):
+            yield a.id, b.id, message
+    for a in only_a:
+        yield a.id, None, 'only in first input ({} nodes)'.format(len(a.topology))
+    for b in by_id.values():
+        yield None, b.id, 'only in second input ({} nodes)'.format(len(b.topology))
+
+
+def diff_nodes(a, b):
+    """Compares the nodes of two skeletons, descending only into subtrees
+    whose hashes differ.
+
+    :type a: Skeleton
+    :type b: Skeleton
+    :returns: Generator of messages
+    """
+    for first, second, side in ((a, b, 'first'), (b, a, 'second')):
+        stack = list(first.topology.roots)
+        while stack:
+            i = stack.pop()
+            node_id = first.topology.ids[i]
+            j = second.index.get(node_id)
+            if j is not None and first.digests[i] == second.digests[j]:
+                # The subtree is unchanged, but may have been moved as a whole
+                if first is a and a.parent_id(i) != b.parent_id(j):
+                    yield 'node {}: parent changed from {} to {}'.format(
+                        node_id, a.parent_id(i), b.parent_id(j))
+                continue
+            stack.extend(first.topology.children_of(i))
+            if j is None:
+                yield 'node {}: only in {} input'.format(node_id, side)
+            elif first is a:
+                # Compare nodes present on both sides only once
+                for message in _compare_node(a, i, b, j):
+                    yield 'node {}: {}'.format(node_id, message)
+
+
+def _compare_node(a, i, b, j):
+    if a.positions[i] != b.positions[j]:
+        yield 'moved from {} to {}'.format(a.positions[i], b.positions[j])
+    if a.parent_id(i) != b.parent_id(j):
+        yield 'parent changed from {} to {}'.format(a.parent_id(i), b.parent_id(j))
+    if a.comments[i] != b.comments[j]:
+        yield 'comments changed from {} to {}'.format(sorted(a.comments[i]),
+                                                      sorted(b.comments[j]))
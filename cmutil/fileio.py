@@ -0,0 +1,204 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import contextlib
+import gzip
+import hashlib
+import io
+import itertools
+import mmap
+import os
+import stat
+import sys
+import tempfile
+
+from . import binary
+
+# How much of an input to hand to a parser at once
+CHUNK_SIZE = 1024 * 1024
+
+# mkstemp() creates files that only the owner can read. Output files should
+# get the same permissions as if they had been created with open().
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def write_atomic(path, data):
+    """Writes `data' to `path' so that readers either see the old file or
+    the complete new one, never a partially written file. The data is
+    written to a temporary file next to `path' first, which is then renamed.
+
+    :param str path: Output file
+    :type data: str or bytes
+    """
+    f, tmp_path = open_temporary(path, 'wb' if isinstance(data, bytes) else 'w')
+    try:
+        with f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def open_temporary(path, mode='wb'):
+    """Creates a hidden temporary file next to `path', which is to be
+    renamed to `path' once it is complete (see `write_atomic').
+
+    :returns: The opened file, and its path
+    :rtype: tuple
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp',
+                                    dir=directory)
+    os.chmod(tmp_path, 0o666 & ~_umask)
+    return os.fdopen(fd, mode), tmp_path
+
+
+def gzip_compress(data):
+    """Compresses `data' (str is encoded as UTF-8). The gzip header gets no
+    timestamp, so the result only depends on `data'.
+
+    :rtype: bytes
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def content_hash(data):
+    """Returns the SHA-256 hex digest of `data' (str is hashed as UTF-8)."""
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of a file's content, or None if the
+    file doesn't exist."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in _read_chunks(f, CHUNK_SIZE):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def write_if_changed(path, data):
+    """Atomically writes `data' to `path', unless the file already has
+    exactly that content.
+
+    :type data: str or bytes
+    :returns: The content hash of `data', and whether the file was written
+    :rtype: tuple
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    digest = content_hash(data)
+    if file_hash(path) == digest:
+        return digest, False
+    write_atomic(path, data)
+    return digest, True
+
+
+@contextlib.contextmanager
+def open_source(path, chunk_size=CHUNK_SIZE):
+    """Opens an input file and yields an iterator over its contents, as
+    bytes-like chunks which can be fed to the parsers in `stream'.
+
+    Regular files are memory-mapped, and the chunks are views into the
+    mapping, so the contents are never copied into process memory as a
+    whole. Pipes and stdin are read chunk by chunk instead.
+
+    :param str path: Input file, or '' or None for stdin. Files ending in
+        .gz are decompressed while they are read.
+    """
+    if not path:
+        yield _read_chunks(sys.stdin.buffer, chunk_size)
+        return
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            yield _read_chunks(f, chunk_size)
+        return
+
+    with open(path, 'rb') as f:
+        info = os.fstat(f.fileno())
+        # Empty files can't be mapped
+        if not stat.S_ISREG(info.st_mode) or info.st_size == 0:
+            yield _read_chunks(f, chunk_size)
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            chunks = _view_chunks(view, chunk_size)
+            try:
+                yield chunks
+            finally:
+                # The mapping can only be closed once no views are left
+                chunks.close()
+                view.release()
+
+
+def sniff_format(chunks):
+    """Guesses whether an input is NML, CATMAID JSON or a binary skeleton
+    file from its first characters.
+
+    :param chunks: Iterable of chunks, e.g. from `open_source'
+    :returns: 'nml', 'catmaid' or 'binary', and an iterator that still
+        yields all chunks
+    :rtype: tuple
+    """
+    chunks = iter(chunks)
+    consumed = []
+    start = b''
+    for chunk in chunks:
+        consumed.append(chunk)
+        if not start and bytes(chunk[:len(binary.MAGIC)]) == binary.MAGIC:
+            return 'binary', itertools.chain(consumed, chunks)
+        start = bytes(chunk).lstrip(b'\xef\xbb\xbf \t\r\n')
+        if start:
+            break
+    input_format = 'catmaid' if start[:1] == b'[' else 'nml'
+    return input_format, itertools.chain(consumed, chunks)
+
+
+def _read_chunks(f, chunk_size):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _view_chunks(view, chunk_size):
+    for offset in range(0, len(view), chunk_size):
+        with view[offset:offset + chunk_size] as chunk:
+            yield chunk
@@ -0,0 +1,183 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import operator
+
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+_MASK = CHUNK_SIZE - 1
+# A chunk is a set of its IDs until it holds more IDs than this, and a
+# bitmap of CHUNK_SIZE bits (8 KiB) from then on. Beyond this many IDs,
+# the set would take more memory than the bitmap.
+DENSE = 128
+
+
+class IdSet:
+    """A set of integer IDs, stored in chunks of 65536 consecutive IDs.
+    Sparse chunks are small sets, and dense chunks are bitmaps.
+
+    KNOSSOS and CATMAID mostly number things consecutively, so a dense
+    range of IDs costs one bit per ID instead of a Python int and a hash
+    table slot each, while IDs that are spread widely cost no more than in
+    a set. Membership tests and adding an ID take constant time, and the
+    largest ID is kept track of. IDs can't be removed.
+
+    Floats with an integral value (PyKNOSSOS writes thing IDs as floats)
+    count as the equal int, like in a set. Other IDs are kept in a set of
+    their own.
+    """
+
+    def __init__(self, ids=()):
+        self._chunks = {}
+        self._other = set()
+        self._len = 0
+        self._max = None
+        for id_ in ids:
+            self.add(id_)
+
+    def add(self, id_):
+        value = id_
+        if type(id_) is not int:
+            id_ = _integer(id_)
+            if id_ is None:
+                if value not in self._other:
+                    self._other.add(value)
+                    self._added(value)
+                return
+        key = id_ >> CHUNK_BITS
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            chunk = self._chunks[key] = set()
+        if type(chunk) is set:
+            if id_ in chunk:
+                return
+            chunk.add(id_)
+            if len(chunk) > DENSE:
+                self._chunks[key] = _bitmap(chunk)
+        else:
+            offset = id_ & _MASK
+            bit = 1 << (offset & 7)
+            if chunk[offset >> 3] & bit:
+                return
+            chunk[offset >> 3] |= bit
+        self._added(value)
+
+    def _added(self, value):
+        self._len += 1
+        # The value as it was added, like max() over a set would return it
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def __contains__(self, id_):
+        if type(id_) is not int:
+            value = id_
+            id_ = _integer(id_)
+            if id_ is None:
+                return value in self._other
+        chunk = self._chunks.get(id_ >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        if type(chunk) is set:
+            return id_ in chunk
+        offset = id_ & _MASK
+        return bool(chunk[offset >> 3] & (1 << (offset & 7)))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        """Iterates over the IDs in ascending order."""
+        if self._other:
+            yield from sorted(list(self._iter_chunks()) + list(self._other))
+        else:
+            yield from self._iter_chunks()
+
+    def _iter_chunks(self):
+        for key in sorted(self._chunks):
+            chunk = self._chunks[key]
+            if type(chunk) is set:
+                yield from sorted(chunk)
+                continue
+            base = key << CHUNK_BITS
+            for i, byte in enumerate(chunk):
+                if byte:
+                    for bit in range(8):
+                        if byte & (1 << bit):
+                            yield base + (i << 3) + bit
+
+    def max(self):
+        """Returns the largest ID, or None if the set is empty."""
+        return self._max
+
+    def next_free(self, start=1):
+        """Returns the smallest integer ID that is not in the set and not
+        smaller than `start'."""
+        id_ = start
+        while True:
+            key = id_ >> CHUNK_BITS
+            chunk = self._chunks.get(key)
+            if chunk is None:
+                return id_
+            if type(chunk) is set:
+                while id_ in chunk:
+                    id_ += 1
+                if id_ >> CHUNK_BITS == key:
+                    return id_
+                # The whole rest of the chunk is taken
+                continue
+            offset = id_ & _MASK
+            byte = chunk[offset >> 3] >> (offset & 7)
+            if byte != 0xff >> (offset & 7):
+                # There is a free ID in the rest of the current byte
+                while byte & 1:
+                    byte >>= 1
+                    id_ += 1
+                return id_
+            # Skip the rest of the current byte, then all full bytes at once
+            id_ = (id_ | 7) + 1
+            offset = (id_ & _MASK) >> 3
+            if offset > 0:
+                rest = chunk[offset:]
+                id_ += (len(rest) - len(rest.lstrip(b'\xff'))) << 3
+
+
+def _integer(id_):
+    """Returns an ID as an int if it has an integral value, or None."""
+    try:
+        return operator.index(id_)
+    except TypeError:
+        pass
+    if isinstance(id_, float) and id_.is_integer():
+        return int(id_)
+    return None
+
+
+def _bitmap(ids):
+    """Turns the IDs of a sparse chunk into a bitmap."""
+    chunk = bytearray(CHUNK_SIZE >> 3)
+    for id_ in ids:
+        offset = id_ & _MASK
+        chunk[offset >> 3] |= 1 << (offset & 7)
+    return chunk
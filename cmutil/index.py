@@ -0,0 +1,464 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import codecs
+import json
+import mmap
+import os
+import re
+import sys
+
+from .fileio import write_atomic
+from .stream import is_truncated
+
+# Sidecar indexes, which make it possible to read single things out of
+# large NML and CATMAID JSON files without parsing the whole file.
+#
+# `build' scans a file once and writes FILE.cmidx next to it, a JSON file
+# with the byte ranges of each <thing> (NML) or of the objects of each
+# skeleton (CATMAID JSON), and of the parts that every thing needs: the
+# parameters, comments and branchpoints of an NML file, and the classes
+# and relations of a CATMAID export. `open_index' returns an `IndexedFile'
+# for an input file if its index is up to date, i.e. if the size and
+# modification time of the file are still the ones recorded in the index.
+# `IndexedFile.extract' then cuts a much smaller document out of the file,
+# with only the selected things, which the usual parsers read.
+
+SUFFIX = '.cmidx'
+VERSION = 1
+
+# Comments, CDATA sections, processing instructions, end tags and the
+# start of start tags
+_MARKUP = re.compile(
+    rb'<(?:(!--)|(!\[CDATA\[)|(\?)|(/?)([A-Za-z_:][^\s/>]*))')
+_SKIP = {1: b'-->', 2: b']]>', 3: b'?>'}
+# The rest of a start tag; attribute values may contain '>'
+_START_TAG_END = re.compile(
+    rb'(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+_ATTRIBUTE = re.compile(rb'([^\s=/>]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_SECTIONS = ('parameters', 'comments', 'branchpoints')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# How much of a CATMAID JSON file `_scan_catmaid' decodes at once
+SCAN_CHUNK_SIZE = 1 << 20
+# The fields that `_scan_catmaid' keeps of each model, to group the objects
+# by skeleton. Objects of other models are needed by every skeleton.
+_REFERENCES = {
+    'catmaid.relation': ('relation_name',),
+    'catmaid.class': ('class_name',),
+    'catmaid.classinstance': ('class_column',),
+    'catmaid.classinstanceclassinstance': ('relation', 'class_instance_a',
+                                           'class_instance_b'),
+    'catmaid.treenode': ('skeleton',),
+    'catmaid.treenodeclassinstance': ('treenode', 'class_instance'),
+}
+
+
+def sidecar_path(path):
+    """Names the index file of `path'."""
+    return path + SUFFIX
+
+
+def build(path):
+    """Scans an NML or CATMAID JSON file, and writes its index next to it.
+
+    :param str path: Input file; compressed files can't be indexed
+    :returns: The number of things in the index
+    :rtype: int
+    """
+    if path.endswith('.gz'):
+        raise ValueError('compressed files cannot be indexed')
+    with open(path, 'rb') as f:
+        info = os.fstat(f.fileno())
+        if info.st_size == 0:
+            raise ValueError('empty file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = data[:64].lstrip(b'\xef\xbb\xbf \t\r\n')
+            if start[:1] == b'[':
+                index = _scan_catmaid(data)
+                count = len(index['skeletons'])
+            else:
+                index = _scan_nml(data)
+                count = len(index['things'])
+    index.update(version=VERSION, size=info.st_size, mtime_ns=info.st_mtime_ns)
+    write_atomic(sidecar_path(path), json.dumps(index, separators=(',', ':')))
+    return count
+
+
+def open_index(path):
+    """Opens a file for reading single things, if it has an up-to-date index.
+
+    :returns: None if there is no index, or if the file has changed since
+        the index was built
+    :rtype: IndexedFile
+    """
+    try:
+        with open(sidecar_path(path)) as f:
+            index = json.load(f)
+        info = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if (index.get('version') != VERSION or index.get('size') != info.st_size
+            or index.get('mtime_ns') != info.st_mtime_ns):
+        return None
+    return IndexedFile(path, index)
+
+
+class IndexedFile:
+    """An NML or CATMAID JSON file with an index, see `open_index'.
+
+    The file is memory-mapped, so only the parts that `extract' copies are
+    read. Use it as a context manager, or call `close'.
+    """
+
+    def __init__(self, path, index):
+        self.format = index['format']
+        self._index = index
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        key = 'things' if self.format == 'nml' else 'skeletons'
+        return len(self._index[key])
+
+    def extract(self, thing_ids):
+        """Cuts a document with only the given things out of the file.
+
+        For NML, the document keeps the parameters, and all comments and
+        branchpoints; for CATMAID JSON, the classes, relations and other
+        shared objects, and the labels of the selected skeletons. If no
+        thing of an NML file matches, the first one is kept, as NML needs
+        at least one. Use `convert.select_things' to drop other things and
+        their comments.
+
+        :param thing_ids: NML thing IDs, or CATMAID neuron or skeleton IDs
+        :returns: An NML or CATMAID JSON document in the format of the file
+        :rtype: bytes
+        """
+        thing_ids = set(thing_ids)
+        data = self._mmap
+        if self.format == 'nml':
+            sections = self._index['sections']
+            parts = [data[:self._index['header']]]
+            parts += [data[offset:offset + length]
+                      for name, offset, length in sections
+                      if name == 'parameters']
+            things = [(offset, length)
+                      for thing_id, neuron_id, skeleton_id, offset, length
+                      in self._index['things']
+                      if thing_id in thing_ids or neuron_id in thing_ids
+                      or skeleton_id in thing_ids]
+            # NML files need at least one <thing>
+            if not things and self._index['things']:
+                things = [self._index['things'][0][3:]]
+            parts += [data[offset:offset + length] for offset, length in things]
+            parts += [data[offset:offset + length]
+                      for name, offset, length in sections
+                      if name != 'parameters']
+            parts.append(self._index['footer'].encode())
+            return b'\n'.join(parts)
+
+        ranges = list(self._index['shared'])
+        for neuron_id, skeleton_id, skeleton_ranges in self._index['skeletons']:
+            if neuron_id in thing_ids or skeleton_id in thing_ids:
+                ranges += skeleton_ranges
+        return b'[' + b','.join(data[start:end]
+                                for start, end in _coalesce(ranges)) + b']'
+
+
+def _coalesce(ranges):
+    """Sorts byte ranges given as (offset, length), and merges overlapping
+    ones (labels can be shared by several skeletons). Yields (start, end)."""
+    current = None
+    for offset, length in sorted(ranges):
+        if current is not None and offset < current[1]:
+            current[1] = max(current[1], offset + length)
+            continue
+        if current is not None:
+            yield current
+        current = [offset, offset + length]
+    if current is not None:
+        yield current
+
+
+def _number(value):
+    """Parses an ID attribute, which PyKNOSSOS writes as a float."""
+    if value is None:
+        return None
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _scan_nml(data):
+    """Finds the byte ranges of the <thing>s and other sections of an NML
+    file. Only the structure is checked, not whether it is valid NML."""
+    things = []
+    sections = []
+    root = header = None
+    depth = 0
+    start = element = attributes_end = None
+    end_tags = {}
+    pos = 0
+
+    def add(end):
+        name = element.group(5).rpartition(b':')[2].decode()
+        if name == 'thing':
+            attributes = {}
+            for match in _ATTRIBUTE.finditer(data, element.end(),
+                                             attributes_end):
+                value = match.group(2)
+                attributes[match.group(1)] = (match.group(3) if value is None
+                                              else value)
+            # Like `nml.thing_processor', which fills in missing neuron
+            # and skeleton IDs. Extra matches are dropped after parsing.
+            things.append([_number(attributes.get(b'id')),
+                           _number(attributes.get(b'neuron_id', b'100')),
+                           _number(attributes.get(b'skeleton_id', b'99')),
+                           start, end - start])
+        elif name in _SECTIONS:
+            sections.append([name, start, end - start])
+
+    while True:
+        match = _MARKUP.search(data, pos)
+        if match is None:
+            break
+        if match.lastindex in _SKIP:
+            end = data.find(_SKIP[match.lastindex], match.end())
+            if end < 0:
+                raise ValueError('Unterminated markup at byte {}'.format(
+                    match.start()))
+            pos = end + len(_SKIP[match.lastindex])
+            continue
+
+        if match.group(4):
+            end = data.find(b'>', match.end()) + 1
+            if end == 0 or depth == 0:
+                raise ValueError('Unexpected end tag at byte {}'.format(
+                    match.start()))
+            depth -= 1
+            if depth == 1:
+                add(end)
+            pos = end
+            continue
+
+        tag = _START_TAG_END.match(data, match.end())
+        if tag is None:
+            raise ValueError('Malformed tag at byte {}'.format(match.start()))
+        empty = tag.group(1) == b'/'
+        name = match.group(5)
+        pos = tag.end()
+        if depth == 0:
+            if root is not None:
+                raise ValueError('Several root elements')
+            root, header = name, tag.end()
+            if empty:
+                break
+        elif depth == 1:
+            start, element, attributes_end = match.start(), match, tag.end()
+            if empty:
+                add(tag.end())
+                continue
+            # Skip the contents of the element, unless it contains markup
+            # that could hide the end tag
+            if name not in end_tags:
+                end_tags[name] = re.compile(rb'</' + re.escape(name) + rb'\s*>')
+            end = end_tags[name].search(data, pos)
+            if (end is not None and data.find(b'<!--', pos, end.start()) < 0
+                    and data.find(b'<![CDATA[', pos, end.start()) < 0):
+                add(end.end())
+                pos = end.end()
+                continue
+        if not empty:
+            depth += 1
+
+    if root is None or depth > 0:
+        raise ValueError('Incomplete XML document')
+    return {'format': 'nml', 'header': header,
+            'footer': '</{}>'.format(root.decode()),
+            'things': things, 'sections': sections}
+
+
+def _scan_catmaid(data, chunk_size=SCAN_CHUNK_SIZE):
+    """Finds the byte ranges of the objects of a CATMAID JSON export, and
+    groups them by skeleton. Only the fields needed for grouping are kept
+    (see `_REFERENCES')."""
+    offsets = []
+    objects = []
+    for obj, start, end in _iter_objects(data, chunk_size):
+        offsets.append((start, end))
+        model = obj['model']
+        names = _REFERENCES.get(model)
+        if names is None:
+            objects.append((None, None, ()))
+        else:
+            fields = obj['fields']
+            objects.append((sys.intern(model), obj.get('pk'),
+                            tuple(fields.get(name) for name in names)))
+
+    relations = {values[0]: pk for model, pk, values in objects
+                 if model == 'catmaid.relation'}
+    classes = {values[0]: pk for model, pk, values in objects
+               if model == 'catmaid.class'}
+    neurons = {}
+    for model, pk, values in objects:
+        if (model == 'catmaid.classinstanceclassinstance'
+                and values[0] == relations.get('model_of')):
+            neurons[values[1]] = values[2]
+    skeleton_of = {neuron: skeleton for skeleton, neuron in neurons.items()}
+    node_skeletons = {pk: values[0] for model, pk, values in objects
+                      if model == 'catmaid.treenode'}
+    label_skeletons = {}
+    for model, pk, values in objects:
+        if (model == 'catmaid.treenodeclassinstance'
+                and values[0] in node_skeletons):
+            label_skeletons.setdefault(values[1], set()).add(
+                node_skeletons[values[0]])
+
+    # The objects of each skeleton, and those that every skeleton needs
+    members = {skeleton: [] for skeleton in neurons}
+    shared = []
+    for i, (model, pk, values) in enumerate(objects):
+        if model == 'catmaid.treenode':
+            owners = [values[0]]
+        elif model == 'catmaid.treenodeclassinstance':
+            owners = [node_skeletons.get(values[0])]
+        elif model == 'catmaid.classinstanceclassinstance':
+            owners = [values[1]]
+        elif model == 'catmaid.classinstance':
+            if values[0] == classes.get('label'):
+                owners = label_skeletons.get(pk, [])
+            else:
+                owners = [skeleton_of.get(pk, pk)]
+        else:
+            # Including relations and classes
+            shared.append(i)
+            continue
+        for owner in owners:
+            if owner in members:
+                members[owner].append(i)
+
+    return {'format': 'catmaid',
+            'shared': _runs(shared, offsets),
+            'skeletons': [[neuron, skeleton, _runs(members[skeleton], offsets)]
+                          for skeleton, neuron in neurons.items()]}
+
+
+def _iter_objects(data, chunk_size):
+    """Decodes the objects of a CATMAID JSON array one chunk of `data' at
+    a time, like `stream.CatmaidParser', and yields each object with the
+    byte offsets of its start and end."""
+    def error(message, index):
+        return ValueError('{} at byte {}'.format(
+            message, byte_position + _byte_length(buffer, position, index)))
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    expect = '['
+    buffer = ''
+    # Byte offset of the start of `buffer'
+    consumed = len(codecs.BOM_UTF8) if data[:3] == codecs.BOM_UTF8 else 0
+    read = consumed
+    final = False
+    while not final:
+        chunk = data[read:read + chunk_size]
+        read += len(chunk)
+        final = read >= len(data)
+        buffer += text_decoder.decode(chunk, final)
+        position = 0
+        # Byte offset of buffer[position]
+        byte_position = consumed
+        while True:
+            start = _WHITESPACE.match(buffer, position).end()
+            if start == len(buffer):
+                break
+            char = buffer[start]
+            if expect == '[':
+                if char != '[':
+                    raise error('Expecting "["', start)
+                expect = 'first'
+                end = start + 1
+            elif expect == ',' or (expect == 'first' and char == ']'):
+                if char == ']':
+                    expect = 'end'
+                elif char == ',':
+                    expect = 'value'
+                else:
+                    raise error('Expecting "," or "]"', start)
+                end = start + 1
+            elif expect in ('first', 'value'):
+                try:
+                    obj, end = decoder.raw_decode(buffer, start)
+                except json.JSONDecodeError as decode_error:
+                    # Wait for more text only if the object is cut off at
+                    # the end of the buffer; anything else stays an error
+                    if final or not is_truncated(buffer, decode_error.pos):
+                        raise error(decode_error.msg,
+                                    decode_error.pos) from None
+                    break
+                if not isinstance(obj, dict):
+                    raise error('Not a CATMAID object', start)
+                object_start = byte_position + _byte_length(
+                    buffer, position, start)
+                byte_position = object_start + _byte_length(buffer, start, end)
+                position = end
+                expect = ','
+                yield obj, object_start, byte_position
+                continue
+            else:
+                raise error('Extra data', start)
+            byte_position += _byte_length(buffer, position, end)
+            position = end
+        byte_position += _byte_length(buffer, position, start)
+        buffer = buffer[start:]
+        consumed = byte_position
+    if expect != 'end':
+        raise ValueError('Unexpected end of JSON array at byte {}'.format(
+            len(data)))
+
+
+def _byte_length(text, start, end):
+    """Returns the UTF-8 length of text[start:end]."""
+    return len(text[start:end].encode('utf-8'))
+
+
+def _runs(indices, offsets):
+    """Turns the indices of objects into byte ranges [offset, length],
+    with one range for each run of consecutive objects."""
+    runs = []
+    for i in sorted(indices):
+        start, end = offsets[i]
+        if runs and runs[-1][2] == i - 1:
+            runs[-1][1] = end - runs[-1][0]
+            runs[-1][2] = i
+        else:
+            runs.append([start, end - start, i])
+    return [run[:2] for run in runs]
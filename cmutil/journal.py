@@ -0,0 +1,142 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import json
+import os
+
+from .fileio import write_atomic
+
+# Journals of long runs (-shards, -watch), so that a run that was killed
+# half-way can be resumed with -resume instead of starting over.
+
+# A journal with a key is compacted once it has this many lines per key,
+# but not before it has COMPACT_MINIMUM lines
+COMPACT_RATIO = 2
+COMPACT_MINIMUM = 100
+
+
+class Journal:
+    """A log of the work that a run has completed.
+
+    Each entry is a line of JSON, which is appended and synced to disk as
+    soon as a piece of work is done, so that after a crash the journal
+    lists exactly the work that was finished. The first line describes the
+    run itself, so that a journal isn't resumed with other input or options.
+
+    :param str path: Journal file
+    :param dict run: Anything that identifies the run, as JSON
+    :param bool resume: If true, the entries of an existing journal of the
+        same run are kept, and are available as `entries'. Otherwise, the
+        journal starts out empty.
+    :param str key: If given, only the last entry with each value of this
+        key is kept. The journal is then rewritten with only those entries
+        whenever it grows to more than COMPACT_RATIO lines per key, so that
+        long runs (e.g. -watch) don't grow it without limit.
+    """
+
+    def __init__(self, path, run, resume=False, key=None):
+        self.path = path
+        self._run = json.loads(json.dumps(run))
+        self._key = key
+        entries = []
+        if resume:
+            entries = _read(path)
+            if entries and entries[0].get('run') != self._run:
+                raise ValueError('{} belongs to a different run; start over '
+                                 'without -resume'.format(path))
+            entries = entries[1:]
+        self._entries = entries
+        self._latest = None
+        if key is not None:
+            self._latest = {}
+            for entry in entries:
+                self._latest[entry.get(key)] = entry
+        # Rewriting the journal also drops a last line that a crash cut off
+        self._file = None
+        self._rewrite()
+
+    @property
+    def entries(self):
+        """The entries recorded so far (only the last one per key)."""
+        if self._latest is not None:
+            return list(self._latest.values())
+        return self._entries
+
+    def record(self, **entry):
+        """Adds an entry, and makes sure it is on disk before returning."""
+        if self._latest is None:
+            self._entries.append(entry)
+        else:
+            self._latest[entry.get(self._key)] = entry
+            if self._lines >= max(COMPACT_MINIMUM,
+                                  COMPACT_RATIO * len(self._latest)):
+                self._rewrite()
+                return
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._lines += 1
+
+    def _rewrite(self):
+        """Atomically replaces the journal with the run and the current
+        entries, and reopens it for appending."""
+        if self._file is not None:
+            self._file.close()
+        entries = [{'run': self._run}] + self.entries
+        write_atomic(self.path, ''.join(json.dumps(entry, sort_keys=True)
+                                        + '\n' for entry in entries))
+        self._file = open(self.path, 'a')
+        self._lines = len(entries)
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        """Closes and deletes the journal, once the run is complete."""
+        self.close()
+        os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _read(path):
+    """Reads the entries of a journal, up to the first incomplete line."""
+    entries = []
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return entries
+    with f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+    return entries
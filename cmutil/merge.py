@@ -0,0 +1,145 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import csv
+import io
+import struct
+
+from .diff import node_comments, tree_digests
+from .idset import IdSet
+from .topology import Topology
+
+
+def skeleton_digest(thing, comments):
+    """Hashes the shape of a skeleton: the positions and comments of its
+    nodes, and how they are connected. Unlike `diff.Skeleton.digest', the
+    hash doesn't depend on node IDs, so copies of a skeleton that were
+    renumbered (e.g. when loading it into a new tracing) are recognised.
+
+    :param dict thing: NML `thing' dict
+    :param dict comments: Sets of comment texts by node ID (see
+        `diff.node_comments')
+    :rtype: bytes
+    """
+    nodes = thing['nodes']
+
+    def record(i):
+        node = nodes[i]
+        record = struct.pack('<ddd', float(node['x']), float(node['y']),
+                             float(node['z']))
+        for comment in sorted(comments.get(node['id'], ())):
+            record += comment.encode() + b'\0'
+        return record
+
+    return tree_digests(Topology.from_thing(thing), record)[1]
+
+
+class Merger:
+    """Merges NML dicts (see `convert.load_nml') into one, keeping only one
+    copy of identical skeletons (see `skeleton_digest').
+
+    Node and thing IDs that are already taken by an earlier skeleton are
+    renumbered. The comments and branchpoints of dropped copies are dropped
+    with them.
+    """
+
+    def __init__(self):
+        self.nml = {'things': [], 'comments': [], 'branchpoints': []}
+        # The kept copy of each distinct skeleton, as (file name, thing ID)
+        self.index = {}
+        # (file name, thing ID, kept file name, kept thing ID) of every
+        # dropped copy
+        self.duplicates = []
+        self._node_ids = IdSet()
+        self._thing_ids = set()
+
+    def add(self, nml, name):
+        """Merges the skeletons of another file.
+
+        :param dict nml: NML dict
+        :param str name: File name, for `index' and `duplicates'
+        """
+        if 'parameters' not in self.nml and nml.get('parameters'):
+            self.nml['parameters'] = nml['parameters']
+        comments = node_comments(nml)
+        # New ID of every node of a kept skeleton
+        kept = {}
+        for thing in nml['things']:
+            digest = skeleton_digest(thing, comments) if thing['nodes'] else None
+            original = self.index.get(digest)
+            if original is not None:
+                self.duplicates.append((name, thing['id']) + original)
+                continue
+            thing = self._renumber(thing, kept)
+            if digest is not None:
+                self.index[digest] = (name, thing['id'])
+            self.nml['things'].append(thing)
+
+        self.nml['comments'].extend(
+            dict(comment, node=kept[comment['node']])
+            for comment in nml.get('comments') or [] if comment['node'] in kept)
+        self.nml['branchpoints'].extend(
+            dict(branchpoint, id=kept[branchpoint['id']])
+            for branchpoint in nml.get('branchpoints') or []
+            if branchpoint['id'] in kept)
+
+    def _renumber(self, thing, kept):
+        """Returns `thing', or a renumbered copy if any of its IDs are taken,
+        and records the new ID of each node in `kept'."""
+        node_ids = [node['id'] for node in thing['nodes']]
+        if any(node_id in self._node_ids for node_id in node_ids):
+            new_ids = {}
+            free = 0
+            for node_id in node_ids:
+                free = self._node_ids.next_free(free + 1)
+                self._node_ids.add(free)
+                new_ids[node_id] = free
+            thing = dict(thing)
+            thing['nodes'] = [dict(node, id=new_ids[node['id']])
+                              for node in thing['nodes']]
+            thing['edges'] = [dict(edge, source=new_ids.get(edge['source'], edge['source']),
+                                   target=new_ids.get(edge['target'], edge['target']))
+                              for edge in thing['edges']]
+            kept.update(new_ids)
+        else:
+            for node_id in node_ids:
+                self._node_ids.add(node_id)
+                kept[node_id] = node_id
+
+        if thing['id'] in self._thing_ids:
+            thing = dict(thing, id=max(self._thing_ids) + 1)
+        self._thing_ids.add(thing['id'])
+        return thing
+
+
+def duplicates_csv(duplicates):
+    """Formats `Merger.duplicates' as CSV.
+
+    :rtype: str
+    """
+    f = io.StringIO()
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(('file', 'thing_id', 'kept_file', 'kept_thing_id'))
+    writer.writerows(duplicates)
+    return f.getvalue()
@@ -22,7 +22,7 @@
 # Sebastian Spaar sebastian.spaar@ariadne.ai
 
 
-import declxml
+from . import declxml
 
 parameters = declxml.dictionary('parameters', [
     declxml.dictionary('experiment', [
@@ -41,6 +41,16 @@ parameters = declxml.dictionary('parameters', [
         declxml.string('.', attribute='path'),
         declxml.integer('.', attribute='overlay')
     ], required=False),
+    declxml.dictionary('scale', [
+        declxml.floating_point('.', attribute='x'),
+        declxml.floating_point('.', attribute='y'),
+        declxml.floating_point('.', attribute='z')
+    ], required=False),
+    declxml.dictionary('offset', [
+        declxml.floating_point('.', attribute='x'),
+        declxml.floating_point('.', attribute='y'),
+        declxml.floating_point('.', attribute='z')
+    ], required=False),
 ], required=False)
 
 node_processor = declxml.dictionary('node', [
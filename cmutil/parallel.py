@@ -0,0 +1,173 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import concurrent.futures
+import itertools
+import os
+
+from . import convert, declxml, shm
+from .nml import thing_processor
+from .simplify import simplify_thing
+
+# Comments by treenode ID, and the coordinate transform. Every worker
+# process gets its own copy once, when it starts, instead of with every
+# skeleton. The treenodes are read from shared memory (see `shm').
+_node_comments = None
+_transform = None
+
+
+def _initialize(node_comments, transform=None, shared=None):
+    global _node_comments, _transform
+    _node_comments = node_comments
+    _transform = transform
+    shm.attach(shared)
+
+
+def serialize_thing(thing, nodes, tolerances, indent=' '):
+    """Fills and serializes a single <thing>. This runs inside the worker
+    processes.
+
+    :param nodes: The skeleton's descriptor in a `shm.SharedSkeletons'
+    :returns: One `<thing>' fragment per tolerance, and the thing's
+        branchpoints
+    :rtype: tuple
+    """
+    convert.fill_nodes(thing, *shm.read(nodes), _node_comments, _transform)
+    branchpoints = convert.find_branchpoints(thing)
+    fragments = [declxml.serialize_to_fragment(
+        thing_processor,
+        thing if tolerance is None else simplify_thing(thing, tolerance),
+        indent) for tolerance in tolerances]
+    return fragments, branchpoints
+
+
+def serialize_nml(catmaid_objects, tolerances=(None,), workers=None, shards=1,
+                  indent=' ', progress=None, thing_ids=None, transform=None):
+    """Converts CATMAID objects into NML like `convert.prepare_nml' and
+    `declxml.serialize_to_string' do, but fills and serializes the <thing>s
+    on a pool of worker processes. The lookups shared by all skeletons are
+    built only once, in this process.
+
+    The fragments are spliced together in the original order, so the
+    output is identical to a serial conversion. With several shards, the
+    things are split into that many consecutive runs, and each shard gets
+    the comments and branchpoints of its own nodes.
+
+    :param list tolerances: Simplification tolerances, see
+        `convert.convert_levels'
+    :param int workers: Number of worker processes; defaults to the number of CPUs
+    :param int shards: Number of NML documents to split the output into
+    :param progress.Progress progress: If given, counts the things serialized
+    :param thing_ids: If given, only the skeletons with these neuron or
+        skeleton IDs are converted
+    :param transform.Affine transform: Transform into NML coordinates, see
+        `convert.prepare_nml'
+    :returns: For each tolerance, a list with one NML document per shard
+    :rtype: list
+    """
+    outputs = [[] for _ in tolerances]
+    for _, documents in iter_shards(catmaid_objects, tolerances, workers,
+                                    shards, indent, progress, thing_ids,
+                                    transform):
+        for level, document in enumerate(documents):
+            outputs[level].append(document)
+    return outputs
+
+
+def iter_shards(catmaid_objects, tolerances=(None,), workers=None, shards=1,
+                indent=' ', progress=None, thing_ids=None, transform=None,
+                skip=()):
+    """Like `serialize_nml', but yields each shard as soon as it is
+    complete, so that it can be written before the next one is converted.
+
+    :param skip: Numbers of shards that are neither converted nor yielded,
+        e.g. because they were written by an earlier run
+    :returns: Iterator over the number of each shard, and a list with its
+        NML document for each tolerance
+    :rtype: iterator
+    """
+    skeletons, node_comments, comments = convert.index_catmaid(catmaid_objects)
+    parameters = None
+    if transform is not None:
+        transform = transform.bind(None)
+        parameters = transform.parameters()
+    if thing_ids is not None:
+        thing_ids = set(thing_ids)
+        skeletons = [(thing, treenodes) for thing, treenodes in skeletons
+                     if thing['id'] in thing_ids or thing['skeleton_id'] in thing_ids]
+        if not skeletons:
+            raise convert.ThingsNotFound(thing_ids)
+        node_ids = {node['pk'] for _, treenodes in skeletons for node in treenodes}
+        comments = [comment for comment in comments if comment['node'] in node_ids]
+    workers = workers or os.cpu_count() or 1
+    things = [thing for thing, _ in skeletons]
+    treenodes = [treenodes for _, treenodes in skeletons]
+
+    shard_of = [i * shards // len(things) for i in range(len(things))]
+    if shards == 1:
+        shard_comments = [comments]
+    else:
+        # Comments of nodes that don't belong to any skeleton go to shard 0
+        node_shard = {node['pk']: shard_of[i]
+                      for i, nodes in enumerate(treenodes) for node in nodes}
+        shard_comments = [[] for _ in range(shards)]
+        for comment in comments:
+            shard_comments[node_shard.get(comment['node'], 0)].append(comment)
+    members = [[] for _ in range(shards)]
+    for i, shard in enumerate(shard_of):
+        members[shard].append(i)
+    # Only the nodes of the shards that are converted go to the workers
+    converted = [i for shard in range(shards) if shard not in skip
+                 for i in members[shard]]
+
+    with shm.SharedSkeletons([treenodes[i] for i in converted]) as shared, \
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_initialize,
+                initargs=(node_comments, transform, shared.name)) as pool:
+        nodes = dict(zip(converted, shared.descriptors))
+        if progress is not None:
+            progress.start('converting', len(converted))
+        for shard in range(shards):
+            if shard in skip:
+                continue
+            results = []
+            for i, result in zip(members[shard], pool.map(
+                    serialize_thing,
+                    [things[i] for i in members[shard]],
+                    [nodes[i] for i in members[shard]],
+                    itertools.repeat(tolerances), itertools.repeat(indent),
+                    chunksize=max(1, len(members[shard]) // (4 * workers)))):
+                results.append(result)
+                if progress is not None:
+                    progress.update(things=1, nodes=len(treenodes[i]))
+
+            documents = []
+            for level in range(len(tolerances)):
+                fragments = (fragments[level] for fragments, _ in results)
+                branchpoints = [branchpoint for _, branchpoints in results
+                                for branchpoint in branchpoints]
+                documents.append(''.join(convert.splice_nml(
+                    fragments, shard_comments[shard], branchpoints,
+                    parameters, indent)))
+            yield shard, documents
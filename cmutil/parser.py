@@ -26,11 +26,14 @@ import argparse
 import datetime
 import sys
 
+from .transform import parse_option
+
 parser = argparse.ArgumentParser(
     description='Convert CATMAID JSON into NML and vice-versa.')
 parser.add_argument('-convert',
-                    choices=['nml', 'catmaid'],
-                    help='Output format', required=True)
+                    choices=['nml', 'catmaid', 'binary'],
+                    help="""Output format. The input format (NML, CATMAID JSON
+                    or binary) is detected automatically.""")
 parser.add_argument('-o', '--output',
                     help='Output file. If no file is specified, prints to stdout.')
 parser.add_argument('-u', '--user',
@@ -39,9 +42,155 @@ parser.add_argument('-u', '--user',
 parser.add_argument('-pyknossos',
                     help="""(Only for creating CATMAID JSON) Parse PyKNOSSOS files.""",
                     action='store_true')
+parser.add_argument('-timestamp',
+                    help="""(Only for creating CATMAID JSON) Creation time to
+                    write into every CATMAID object, e.g.
+                    2018-01-01T00:00:00Z. Defaults to the current time.""")
+parser.add_argument('-deterministic',
+                    help="""Create the same output for the same input: unless
+                    -timestamp is given, the creation time is always
+                    1970-01-01T00:00:00Z. Output files whose content would
+                    not change are not rewritten.""",
+                    action='store_true')
+parser.add_argument('-intern-labels',
+                    help="""(Only for creating CATMAID JSON) Create one CATMAID
+                    label per distinct comment text, instead of one per
+                    commented node.""",
+                    action='store_true')
+parser.add_argument('-simplify', metavar='TOLERANCE[,TOLERANCE...]',
+                    help="""Drop nodes that are within TOLERANCE of the straight
+                    line through their neighbours. Roots, branch nodes,
+                    leaves and commented nodes are always kept. With several
+                    comma-separated tolerances, one output file is written per
+                    tolerance, named like the output file plus .lod0, .lod1, ...""",
+                    type=lambda value: [float(_) for _ in value.split(',')])
+parser.add_argument('-scale', metavar='X,Y,Z',
+                    help="""Voxel size, e.g. in nanometres: NML coordinates are
+                    multiplied by it for CATMAID, and CATMAID coordinates
+                    divided by it (and rounded) for NML. "nml" takes it from
+                    the <scale> parameter of the NML input.""",
+                    type=parse_option)
+parser.add_argument('-offset', metavar='X,Y,Z',
+                    help="""Position of the dataset in voxels, added to NML
+                    coordinates for CATMAID. "nml" takes it from the
+                    <offset> parameter of the NML input.""",
+                    type=parse_option)
+parser.add_argument('-validate',
+                    help="""Check the input for problems (e.g. dangling edges,
+                    cycles, duplicate IDs) instead of converting it. NML and
+                    CATMAID JSON are told apart automatically.""",
+                    action='store_true')
+parser.add_argument('-things',
+                    help="""Only convert these things, given as comma-separated
+                    NML thing IDs or CATMAID neuron or skeleton IDs. Binary
+                    files are only read where these things are stored.""",
+                    type=lambda value: [int(_) for _ in value.split(',')])
+parser.add_argument('-diff',
+                    help="""Compare the input with this NML or CATMAID JSON
+                    file instead of converting it, and list the skeletons and
+                    nodes that differ. Exits with status 1 if there are
+                    differences.""",
+                    metavar='OTHER')
+parser.add_argument('-stats',
+                    help="""Instead of converting, count the nodes, edges,
+                    branch points, end points and comments of each skeleton,
+                    and measure its cable length. Several input files can be
+                    given; the totals of each file are listed, too.""",
+                    choices=['csv', 'json'])
+parser.add_argument('-merge',
+                    help="""Merge all input files into one output file. Of
+                    identical skeletons (same node positions, edges and
+                    comments, regardless of IDs), only the first copy is
+                    kept. Node and thing IDs that are taken by an earlier
+                    skeleton are renumbered.""",
+                    action='store_true')
+parser.add_argument('-dedup-map', metavar='FILE',
+                    help="""(Only for -merge) Write the skeletons that were
+                    dropped as copies, and the skeletons they are copies of,
+                    to FILE as CSV.""")
+parser.add_argument('-index',
+                    help="""Instead of converting, write an index of the
+                    things in each NML or CATMAID JSON input file to
+                    FILE.cmidx. As long as a file doesn't change, -things
+                    then parses only the selected things.""",
+                    action='store_true')
+parser.add_argument('-check',
+                    help="""Check the input for problems before converting it,
+                    and don't convert it if there are any.""",
+                    action='store_true')
+parser.add_argument('-watch', metavar='DIRECTORY',
+                    help="""Keep running and convert every file that is
+                    saved into DIRECTORY. Output files are written to the
+                    directory given by -o (default: DIRECTORY).""")
+parser.add_argument('-workers',
+                    help="""Number of worker processes for -watch and -serve
+                    (defaults to the number of CPUs). With -convert nml,
+                    skeletons are converted in parallel on that many
+                    processes.""",
+                    type=int)
+parser.add_argument('-shards',
+                    help="""(Only for -convert nml) Split the output into this
+                    many NML files, named like the output file plus .shard0,
+                    .shard1, ... Skeletons are converted in parallel.""",
+                    type=int)
+parser.add_argument('-resume',
+                    help="""(Only for -shards and -watch) Continue a run that
+                    was interrupted, skipping the shards or files that its
+                    journal lists as complete.""",
+                    action='store_true')
+parser.add_argument('-interval',
+                    help="""Seconds between two scans of the watched directory
+                    (-watch; a file is converted once it has not changed for
+                    one interval), or between two progress reports
+                    (-progress, -heartbeat).""",
+                    type=float, default=1.0)
+parser.add_argument('-pipeline',
+                    help="""Read the input, convert it and write the output on
+                    separate threads, so that reading and writing overlap
+                    with the conversion.""",
+                    action='store_true')
+parser.add_argument('-stream',
+                    help="""(Only for -convert catmaid) Convert one skeleton
+                    at a time, keeping only that skeleton in memory. All
+                    objects of a skeleton are written together, right after
+                    the classes and relations. Reads the NML input file
+                    twice.""",
+                    action='store_true')
+parser.add_argument('-progress',
+                    help="""Report bytes read, things converted, nodes per
+                    second and the estimated time left on stderr.""",
+                    action='store_true')
+parser.add_argument('-heartbeat',
+                    help="""Keep replacing this file with the progress of the
+                    conversion as JSON.""",
+                    metavar='FILE')
+parser.add_argument('-serve', metavar='ADDRESS',
+                    help="""Run a local conversion server on ADDRESS, which is
+                    either [HOST:]PORT or the path of a Unix socket. POST
+                    CATMAID JSON to /nml, or NML to /catmaid?user=ID.""")
+parser.add_argument('-backlog',
+                    help="""(Only for -serve) Maximum number of requests that
+                    are being converted or wait for a worker. Further
+                    requests are rejected with 503. Defaults to twice the
+                    number of workers.""",
+                    type=int)
 parser.add_argument('source',
                     help='Input file. If no file is specified, reads from stdin.',
                     nargs='?', default='')
+parser.add_argument('sources',
+                    help='(Only for -stats, -merge and -index) Further input files.',
+                    nargs='*', metavar='source')
+
+
+def create_timestamp(mtime=None):
+    """Returns the current time, or the given modification time of a file,
+    formatted like CATMAID timestamps."""
+    if mtime is not None:
+        utc = datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+        return utc.replace(tzinfo=None).isoformat() + 'Z'
+    # TODO fix timezone
+    # return datetime.datetime.now().isoformat(timespec='milliseconds') + 'Z'
+    return datetime.datetime.now().isoformat() + 'Z'
 
 
 def fill_arguments(args):
@@ -52,8 +201,12 @@ def fill_arguments(args):
             print('Project ID must be an integer!', file=sys.stderr)
             sys.exit(-1)
 
-    # TODO fix timezone
-    # args.timestamp = datetime.datetime.now().isoformat(timespec='milliseconds') + 'Z'
-    args.timestamp = datetime.datetime.now().isoformat() + 'Z'
+    if args.timestamp is None:
+        if args.deterministic:
+            # A fixed time, so that the output only depends on the content
+            # of the input, and not on when the input file was written
+            args.timestamp = create_timestamp(0)
+        else:
+            args.timestamp = create_timestamp()
 
     return args
@@ -0,0 +1,226 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import gzip
+import hashlib
+import itertools
+import os
+import queue
+import sys
+import threading
+
+from .fileio import file_hash, open_temporary
+
+# Number of chunks or output pieces each stage may be ahead of the next
+DEPTH = 8
+# Output pieces are joined into blocks of about this size before they are
+# handed to the writer, so that the queue isn't busy with tiny strings
+BLOCK_SIZE = 1 << 20
+_MAX_BATCH = 4096
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+def read_ahead(chunks, depth=DEPTH):
+    """Iterates over `chunks' on a separate thread, so that reading the
+    input overlaps with parsing it. At most `depth' chunks are read ahead.
+
+    The chunks are copied before they are handed over, since memory-mapped
+    chunks (see `fileio.open_source') are only valid until the next one is
+    read. The reading thread is stopped when the returned iterator is
+    closed, so `chunks' can be closed safely afterwards.
+
+    :rtype: iterator of bytes
+    """
+    pending = queue.Queue(depth)
+    stop = threading.Event()
+
+    def read():
+        try:
+            for chunk in chunks:
+                if not _put(pending, bytes(chunk), stop):
+                    return
+            _put(pending, _DONE, stop)
+        except BaseException as error:
+            _put(pending, _Failure(error), stop)
+
+    thread = threading.Thread(target=read, name='cmutil-reader', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _put(pending, item, stop):
+    """Puts `item' into the queue unless `stop' is set first. Returns
+    whether the item was put."""
+    while not stop.is_set():
+        try:
+            pending.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def write_behind(pieces, path=None, compress=False, keep_unchanged=False,
+                 depth=DEPTH):
+    """Writes the str or bytes `pieces' to `path', encoding, compressing and
+    writing them on a separate thread, so that this overlaps with creating
+    the pieces. At most `depth' blocks of output are queued.
+
+    The file is replaced atomically once all pieces are written; if
+    creating the pieces fails, the file is left alone.
+
+    :param str path: Output file; stdout if None
+    :param bool compress: gzip the output
+    :param bool keep_unchanged: Don't replace the file if it already has
+        exactly the new content
+    :returns: The SHA-256 hex digest of the output, and whether the file was
+        written
+    :rtype: tuple
+    """
+    if path is None:
+        f, tmp_path = sys.stdout.buffer, None
+    else:
+        f, tmp_path = open_temporary(path)
+
+    pending = queue.Queue(depth)
+    stop = threading.Event()
+    digest = hashlib.sha256()
+    failure = []
+
+    def write():
+        # gzip headers get no timestamp, so the output only depends on the
+        # input. The hash is over the compressed bytes, as written.
+        if compress:
+            out = gzip.GzipFile(fileobj=_HashingFile(f, digest), mode='wb',
+                                mtime=0)
+        else:
+            out = f
+        try:
+            while True:
+                block = pending.get()
+                if block is _DONE:
+                    break
+                if isinstance(block, str):
+                    block = block.encode()
+                out.write(block)
+                if not compress:
+                    digest.update(block)
+            if compress:
+                out.close()
+        except BaseException as error:
+            failure.append(error)
+            stop.set()
+
+    thread = threading.Thread(target=write, name='cmutil-writer', daemon=True)
+    thread.start()
+    try:
+        try:
+            for block in _blocks(pieces):
+                if not _put(pending, block, stop):
+                    break
+        finally:
+            _put(pending, _DONE, stop)
+            thread.join()
+        if failure:
+            raise failure[0]
+        f.flush()
+    except BaseException:
+        if tmp_path is not None:
+            f.close()
+            os.unlink(tmp_path)
+        raise
+
+    if tmp_path is None:
+        return digest.hexdigest(), True
+
+    os.fsync(f.fileno())
+    f.close()
+    if keep_unchanged and file_hash(path) == digest.hexdigest():
+        os.unlink(tmp_path)
+        return digest.hexdigest(), False
+    os.replace(tmp_path, path)
+    return digest.hexdigest(), True
+
+
+def _blocks(pieces):
+    """Joins pieces of output (either all str or all bytes) into blocks of
+    about `BLOCK_SIZE'. Pieces are joined in batches, since there can be
+    millions of tiny ones; the size of the batches adapts to the size of
+    the pieces, so that large pieces are passed on right away."""
+    pieces = iter(pieces)
+    block = []
+    size = 0
+    count = 1
+    while True:
+        batch = list(itertools.islice(pieces, count))
+        if not batch:
+            break
+        part = _join(batch)
+        block.append(part)
+        size += len(part)
+        if size >= BLOCK_SIZE:
+            yield _join(block)
+            block, size = [], 0
+        # Aim for batches of a tenth of a block, but grow them slowly, since
+        # pieces can be much larger than the ones before
+        count = max(1, min(2 * count, _MAX_BATCH,
+                           len(batch) * BLOCK_SIZE // (10 * len(part) + 1)))
+    if block:
+        yield _join(block)
+
+
+def _join(block):
+    return (b'' if isinstance(block[0], bytes) else '').join(block)
+
+
+class _HashingFile:
+    """Hashes everything written to a file, i.e. the compressed output."""
+
+    def __init__(self, f, digest):
+        self._f = f
+        self._digest = digest
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
@@ -0,0 +1,176 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import datetime
+import json
+import os
+import sys
+import time
+
+from .fileio import write_atomic
+
+
+class Progress:
+    """Keeps track of a long conversion, and reports on it every `interval'
+    seconds: as a line on stderr, and/or by replacing a JSON heartbeat file.
+
+    A conversion goes through phases (e.g. 'reading', then 'converting').
+    The loops of a phase call `update' once per chunk or thing, never per
+    node, and `update' only looks at the clock, so leaving progress
+    reporting on costs next to nothing.
+    """
+
+    def __init__(self, total_bytes=None, stream=None, heartbeat=None,
+                 interval=1.0):
+        """
+        :param int total_bytes: Size of the input, if known; used for the ETA
+            while reading
+        :param stream: File to print progress lines to, e.g. sys.stderr
+        :param str heartbeat: Path of a JSON file to replace with the
+            current state
+        :param float interval: Seconds between reports
+        """
+        self.total_bytes = total_bytes
+        self.stream = stream
+        self.heartbeat = heartbeat
+        self.interval = interval
+
+        self.bytes_read = 0
+        self.phase = 'reading'
+        self.things = 0
+        self.total_things = None
+        self.nodes = 0
+
+        self._started = self._phase_started = time.monotonic()
+        self._next_report = self._started + interval
+
+    def start(self, phase, total_things=None):
+        """Starts a new phase, resetting the thing and node counts.
+
+        :param str phase: Name of the phase
+        :param int total_things: Number of things the phase will go through
+        """
+        self.phase = phase
+        self.things = 0
+        self.total_things = total_things
+        self.nodes = 0
+        self._phase_started = time.monotonic()
+        self.report()
+
+    def update(self, nbytes=0, things=0, nodes=0):
+        """Counts bytes read, and things and nodes processed, and reports
+        if it's time to."""
+        self.bytes_read += nbytes
+        self.things += things
+        self.nodes += nodes
+        now = time.monotonic()
+        if now >= self._next_report:
+            self.report(now)
+
+    def finish(self):
+        """Reports the final state."""
+        self.phase = 'done'
+        self.report()
+
+    def state(self, now=None):
+        """Returns the current state as a dict."""
+        now = time.monotonic() if now is None else now
+        elapsed = now - self._phase_started
+
+        # Estimate the rest of the current phase from how far it got
+        if self.phase == 'reading' and self.total_bytes:
+            done, total = self.bytes_read, self.total_bytes
+        else:
+            done, total = self.things, self.total_things
+        eta = None
+        if total and done:
+            eta = max(0.0, elapsed * (total - done) / done)
+
+        return {'phase': self.phase,
+                'bytes_read': self.bytes_read,
+                'bytes_total': self.total_bytes,
+                'things': self.things,
+                'things_total': self.total_things,
+                'nodes': self.nodes,
+                'nodes_per_second': self.nodes / elapsed if elapsed > 0 else None,
+                'eta_seconds': eta,
+                'elapsed_seconds': now - self._started,
+                'time': datetime.datetime.now().isoformat()}
+
+    def report(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._next_report = now + self.interval
+        state = self.state(now)
+        if self.stream is not None:
+            print(format_state(state), file=self.stream)
+            self.stream.flush()
+        if self.heartbeat is not None:
+            write_atomic(self.heartbeat, json.dumps(state))
+
+
+def format_state(state):
+    """Formats a state returned by `Progress.state' as one line."""
+    if state['phase'] == 'reading' and state['bytes_total']:
+        parts = ['reading: {} of {} read ({:.0%})'.format(
+            _size(state['bytes_read']), _size(state['bytes_total']),
+            state['bytes_read'] / state['bytes_total'])]
+    else:
+        parts = ['{}: {} read'.format(state['phase'], _size(state['bytes_read']))]
+    if state['things_total'] is not None:
+        parts.append('{} of {} things'.format(state['things'],
+                                              state['things_total']))
+    elif state['things']:
+        parts.append('{} things'.format(state['things']))
+    if state['nodes']:
+        parts.append('{} nodes ({:.0f} nodes/s)'.format(
+            state['nodes'], state['nodes_per_second'] or 0))
+    if state['phase'] == 'done':
+        parts.append('{} elapsed'.format(_duration(state['elapsed_seconds'])))
+    elif state['eta_seconds'] is not None:
+        parts.append('ETA {}'.format(_duration(state['eta_seconds'])))
+    return ', '.join(parts)
+
+
+def _size(nbytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if nbytes < 1024 or unit == 'GiB':
+            return ('{} {}' if unit == 'B' else '{:.1f} {}').format(nbytes, unit)
+        nbytes /= 1024
+
+
+def _duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def stderr_progress(source, heartbeat=None, interval=1.0, quiet=False):
+    """Creates a `Progress' for converting the file `source' (or stdin, if
+    empty), printing to stderr unless `quiet'."""
+    total_bytes = None
+    if source:
+        try:
+            total_bytes = os.stat(source).st_size
+        except OSError:
+            pass
+    return Progress(total_bytes, None if quiet else sys.stderr, heartbeat,
+                    interval)
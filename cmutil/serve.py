@@ -0,0 +1,228 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import concurrent.futures
+import http.server
+import os
+import re
+import signal
+import socketserver
+import stat
+import sys
+import threading
+import urllib.parse
+
+from . import convert, declxml
+from .parser import create_timestamp
+
+CHUNK_SIZE = 64 * 1024
+# What each endpoint converts from
+INPUT_FORMATS = {'nml': 'catmaid', 'catmaid': 'nml'}
+FORMAT_NAMES = {'nml': 'NML', 'catmaid': 'CATMAID JSON'}
+# A byte order mark, and whitespace
+_LEADING_SPACE = re.compile(b'(?:\xef\xbb\xbf)?[ \t\r\n]*')
+
+
+def convert_request(body, output_format, user_id, is_pyknossos):
+    """Converts a request body. This runs inside the worker processes.
+
+    :type body: bytes
+    :rtype: bytes
+    """
+    return convert.convert(body, output_format, user_id, create_timestamp(),
+                           is_pyknossos).encode()
+
+
+def input_format(body):
+    """Tells from its first character whether a request body is CATMAID
+    JSON or NML."""
+    start = _LEADING_SPACE.match(body).end()
+    return 'catmaid' if body[start:start + 1] == b'[' else 'nml'
+
+
+def _warm_up(_):
+    return os.getpid()
+
+
+class ConversionHandler(http.server.BaseHTTPRequestHandler):
+    """Handles `POST /nml' (CATMAID JSON in, NML out) and
+    `POST /catmaid?user=ID[&pyknossos=1]' (NML in, CATMAID JSON out).
+
+    Request bodies may be sent with a Content-Length or chunked. Each body
+    is read completely, and converted in one piece by a worker process, so
+    memory use grows with the size of the request. Responses are always
+    sent chunked.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        output_format = url.path.strip('/')
+        if output_format not in ('nml', 'catmaid'):
+            self.send_error(404, 'Use POST /nml or POST /catmaid')
+            return
+
+        user_id = self.server.user_id
+        if 'user' in query:
+            try:
+                user_id = int(query['user'][0])
+            except ValueError:
+                self.send_error(400, 'User ID must be an integer')
+                return
+        if output_format == 'catmaid' and user_id is None:
+            self.send_error(400, 'Specify a user ID with ?user=ID')
+            return
+        is_pyknossos = query.get('pyknossos', ['0'])[0] not in ('0', '')
+
+        # Backpressure: don't queue more requests than the server allows.
+        # The slot is taken before the body is read, so that a rejected
+        # request costs neither memory nor a waiting thread.
+        if not self.server.slots.acquire(blocking=False):
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            # The body is left unread, so the connection can't be reused
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            return
+        try:
+            body = self._read_body()
+            expected, found = INPUT_FORMATS[output_format], input_format(body)
+            if found != expected:
+                raise ValueError('Expected {} for /{}, got {}'.format(
+                    FORMAT_NAMES[expected], output_format,
+                    FORMAT_NAMES[found]))
+            output = self.server.pool.submit(convert_request, body,
+                                             output_format, user_id,
+                                             is_pyknossos).result()
+        except (ValueError, SyntaxError, KeyError, AssertionError,
+                declxml.XmlError) as error:
+            self.send_error(400, str(error) or type(error).__name__)
+            return
+        except Exception as error:
+            self.log_error('Conversion failed: %r', error)
+            self.send_error(500, str(error) or type(error).__name__)
+            return
+        finally:
+            self.server.slots.release()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json'
+                         if output_format == 'catmaid' else 'application/xml')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        view = memoryview(output)
+        for offset in range(0, len(view), CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            self.wfile.write(b'%x\r\n' % len(chunk))
+            self.wfile.write(chunk)
+            self.wfile.write(b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                # Skip trailers up to the final empty line
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(address, workers=None, backlog=None, user_id=None,
+                  quiet=False):
+    """Creates a conversion server and starts its worker processes.
+
+    :param str address: Either `[HOST:]PORT' (HOST defaults to 127.0.0.1),
+        or the path of a Unix socket (anything containing a `/', optionally
+        prefixed with `unix:')
+    :param int workers: Number of worker processes; defaults to the number of CPUs
+    :param int backlog: Maximum number of requests that are converted or wait
+        for a worker at the same time. Further requests are rejected with
+        503 right away, before their body is read. Defaults to twice the
+        number of workers.
+    :param int user_id: CATMAID user ID used if a request does not specify one
+    """
+    workers = workers or os.cpu_count() or 1
+
+    if address.startswith('unix:') or '/' in address:
+        path = address[len('unix:'):] if address.startswith('unix:') else address
+        # Remove a stale socket left behind by a previous server
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        server = ThreadingUnixHTTPServer(path, ConversionHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)),
+                                     ConversionHandler)
+
+    server.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    # Fork all workers up front, so that no request pays for process startup
+    list(server.pool.map(_warm_up, range(workers)))
+    server.slots = threading.BoundedSemaphore(backlog or 2 * workers)
+    server.user_id = user_id
+    server.quiet = quiet
+    return server
+
+
+def serve(address, **kwargs):
+    """Runs a conversion server until interrupted. See `create_server'."""
+    server = create_server(address, **kwargs)
+    # Shut down cleanly (and remove the socket file) when terminated
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print('Serving on {}'.format(server.server_address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+        if isinstance(server, ThreadingUnixHTTPServer):
+            os.unlink(server.server_address)
@@ -0,0 +1,165 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+from array import array
+import contextlib
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    # Python < 3.8: the packed arrays are pickled instead
+    shared_memory = None
+
+# Handing the nodes of skeletons to worker processes without pickling them.
+#
+# The parent packs the treenodes of all skeletons into one block of shared
+# memory: the node IDs and parent IDs of all skeletons (int64, with
+# _NO_PARENT for roots), followed by their interleaved x, y, z coordinates
+# (float64). Each task only carries a small descriptor, (number of nodes in
+# the block, index of the skeleton's first node, number of its nodes), and
+# the workers read the arrays straight from the block.
+
+_NO_PARENT = -2 ** 63
+_NODE_SIZE = 5 * 8
+
+# The block that a worker process is attached to, see `attach'
+_attached = None
+
+
+def node_arrays(treenodes):
+    """Packs CATMAID treenodes into arrays of node IDs, parent IDs and
+    interleaved coordinates.
+
+    :param list treenodes: `catmaid.treenode' objects
+    :rtype: tuple
+    """
+    ids = array('q', [node['pk'] for node in treenodes])
+    parents = array('q', [_NO_PARENT if node['fields']['parent'] is None
+                          else node['fields']['parent'] for node in treenodes])
+    locations = array('d')
+    for node in treenodes:
+        fields = node['fields']
+        locations.extend((fields['location_x'], fields['location_y'],
+                          fields['location_z']))
+    return ids, parents, locations
+
+
+def unpack(ids, parents, locations):
+    """Turns arrays like those from `node_arrays' back into lists.
+
+    :returns: Node IDs, parent IDs (None for roots) and (x, y, z) tuples
+    :rtype: tuple
+    """
+    coordinates = locations.tolist()
+    return (ids.tolist(),
+            [None if parent == _NO_PARENT else parent
+             for parent in parents.tolist()],
+            list(zip(coordinates[0::3], coordinates[1::3], coordinates[2::3])))
+
+
+class SharedSkeletons:
+    """The nodes of many skeletons in one block of shared memory. Instead
+    of the treenodes of a skeleton, its entry in `descriptors' is sent to a
+    worker, which gets the nodes from `read'. Workers have to `attach' to
+    the block named `name' first, e.g. in the initializer of the pool.
+
+    Without `multiprocessing.shared_memory', `name' is None, and the
+    descriptors are the packed arrays themselves.
+
+    The block is removed by `close', which has to be called once the
+    workers are done; use it as a context manager. If the process is
+    killed instead, the resource tracker of `multiprocessing' removes it
+    once the workers have exited, too.
+
+    :param skeletons: For each skeleton, its `catmaid.treenode' objects
+    """
+
+    def __init__(self, skeletons):
+        self.name = None
+        self.descriptors = []
+        if shared_memory is None:
+            self.descriptors = [node_arrays(treenodes) for treenodes in skeletons]
+            return
+
+        total = sum(len(treenodes) for treenodes in skeletons)
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=max(1, total * _NODE_SIZE))
+        self.name = self._memory.name
+        try:
+            with _views(self._memory.buf, total) as (ids, parents, locations):
+                start = 0
+                for treenodes in skeletons:
+                    end = start + len(treenodes)
+                    ids[start:end], parents[start:end], \
+                        locations[3 * start:3 * end] = node_arrays(treenodes)
+                    self.descriptors.append((total, start, len(treenodes)))
+                    start = end
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.name is not None:
+            self._memory.close()
+            self._memory.unlink()
+            self.name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach(name):
+    """Attaches a worker process to the block of a `SharedSkeletons'. Does
+    nothing if `name' is None."""
+    global _attached
+    if name is not None:
+        _attached = shared_memory.SharedMemory(name)
+
+
+def read(descriptor):
+    """Returns the nodes of a skeleton, like `unpack', given its entry in
+    `SharedSkeletons.descriptors'."""
+    if _attached is None:
+        return unpack(*descriptor)
+    total, start, count = descriptor
+    with _views(_attached.buf, total) as (ids, parents, locations):
+        return unpack(ids[start:start + count], parents[start:start + count],
+                      locations[3 * start:3 * (start + count)])
+
+
+@contextlib.contextmanager
+def _views(buffer, total):
+    """Views of the ID, parent and coordinate arrays in a block. A block
+    can only be closed once all views of it are released."""
+    views = (buffer[:8 * total].cast('q'),
+             buffer[8 * total:16 * total].cast('q'),
+             buffer[16 * total:_NODE_SIZE * total].cast('d'))
+    try:
+        yield views
+    finally:
+        for view in views:
+            view.release()
@@ -0,0 +1,133 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+from array import array
+import math
+
+from .topology import Topology
+
+
+def simplify(nml, tolerance):
+    """Simplifies all things of an NML dict, i.e. the output of either
+    `convert.nml2dict' or `convert.prepare_nml'. See `simplify_thing'.
+
+    Nodes referenced by the `<comments>' and `<branchpoints>' of `nml' are
+    always kept.
+
+    :param float tolerance: Maximum distance of a dropped node from the
+        simplified skeleton, in the units of the coordinates. If None,
+        `nml' is returned unchanged.
+    :rtype: dict
+    """
+    if tolerance is None:
+        return nml
+
+    keep = {comment['node'] for comment in nml.get('comments', [])}
+    keep.update(branchpoint['id'] for branchpoint in nml.get('branchpoints', []))
+
+    simplified = dict(nml)
+    simplified['things'] = [simplify_thing(thing, tolerance, keep)
+                            for thing in nml['things']]
+    return simplified
+
+
+def simplify_thing(thing, tolerance, keep=frozenset()):
+    """Returns a copy of an NML `thing' without the nodes that are (almost)
+    collinear with their neighbours.
+
+    Roots, branch nodes, leaves, nodes with a comment and nodes in `keep'
+    are always kept. Every path between two of those is simplified with the
+    Reumann-Witkam algorithm: a line is drawn through the first node of the
+    path and its successor, and all following nodes within `tolerance' of
+    that line are dropped. The node before the first one that is further
+    away is kept, and starts the next line. Every node is looked at once,
+    so this takes linear time.
+
+    :type thing: dict
+    :param float tolerance: Maximum distance of a dropped node from the line
+    :param keep: Node IDs which must not be dropped
+    :rtype: dict
+    """
+    nodes = thing['nodes']
+    topology = Topology.from_thing(thing)
+    parents = topology.parents
+
+    kept = bytearray(len(nodes))
+    for indices in (topology.roots, topology.branch_nodes, topology.leaves):
+        for i in indices:
+            kept[i] = 1
+    for i, node in enumerate(nodes):
+        if node.get('comment') or node['id'] in keep:
+            kept[i] = 1
+
+    new_parents = array('q', parents)
+    # Every node that isn't kept yet lies on exactly one path between a
+    # kept node and its closest kept ancestor.
+    for end in [i for i in range(len(nodes)) if kept[i] and parents[i] >= 0]:
+        path = [end, parents[end]]
+        while not kept[path[-1]]:
+            path.append(parents[path[-1]])
+        path.reverse()
+
+        start = 0
+        keys = [0]
+        for j in range(2, len(path)):
+            if _distance(nodes[path[j]], nodes[path[start]],
+                         nodes[path[start + 1]]) > tolerance:
+                keys.append(j - 1)
+                start = j - 1
+        keys.append(len(path) - 1)
+
+        for a, b in zip(keys, keys[1:]):
+            kept[path[b]] = 1
+            new_parents[path[b]] = path[a]
+
+    ids = topology.ids
+    simplified = dict(thing)
+    simplified['nodes'] = [node for i, node in enumerate(nodes) if kept[i]]
+    simplified['edges'] = [{'source': ids[new_parents[i]], 'target': ids[i]}
+                           for i in range(len(nodes))
+                           if kept[i] and new_parents[i] >= 0]
+    return simplified
+
+
+def _distance(node, start, through):
+    """Returns the distance of `node' from the line through `start' and
+    `through'."""
+    dx = through['x'] - start['x']
+    dy = through['y'] - start['y']
+    dz = through['z'] - start['z']
+    px = node['x'] - start['x']
+    py = node['y'] - start['y']
+    pz = node['z'] - start['z']
+
+    length = math.sqrt(dx * dx + dy * dy + dz * dz)
+    if length == 0:
+        return math.sqrt(px * px + py * py + pz * pz)
+
+    # The length of the cross product is the area of the parallelogram
+    cx = py * dz - pz * dy
+    cy = pz * dx - px * dz
+    cz = px * dy - py * dx
+    return math.sqrt(cx * cx + cy * cy + cz * cz) / length
@@ -0,0 +1,423 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+from array import array
+from collections import namedtuple
+import csv
+import io
+import json
+import math
+
+from . import binary, declxml
+from .stream import CatmaidParser
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Statistics of tracings ("how much did we trace?"), computed in a single
+# pass over an NML, CATMAID JSON or binary skeleton file. Nodes are never
+# turned into dicts: only their IDs and coordinates are collected, in flat
+# arrays, one skeleton at a time where the file format allows it. With
+# numpy, edge lengths and node degrees are computed on whole arrays.
+#
+# Cable length is the sum of the edge lengths, in the file's coordinates
+# (voxels for NML, nanometres for CATMAID). Branch points are nodes with
+# three or more neighbours, end points nodes with exactly one. Edges that
+# refer to nodes of other skeletons, or connect a node to itself, are
+# ignored. Comments are counted as commented nodes: a node with several
+# comments (say, a `comment' attribute and an entry in <comments>) counts
+# once.
+#
+# The ID columns are those a conversion to NML (or to a binary skeleton
+# file) ends up with, whatever the input format: things of NML files
+# without a neuron or skeleton ID get the defaults of
+# `nml.thing_processor'.
+
+FIELDS = ('file', 'thing_id', 'neuron_id', 'skeleton_id', 'nodes', 'edges',
+          'cable_length', 'branch_points', 'end_points', 'comments')
+
+# Defaults of `nml.thing_processor' (PyKNOSSOS files have none)
+DEFAULT_NEURON_ID = 100
+DEFAULT_SKELETON_ID = 99
+
+SkeletonStats = namedtuple('SkeletonStats', FIELDS)
+SkeletonStats.__doc__ = """Statistics of a single skeleton, or the totals
+of a file (with the ID fields set to None)."""
+
+
+def stats(chunks, input_format, is_pyknossos=False, name=''):
+    """Computes the statistics of every skeleton in a file.
+
+    :param chunks: The file, as an iterable of chunks (see
+        `fileio.open_source')
+    :param str input_format: Either 'nml', 'catmaid' or 'binary'
+    :param bool is_pyknossos: Whether an NML file was created by PyKNOSSOS
+    :param str name: File name to report in each `SkeletonStats'
+    :rtype: list of SkeletonStats
+    """
+    if input_format == 'catmaid':
+        rows = _catmaid_stats(chunks)
+    elif input_format == 'binary':
+        rows = _binary_stats(chunks)
+    else:
+        rows = _nml_stats(chunks, is_pyknossos)
+    return [SkeletonStats(name, *row) for row in rows]
+
+
+def total(rows, name=''):
+    """Sums up the statistics of the skeletons of a file.
+
+    :type rows: list of SkeletonStats
+    :rtype: SkeletonStats
+    """
+    sums = [sum(row[i] for row in rows) for i in range(4, len(FIELDS))]
+    sums[2] = round(sums[2], 3)
+    return SkeletonStats(name, None, None, None, *sums)
+
+
+def to_csv(files):
+    """Formats the statistics as CSV: one row per skeleton, followed by
+    one row with the totals of each file (whose ID columns are empty).
+
+    :param files: `stats' of each file
+    :type files: list of list of SkeletonStats
+    :rtype: str
+    """
+    f = io.StringIO()
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(FIELDS)
+    for rows in files:
+        writer.writerows(rows)
+    for rows in files:
+        if rows:
+            writer.writerow(total(rows, rows[0].file))
+    return f.getvalue()
+
+
+def to_json(files, names):
+    """Formats the statistics as JSON: a list with the skeletons and the
+    totals of each file.
+
+    :param files: `stats' of each file
+    :type files: list of list of SkeletonStats
+    :param list names: The name of each file
+    :rtype: str
+    """
+    return json.dumps([
+        {'file': name,
+         'skeletons': [dict(zip(FIELDS[1:], row[1:])) for row in rows],
+         'total': {field: value
+                   for field, value in zip(FIELDS[4:], total(rows)[4:])}}
+        for name, rows in zip(names, files)
+    ], indent=4)
+
+
+class _Skeleton:
+    """Collects the nodes and edges of one skeleton. Once it is complete,
+    `finish' measures it and drops everything but the node IDs, which are
+    needed to count the commented nodes."""
+
+    def __init__(self, ids):
+        # Thing ID, neuron ID and skeleton ID
+        self.ids = ids
+        self.node_ids = array('q')
+        self.coordinates = array('d')
+        self.sources = array('q')
+        self.targets = array('q')
+        self.comments = 0
+        self.measures = None
+
+    def add_node(self, node_id, x, y, z):
+        self.node_ids.append(node_id)
+        self.coordinates.extend((x, y, z))
+
+    def add_edge(self, source, target):
+        self.sources.append(source)
+        self.targets.append(target)
+
+    def finish(self):
+        sources, targets = _edge_indices(self.node_ids, self.sources,
+                                         self.targets)
+        n = len(self.node_ids)
+        self.measures = ((n, len(sources))
+                         + _measure(n, self.coordinates, sources, targets))
+        self.coordinates = self.sources = self.targets = None
+
+    def row(self):
+        """Returns the statistics (without the file name)."""
+        if self.measures is None:
+            self.finish()
+        return self.ids + self.measures + (self.comments,)
+
+
+def _edge_indices(node_ids, sources, targets):
+    """Translates the source and target node IDs of edges into node
+    indices, dropping edges to unknown nodes and from a node to itself."""
+    if numpy is not None:
+        ids = numpy.asarray(node_ids, dtype=numpy.int64)
+        s, found_s = _lookup(ids, sources)
+        t, found_t = _lookup(ids, targets)
+        valid = found_s & found_t & (s != t)
+        return s[valid], t[valid]
+
+    index = {node_id: i for i, node_id in enumerate(node_ids)}
+    s_indices = array('q')
+    t_indices = array('q')
+    for source, target in zip(sources, targets):
+        s = index.get(source)
+        t = index.get(target)
+        if s is not None and t is not None and s != t:
+            s_indices.append(s)
+            t_indices.append(t)
+    return s_indices, t_indices
+
+
+def _lookup(ids, queries):
+    """Finds the index of each of `queries' in the numpy array `ids'.
+
+    :returns: The indices, and whether each query was found
+    :rtype: tuple
+    """
+    queries = numpy.asarray(queries, dtype=numpy.int64)
+    if not len(ids):
+        return (numpy.zeros(len(queries), dtype=numpy.intp),
+                numpy.zeros(len(queries), dtype=bool))
+    order = numpy.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    positions = numpy.minimum(numpy.searchsorted(sorted_ids, queries),
+                              len(ids) - 1)
+    return order[positions], sorted_ids[positions] == queries
+
+
+def _measure(n, coordinates, sources, targets):
+    """Returns the cable length, and the number of branch points and end
+    points of a skeleton.
+
+    :param int n: Number of nodes
+    :param coordinates: Interleaved x, y, z coordinates of the nodes
+    :param sources: Node index of the source of each edge
+    :param targets: Node index of the target of each edge
+    :rtype: tuple
+    """
+    if n == 0:
+        return 0.0, 0, 0
+    if numpy is not None:
+        xyz = numpy.asarray(coordinates, dtype=numpy.float64).reshape(-1, 3)
+        sources = numpy.asarray(sources, dtype=numpy.intp)
+        targets = numpy.asarray(targets, dtype=numpy.intp)
+        d = xyz[sources] - xyz[targets]
+        length = float(numpy.sqrt(numpy.einsum('ij,ij->i', d, d)).sum())
+        degrees = numpy.bincount(numpy.concatenate((sources, targets)),
+                                 minlength=n)
+        return (round(length, 3), int((degrees >= 3).sum()),
+                int((degrees == 1).sum()))
+
+    length = 0.0
+    degrees = [0] * n
+    for s, t in zip(sources, targets):
+        length += math.sqrt((coordinates[3 * s] - coordinates[3 * t]) ** 2
+                            + (coordinates[3 * s + 1] - coordinates[3 * t + 1]) ** 2
+                            + (coordinates[3 * s + 2] - coordinates[3 * t + 2]) ** 2)
+        degrees[s] += 1
+        degrees[t] += 1
+    return (round(length, 3), sum(1 for d in degrees if d >= 3),
+            degrees.count(1))
+
+
+def _parent_edges(parents):
+    """Returns the edges of a tree given by the parent index of each node
+    (-1 for roots), as node indices of the children and of the parents."""
+    if numpy is not None:
+        parents = numpy.asarray(parents, dtype=numpy.int64)
+        children = numpy.flatnonzero(parents >= 0)
+        return children, parents[children]
+    children = array('q', (i for i, parent in enumerate(parents) if parent >= 0))
+    return children, array('q', (parents[i] for i in children))
+
+
+def _count_comments(skeletons, comment_nodes):
+    """Counts the commented nodes of each skeleton.
+
+    :param list skeletons: The `_Skeleton's of a file
+    :param comment_nodes: IDs of the commented nodes of the file, with
+        repetitions for nodes with several comments
+    """
+    if not len(comment_nodes):
+        return
+    if numpy is not None:
+        comment_nodes = numpy.unique(numpy.asarray(comment_nodes,
+                                                   dtype=numpy.int64))
+        ids = numpy.concatenate([numpy.asarray(skeleton.node_ids, dtype=numpy.int64)
+                                 for skeleton in skeletons] or [[]])
+        owners = numpy.repeat(numpy.arange(len(skeletons)),
+                              [len(skeleton.node_ids) for skeleton in skeletons])
+        indices, found = _lookup(ids.astype(numpy.int64), comment_nodes)
+        counts = numpy.bincount(owners[indices[found]], minlength=len(skeletons))
+        for skeleton, count in zip(skeletons, counts):
+            skeleton.comments += int(count)
+        return
+
+    owners = {node_id: skeleton
+              for skeleton in skeletons for node_id in skeleton.node_ids}
+    for node_id in set(comment_nodes):
+        skeleton = owners.get(node_id)
+        if skeleton is not None:
+            skeleton.comments += 1
+
+
+def _nml_stats(chunks, is_pyknossos):
+    parser = declxml.backend.pull_parser(('start', 'end'))
+    number = float if is_pyknossos else int
+    if is_pyknossos:
+        default_ids = None, None
+    else:
+        default_ids = DEFAULT_NEURON_ID, DEFAULT_SKELETON_ID
+    skeletons = []
+    comment_nodes = array('q')
+    # The open elements. Complete elements are removed from their parent
+    # right away, so that the document never piles up in memory.
+    open_elements = []
+    skeleton = None
+
+    def read_events():
+        nonlocal skeleton
+        for event, element in parser.read_events():
+            if event == 'start':
+                open_elements.append(element)
+                if len(open_elements) == 2 and _tag(element) == 'thing':
+                    skeleton = _Skeleton((
+                        number(element.get('id')),
+                        _optional_int(element.get('neuron_id'), default_ids[0]),
+                        _optional_int(element.get('skeleton_id'), default_ids[1])))
+                continue
+
+            open_elements.pop()
+            depth = len(open_elements)
+            tag = _tag(element)
+            if depth == 3 and skeleton is not None:
+                if tag == 'node':
+                    skeleton.add_node(int(element.get('id')),
+                                      float(element.get('x', 0)),
+                                      float(element.get('y', 0)),
+                                      float(element.get('z', 0)))
+                    if element.get('comment'):
+                        comment_nodes.append(skeleton.node_ids[-1])
+                elif tag == 'edge':
+                    skeleton.add_edge(int(element.get('source')),
+                                      int(element.get('target')))
+            elif depth == 2 and tag == 'comment':
+                comment_nodes.append(int(element.get('node')))
+            elif depth == 1 and tag == 'thing':
+                skeleton.finish()
+                skeletons.append(skeleton)
+                skeleton = None
+            if depth > 0:
+                open_elements[-1].remove(element)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        read_events()
+    parser.close()
+    read_events()
+
+    _count_comments(skeletons, comment_nodes)
+    return [skeleton.row() for skeleton in skeletons]
+
+
+def _tag(element):
+    return element.tag.split('}')[-1]
+
+
+def _optional_int(value, default=None):
+    return default if value is None or value == '' else int(value)
+
+
+def _catmaid_stats(chunks):
+    parser = CatmaidParser()
+    # Treenodes of a skeleton need not be next to each other, so all
+    # skeletons are collected until the end
+    skeletons = {}
+    relations = {}
+    links = []
+    labels = []
+
+    def read(objects):
+        for object_ in objects:
+            model = object_['model']
+            fields = object_['fields']
+            if model == 'catmaid.treenode':
+                skeleton = skeletons.get(fields['skeleton'])
+                if skeleton is None:
+                    skeleton = skeletons[fields['skeleton']] = _Skeleton(None)
+                skeleton.add_node(object_['pk'], fields['location_x'],
+                                  fields['location_y'], fields['location_z'])
+                if fields['parent'] is not None:
+                    skeleton.add_edge(fields['parent'], object_['pk'])
+            elif model == 'catmaid.relation':
+                relations[fields['relation_name']] = object_['pk']
+            elif model == 'catmaid.classinstanceclassinstance':
+                links.append((fields['relation'], fields['class_instance_a'],
+                              fields['class_instance_b']))
+            elif model == 'catmaid.treenodeclassinstance':
+                labels.append((fields['relation'], fields['treenode']))
+
+    for chunk in chunks:
+        read(parser.feed(chunk))
+    read(parser.close())
+
+    # Neurons are modelled by skeletons, and a neuron's ID is the thing ID
+    model_of = relations.get('model_of')
+    neurons = {a: b for relation, a, b in links if relation == model_of}
+    for skeleton_id, neuron_id in neurons.items():
+        if skeleton_id not in skeletons:
+            skeletons[skeleton_id] = _Skeleton(None)
+    for skeleton_id, skeleton in skeletons.items():
+        neuron_id = neurons.get(skeleton_id)
+        skeleton.ids = (neuron_id, neuron_id, skeleton_id)
+
+    labeled_as = relations.get('labeled_as')
+    skeletons = list(skeletons.values())
+    _count_comments(skeletons, array('q', (node for relation, node in labels
+                                           if relation == labeled_as)))
+    return [skeleton.row() for skeleton in skeletons]
+
+
+def _binary_stats(chunks):
+    data = binary.read_all(chunks)
+    skeletons = []
+    comment_nodes = binary.read_comment_nodes(data)
+    for header, arrays in binary.iter_arrays(data):
+        skeleton = _Skeleton(tuple(id_ or None for id_ in header[:3]))
+        skeleton.node_ids = arrays.ids
+        n = len(arrays.ids)
+        sources, targets = _parent_edges(arrays.parents)
+        skeleton.measures = ((n, len(sources))
+                             + _measure(n, arrays.coordinates, sources, targets))
+        comment_nodes.extend(node_id for node_id, comment
+                             in zip(arrays.ids, arrays.comments) if comment >= 0)
+        skeletons.append(skeleton)
+    _count_comments(skeletons, comment_nodes)
+    return [skeleton.row() for skeleton in skeletons]
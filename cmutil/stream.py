@@ -0,0 +1,299 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import codecs
+import json
+import re
+
+from . import declxml
+from .idset import IdSet
+from .nml import (parameters, thing_processor, pyknossos_thing_processor,
+                  comments_processor, branchpoints_processor)
+
+# The start of a JSON value that was cut off: a string, an escape sequence
+# in a string, a number or a literal
+_CUT_OFF = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*\\?|[-+.eE0-9]*'
+                      r'|u[0-9a-fA-F]{0,4}(?:\\(?:u[0-9a-fA-F]{0,4})?)?'
+                      r'|t(?:ru?)?|f(?:a(?:ls?)?)?|n(?:ul?)?')
+
+
+class NmlParser:
+    """Incremental NML parser. Feed it the document chunk by chunk; every
+    top-level element (`<parameters>', each `<thing>', `<comments>' and
+    `<branchpoints>') is parsed as soon as it is complete, and dropped from
+    memory afterwards.
+
+    `feed' and `close' return a list of `(tag, value)' tuples, where `value'
+    is what the corresponding processor in `nml' parses, e.g. a thing dict
+    for `thing'.
+    """
+
+    def __init__(self, is_pyknossos=False):
+        self._parser = declxml.backend.pull_parser(('start', 'end'))
+        self._processors = {
+            'parameters': parameters,
+            'thing': pyknossos_thing_processor if is_pyknossos else thing_processor,
+            'comments': comments_processor,
+            'branchpoints': branchpoints_processor
+        }
+        self._root = None
+        self._depth = 0
+
+    def feed(self, data):
+        """:type data: str or bytes"""
+        self._parser.feed(data)
+        return self._read_events()
+
+    def close(self):
+        self._parser.close()
+        events = self._read_events()
+        if self._root is None or self._root.tag.split('}')[-1] != 'things':
+            raise declxml.MissingValue('Missing required root aggregate "things"')
+        return events
+
+    def _read_events(self):
+        parsed = []
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                if self._root is None:
+                    self._root = element
+                self._depth += 1
+                continue
+
+            self._depth -= 1
+            if self._depth != 1:
+                continue
+            tag = element.tag.split('}')[-1]
+            if tag in self._processors:
+                parsed.append((tag, declxml.parse_from_element(self._processors[tag],
+                                                               element)))
+            # We are done with this element
+            self._root.remove(element)
+        return parsed
+
+
+def scan_nml(chunks, node_ids=None):
+    """Reads only the node IDs of an NML document, e.g. for a first pass
+    over a file that is then converted one `<thing>' at a time.
+
+    :param chunks: The document, as an iterable of chunks
+    :param idset.IdSet node_ids: If given, the IDs are added to this set
+    :returns: The IDs of all nodes of all things, and the number of things
+    :rtype: tuple
+    """
+    parser = declxml.backend.pull_parser(('start', 'end'))
+    if node_ids is None:
+        node_ids = IdSet()
+    count = 0
+    # Complete elements are dropped right away, like in `NmlParser'
+    open_elements = []
+
+    def read_events():
+        nonlocal count
+        for event, element in parser.read_events():
+            if event == 'start':
+                open_elements.append(element)
+                continue
+            open_elements.pop()
+            depth = len(open_elements)
+            tag = element.tag.split('}')[-1]
+            if (depth == 3 and tag == 'node'
+                    and open_elements[1].tag.split('}')[-1] == 'thing'):
+                node_ids.add(int(element.get('id')))
+            elif depth == 1 and tag == 'thing':
+                count += 1
+            if depth > 0:
+                open_elements[-1].remove(element)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        read_events()
+    parser.close()
+    read_events()
+    return node_ids, count
+
+
+def collect_nml(events):
+    """Assembles the output of `NmlParser' into the same dict that
+    `convert.nml2dict' returns.
+
+    :rtype: dict
+    """
+    nml_dict = {'parameters': {}, 'things': [], 'comments': [], 'branchpoints': []}
+    for tag, value in events:
+        if tag == 'thing':
+            nml_dict['things'].append(value)
+        elif tag == 'parameters':
+            nml_dict['parameters'] = value
+        else:
+            nml_dict[tag].extend(value)
+    if not nml_dict['things']:
+        raise declxml.MissingValue('Missing required array "things" at things')
+    return nml_dict
+
+
+class CatmaidSyntaxError(json.JSONDecodeError):
+    """A `json.JSONDecodeError' whose position counts from the start of the
+    whole document, although `CatmaidParser' only keeps the text that it
+    hasn't parsed yet. `doc' is None.
+    """
+
+    def __init__(self, msg, pos, lineno, colno):
+        ValueError.__init__(self, '{}: line {} column {} (char {})'.format(
+            msg, lineno, colno, pos))
+        self.msg = msg
+        self.doc = None
+        self.pos = pos
+        self.lineno = lineno
+        self.colno = colno
+
+    def __reduce__(self):
+        return self.__class__, (self.msg, self.pos, self.lineno, self.colno)
+
+
+def is_truncated(text, position):
+    """Tells whether a `json.JSONDecodeError' at `position' may only be due
+    to `text' being cut off, i.e. whether more text could make it valid.
+    """
+    return _CUT_OFF.fullmatch(text, position) is not None
+
+
+class CatmaidParser:
+    """Incremental parser for CATMAID JSON, i.e. a JSON array of JSON
+    objects. Feed it the document chunk by chunk; `feed' and `close' return
+    a list of all objects that were completed by the chunk.
+
+    Errors are raised as soon as the text fed so far can't be the start of
+    a valid document, as `CatmaidSyntaxError'.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        # Text that was fed but not parsed yet. The pieces are only joined
+        # once they could complete the last object, so that an object that
+        # spans many chunks isn't copied again for every chunk.
+        self._pending = []
+        self._pending_size = 0
+        self._needed = 0
+        # Where the pending text starts in the document
+        self._offset = 0
+        self._line = 1
+        self._column = 1
+        # Either '[' (waiting for the array), 'first' (waiting for the first
+        # object or the end of an empty array), 'value' (waiting for the next
+        # object), ',' (waiting for a comma or the end of the array), or
+        # 'end' (done).
+        self._expect = '['
+
+    def feed(self, data):
+        """:type data: str or bytes"""
+        if not isinstance(data, str):
+            data = self._text_decoder.decode(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size < self._needed:
+            return []
+        return self._read_objects(final=False)
+
+    def close(self):
+        self._pending.append(self._text_decoder.decode(b'', final=True))
+        objects = self._read_objects(final=True)
+        if self._expect != 'end':
+            raise self._error('Unexpected end of JSON array', self._pending[0],
+                              len(self._pending[0]))
+        return objects
+
+    def _read_objects(self, final):
+        objects = []
+        buffer = ''.join(self._pending)
+        position = 0
+        complete = True
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position == len(buffer):
+                break
+
+            char = buffer[position]
+            if self._expect == '[':
+                if char != '[':
+                    raise self._error('Expecting "["', buffer, position)
+                self._expect = 'first'
+                position += 1
+            elif self._expect == ',' or (self._expect == 'first' and char == ']'):
+                if char == ']':
+                    self._expect = 'end'
+                elif char == ',':
+                    self._expect = 'value'
+                else:
+                    raise self._error('Expecting "," or "]"', buffer, position)
+                position += 1
+            elif self._expect in ('first', 'value'):
+                try:
+                    value, end = self._decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError as error:
+                    # Wait for more text only if the object is cut off at
+                    # the end of the buffer; anything else stays an error
+                    if final or not is_truncated(buffer, error.pos):
+                        raise self._error(error.msg, buffer,
+                                          error.pos) from None
+                    complete = False
+                    break
+                if not isinstance(value, dict):
+                    raise self._error('Not a JSON object', buffer, position)
+                objects.append(value)
+                self._expect = ','
+                position = end
+            else:
+                raise self._error('Extra data', buffer, position)
+
+        self._advance(buffer, position)
+        rest = buffer[position:]
+        self._pending = [rest]
+        self._pending_size = len(rest)
+        # Try again once there is at least as much new text as is left over
+        self._needed = 0 if complete else 2 * len(rest)
+        return objects
+
+    def _advance(self, buffer, position):
+        """Moves the start of the pending text to buffer[position]."""
+        newlines = buffer.count('\n', 0, position)
+        if newlines:
+            self._line += newlines
+            self._column = position - buffer.rindex('\n', 0, position)
+        else:
+            self._column += position
+        self._offset += position
+
+    def _error(self, message, buffer, position):
+        """Returns a CatmaidSyntaxError for buffer[position], where `buffer'
+        starts with the pending text."""
+        newlines = buffer.count('\n', 0, position)
+        if newlines:
+            column = position - buffer.rindex('\n', 0, position)
+        else:
+            column = self._column + position
+        return CatmaidSyntaxError(message, self._offset + position,
+                                  self._line + newlines, column)
@@ -0,0 +1,151 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+from array import array
+import itertools
+
+
+class Topology:
+    """Topology of a single skeleton, i.e. of the nodes and edges of one
+    NML `thing' or the treenodes of one CATMAID skeleton.
+
+    Nodes are referred to by their index in `ids', which is the order in
+    which they were passed in. All per-node data is kept in flat arrays:
+
+    - `parents[i]' is the index of the parent of node `i', or -1 for roots
+    - the children of node `i' are `children[child_offsets[i]:child_offsets[i + 1]]'
+    - `order' lists all nodes so that every parent comes before its
+      children (breadth-first from each root)
+    - `roots', `branch_nodes' (more than one child) and `leaves' (no
+      children) list node indices
+
+    Edges are treated as undirected, and oriented away from the roots.
+    Roots are the nodes without an incoming edge, taken in node order, and
+    the first node of any component in which every node has an incoming
+    edge (i.e. contains a cycle). Edges that would close a cycle, and edges
+    that refer to unknown nodes, are ignored. For edges that already form a
+    proper tree, the result is exactly the tree given by the edges.
+    """
+
+    def __init__(self, node_ids, edges):
+        """
+        :param node_ids: Iterable of node IDs
+        :param edges: Iterable of (source ID, target ID) tuples
+        """
+        self.ids = array('q', node_ids)
+        n = len(self.ids)
+        index = {node_id: i for i, node_id in enumerate(self.ids)}
+
+        sources = array('q')
+        targets = array('q')
+        has_incoming = bytearray(n)
+        for source, target in edges:
+            s = index.get(source)
+            t = index.get(target)
+            if s is None or t is None or s == t:
+                continue
+            sources.append(s)
+            targets.append(t)
+            has_incoming[t] = 1
+
+        # Undirected adjacency lists, as one flat array with offsets
+        offsets = _offsets(n, itertools.chain(sources, targets))
+        adjacency = array('q', bytes(8 * offsets[n]))
+        position = array('q', offsets)
+        for s, t in zip(sources, targets):
+            adjacency[position[s]] = t
+            position[s] += 1
+            adjacency[position[t]] = s
+            position[t] += 1
+
+        # Breadth-first search from each root orients the edges
+        self.parents = array('q', [-1]) * n
+        self.order = array('q')
+        self.roots = array('q')
+        visited = bytearray(n)
+        candidates = itertools.chain((i for i in range(n) if not has_incoming[i]),
+                                     range(n))
+        for root in candidates:
+            if visited[root]:
+                continue
+            visited[root] = 1
+            self.roots.append(root)
+            head = len(self.order)
+            self.order.append(root)
+            while head < len(self.order):
+                node = self.order[head]
+                head += 1
+                for k in range(offsets[node], offsets[node + 1]):
+                    neighbour = adjacency[k]
+                    if not visited[neighbour]:
+                        visited[neighbour] = 1
+                        self.parents[neighbour] = node
+                        self.order.append(neighbour)
+
+        # Children lists, again as one flat array with offsets
+        self.child_offsets = _offsets(n, (p for p in self.parents if p >= 0))
+        self.children = array('q', bytes(8 * self.child_offsets[n]))
+        position = array('q', self.child_offsets)
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.children[position[parent]] = i
+                position[parent] += 1
+
+        self.branch_nodes = array('q')
+        self.leaves = array('q')
+        for i in range(n):
+            count = self.child_offsets[i + 1] - self.child_offsets[i]
+            if count == 0:
+                self.leaves.append(i)
+            elif count > 1:
+                self.branch_nodes.append(i)
+
+    @classmethod
+    def from_thing(cls, thing):
+        """Creates the topology of an NML `thing' dict."""
+        return cls((node['id'] for node in thing['nodes']),
+                   ((edge['source'], edge['target']) for edge in thing['edges']))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def children_of(self, i):
+        """Returns the indices of the children of node `i'."""
+        return self.children[self.child_offsets[i]:self.child_offsets[i + 1]]
+
+    def parent_ids(self):
+        """Returns the ID of each node's parent (None for roots), in node order."""
+        ids = self.ids
+        return [None if parent < 0 else ids[parent] for parent in self.parents]
+
+
+def _offsets(n, indices):
+    """Counts how often each of the `n' indices occurs, and returns the
+    running sum of the counts (with n + 1 entries, starting at 0)."""
+    offsets = array('q', bytes(8 * (n + 1)))
+    for i in indices:
+        offsets[i + 1] += 1
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    return offsets
@@ -0,0 +1,152 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Coordinates in NML files are KNOSSOS voxel coordinates, which start at 1.
+# CATMAID coordinates start at 0, and are usually in nanometres:
+#
+#     catmaid = (knossos - 1 + offset) * scale
+#
+# where `scale' is the voxel size and `offset' the position of the dataset
+# in voxels. By default, scale is 1 and offset 0, i.e. coordinates are only
+# shifted by one voxel. NML files carry both in their <parameters>, as
+# <scale> and <offset>.
+
+# Stands for "take it from the <parameters> of the NML file"
+FROM_NML = 'nml'
+
+
+class Affine:
+    """Transforms whole blocks of coordinates between KNOSSOS and CATMAID.
+
+    A block is a sequence of (x, y, z) tuples, e.g. all nodes of a skeleton.
+    With numpy, each block is transformed in one go. Without scale and
+    offset, coordinates are only shifted, and keep their type (integers, or
+    the floats of PyKNOSSOS files).
+
+    `scale' and `offset' can also be `FROM_NML', in which case `bind' has to
+    be called with the parameters of the NML file before transforming.
+    """
+
+    def __init__(self, scale=None, offset=None):
+        """
+        :param scale: Voxel size as (x, y, z), or `FROM_NML'; default 1
+        :param offset: Dataset offset in voxels as (x, y, z), or
+            `FROM_NML'; default 0
+        """
+        self.scale = scale
+        self.offset = offset
+
+    @property
+    def is_default(self):
+        """Whether coordinates are only shifted by one voxel."""
+        return self.scale is None and self.offset is None
+
+    def bind(self, parameters):
+        """Takes scale and offset from NML parameters where they are
+        `FROM_NML'.
+
+        :param dict parameters: Parsed NML <parameters> (see
+            `nml.parameters'), or None if there are none (e.g. for CATMAID
+            JSON input)
+        :raises ValueError: If a parameter is missing
+        :rtype: Affine
+        """
+        if FROM_NML not in (self.scale, self.offset):
+            return self
+        return Affine(_from_parameters(self.scale, parameters, 'scale'),
+                      _from_parameters(self.offset, parameters, 'offset'))
+
+    def to_catmaid(self, points):
+        """Transforms KNOSSOS coordinates to CATMAID.
+
+        :param points: Sequence of (x, y, z)
+        :rtype: list
+        """
+        if self.is_default:
+            return [(x - 1, y - 1, z - 1) for x, y, z in points]
+        scale, shift = self._factors()
+        if numpy is not None:
+            block = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+            return ((block + shift) * scale).tolist()
+        return [((x + shift[0]) * scale[0],
+                 (y + shift[1]) * scale[1],
+                 (z + shift[2]) * scale[2]) for x, y, z in points]
+
+    def to_knossos(self, points):
+        """Transforms CATMAID coordinates to KNOSSOS voxels. Scaled
+        coordinates are rounded to the nearest voxel.
+
+        :param points: Sequence of (x, y, z)
+        :rtype: list
+        """
+        if self.is_default:
+            return [(int(x) + 1, int(y) + 1, int(z) + 1) for x, y, z in points]
+        scale, shift = self._factors()
+        if numpy is not None:
+            block = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+            return numpy.rint(block / scale - shift).astype(numpy.int64).tolist()
+        return [(int(round(x / scale[0] - shift[0])),
+                 int(round(y / scale[1] - shift[1])),
+                 int(round(z / scale[2] - shift[2]))) for x, y, z in points]
+
+    def parameters(self):
+        """Returns scale and offset as NML <parameters> (see
+        `nml.parameters'), or None by default."""
+        if self.is_default:
+            return None
+        scale, shift = self._factors()
+        return {'scale': dict(zip('xyz', scale)),
+                'offset': {axis: shift[i] + 1 for i, axis in enumerate('xyz')}}
+
+    def _factors(self):
+        if FROM_NML in (self.scale, self.offset):
+            raise ValueError('NML parameters are needed for this transform')
+        scale = tuple(float(_) for _ in (self.scale or (1, 1, 1)))
+        if 0 in scale:
+            raise ValueError('The scale must not be 0')
+        shift = tuple(float(_) - 1 for _ in (self.offset or (0, 0, 0)))
+        return scale, shift
+
+
+def _from_parameters(value, parameters, name):
+    if value != FROM_NML:
+        return value
+    if not parameters or not parameters.get(name):
+        raise ValueError('The input has no <{}> parameter'.format(name))
+    return tuple(parameters[name][axis] for axis in 'xyz')
+
+
+def parse_option(value):
+    """Parses a command line value: either 'X,Y,Z' or `FROM_NML'."""
+    if value == FROM_NML:
+        return value
+    values = tuple(float(_) for _ in value.split(','))
+    if len(values) != 3:
+        raise ValueError('Expected X,Y,Z')
+    return values
@@ -0,0 +1,269 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+from collections import namedtuple
+import json
+import xml.etree.ElementTree as ET
+
+from . import binary, declxml
+from .stream import NmlParser, CatmaidParser
+
+Problem = namedtuple('Problem', ['location', 'message'])
+
+
+def validate(chunks, input_format, is_pyknossos=False):
+    """Checks an NML or CATMAID JSON file for problems that would break a
+    conversion, in a single pass over its chunks. Problems are yielded as
+    soon as they are found; problems that can only be detected once the
+    whole file has been read (e.g. references to objects that never show
+    up) are yielded at the end.
+
+    Memory use is proportional to the number of node IDs, not to the size
+    of the file.
+
+    :param chunks: Iterable of chunks, e.g. from `fileio.open_source'
+    :param str input_format: Either 'nml', 'catmaid' or 'binary'
+    :param bool is_pyknossos: Whether to parse NML files generated from PyKNOSSOS.
+    :rtype: iterator of Problem
+    """
+    if input_format == 'binary':
+        yield from _validate_binary(chunks)
+        return
+    if input_format == 'nml':
+        parser, checker = NmlParser(is_pyknossos), _NmlChecker()
+    else:
+        parser, checker = CatmaidParser(), _CatmaidChecker()
+
+    try:
+        for chunk in chunks:
+            for parsed in parser.feed(chunk):
+                yield from checker.check(parsed)
+        for parsed in parser.close():
+            yield from checker.check(parsed)
+    except (ET.ParseError, declxml.backend.ParseError) as error:
+        # Without the position, which is already the location
+        yield Problem('line {}, column {}'.format(*error.position),
+                      declxml.backend.error_message(error))
+        return
+    except json.JSONDecodeError as error:
+        yield Problem('line {}, column {}'.format(error.lineno, error.colno),
+                      error.msg)
+        return
+    except declxml.XmlError as error:
+        yield Problem(checker.location(), str(error))
+        return
+
+    yield from checker.finish()
+
+
+def _validate_binary(chunks):
+    # Binary files are read in one go, and checked like NML files
+    try:
+        nml = binary.loads(chunks)
+    except binary.FormatError as error:
+        yield Problem('file', str(error))
+        return
+    checker = _NmlChecker()
+    for thing in nml['things']:
+        yield from checker.check(('thing', thing))
+    yield from checker.check(('comments', nml['comments']))
+    yield from checker.check(('branchpoints', nml['branchpoints']))
+
+
+class _NmlChecker:
+    """Checks the things of an NML file one by one."""
+
+    def __init__(self):
+        self.node_ids = set()
+        self.things = 0
+
+    def location(self):
+        return 'thing[{}]'.format(self.things)
+
+    def check(self, parsed):
+        tag, value = parsed
+        if tag == 'thing':
+            yield from self._check_thing(value)
+            self.things += 1
+        elif tag in ('comments', 'branchpoints'):
+            key = 'node' if tag == 'comments' else 'id'
+            for i, item in enumerate(value):
+                if item[key] not in self.node_ids:
+                    yield Problem('{}/{}[{}]'.format(tag, tag[:-1], i),
+                                  'Node {} does not exist'.format(item[key]))
+
+    def finish(self):
+        return ()
+
+    def _check_thing(self, thing):
+        location = 'thing[{}] (id {})'.format(self.things, thing['id'])
+
+        # Union-find over the nodes of this thing, to detect cycles
+        components = {}
+        for i, node in enumerate(thing['nodes']):
+            if node['id'] in self.node_ids:
+                yield Problem('{}/node[{}]'.format(location, i),
+                              'Duplicate node ID {}'.format(node['id']))
+            self.node_ids.add(node['id'])
+            components[node['id']] = node['id']
+
+        def find(node_id):
+            while components[node_id] != node_id:
+                components[node_id] = components[components[node_id]]
+                node_id = components[node_id]
+            return node_id
+
+        for i, edge in enumerate(thing['edges']):
+            edge_location = '{}/edge[{}]'.format(location, i)
+            missing = [edge[end] for end in ('source', 'target')
+                       if edge[end] not in components]
+            for node_id in missing:
+                yield Problem(edge_location,
+                              'Edge refers to node {}, which is not part of this thing'
+                              .format(node_id))
+            if missing:
+                continue
+            source, target = find(edge['source']), find(edge['target'])
+            if source == target:
+                yield Problem(edge_location, 'Edge {} -> {} closes a cycle'
+                              .format(edge['source'], edge['target']))
+            else:
+                components[source] = target
+
+
+class _CatmaidChecker:
+    """Checks CATMAID objects one by one, and the references between them
+    at the end."""
+
+    def __init__(self):
+        self.objects = 0
+        self.pks = {}
+        self.classes = {}
+        self.relations = {}
+        # pk -> class_column of all `classinstance's
+        self.classinstances = {}
+        # (relation, class_instance_a) of all `classinstanceclassinstance's
+        self.links = []
+        # pk -> (parent, skeleton, object index) of all treenodes
+        self.treenodes = {}
+        # (relation, treenode, class_instance, object index) of all
+        # `treenodeclassinstance's
+        self.labels = []
+
+    def location(self):
+        return 'object[{}]'.format(self.objects)
+
+    def check(self, obj):
+        location = self.location()
+        self.objects += 1
+
+        if not all(key in obj for key in ('model', 'pk', 'fields')):
+            yield Problem(location, 'Object needs a model, pk and fields')
+            return
+        model, pk, fields = obj['model'], obj['pk'], obj['fields']
+        location += ' ({} {})'.format(model, pk)
+
+        pks = self.pks.setdefault(model, set())
+        if pk in pks:
+            yield Problem(location, 'Duplicate pk {}'.format(pk))
+        pks.add(pk)
+
+        try:
+            if model == 'catmaid.class':
+                self.classes[fields['class_name']] = pk
+            elif model == 'catmaid.relation':
+                self.relations[fields['relation_name']] = pk
+            elif model == 'catmaid.classinstance':
+                self.classinstances[pk] = fields['class_column']
+            elif model == 'catmaid.classinstanceclassinstance':
+                self.links.append((fields['relation'], fields['class_instance_a']))
+            elif model == 'catmaid.treenode':
+                self.treenodes[pk] = (fields['parent'], fields['skeleton'],
+                                      self.objects - 1)
+                for axis in ('location_x', 'location_y', 'location_z'):
+                    if not isinstance(fields[axis], (int, float)):
+                        yield Problem(location, '{} is not a number'.format(axis))
+            elif model == 'catmaid.treenodeclassinstance':
+                self.labels.append((fields['relation'], fields['treenode'],
+                                    fields['class_instance'], self.objects - 1))
+        except KeyError as error:
+            yield Problem(location, 'Missing field {}'.format(error))
+
+    def finish(self):
+        if 'label' not in self.classes:
+            yield Problem('end of file', 'Missing class "label"')
+        for name in ('model_of', 'labeled_as'):
+            if name not in self.relations:
+                yield Problem('end of file', 'Missing relation "{}"'.format(name))
+
+        # Skeletons are the `class_instance_a' of `model_of' links
+        skeletons = {a for relation, a in self.links
+                     if relation == self.relations.get('model_of')}
+        missing_skeletons = {}
+        for pk, (parent, skeleton, index) in self.treenodes.items():
+            location = 'object[{}] (catmaid.treenode {})'.format(index, pk)
+            if skeleton not in skeletons:
+                missing_skeletons.setdefault(skeleton, []).append(location)
+            if parent is None:
+                continue
+            if parent not in self.treenodes:
+                yield Problem(location, 'Parent {} does not exist'.format(parent))
+            elif self.treenodes[parent][1] != skeleton:
+                yield Problem(location, 'Parent {} belongs to skeleton {}, not {}'
+                              .format(parent, self.treenodes[parent][1], skeleton))
+
+        for skeleton, locations in missing_skeletons.items():
+            yield Problem(locations[0],
+                          'Skeleton {} is not modelled by any neuron, but has {} treenode(s)'
+                          .format(skeleton, len(locations)))
+
+        yield from self._check_cycles()
+
+        labels = {pk for pk, class_column in self.classinstances.items()
+                  if class_column == self.classes.get('label')}
+        for relation, treenode, class_instance, index in self.labels:
+            if relation != self.relations.get('labeled_as'):
+                continue
+            location = 'object[{}] (catmaid.treenodeclassinstance)'.format(index)
+            if treenode not in self.treenodes:
+                yield Problem(location, 'Treenode {} does not exist'.format(treenode))
+            if class_instance not in labels:
+                yield Problem(location, 'Label {} does not exist'.format(class_instance))
+
+    def _check_cycles(self):
+        # 0: not visited yet, 1: on the current path, 2: done
+        state = dict.fromkeys(self.treenodes, 0)
+        for start in self.treenodes:
+            path = []
+            node = start
+            while node in state and state[node] == 0:
+                state[node] = 1
+                path.append(node)
+                node = self.treenodes[node][0]
+            if node in state and state[node] == 1:
+                index = self.treenodes[node][2]
+                yield Problem('object[{}] (catmaid.treenode {})'.format(index, node),
+                              'Treenode is part of a cycle')
+            for visited in path:
+                state[visited] = 2
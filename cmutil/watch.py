@@ -0,0 +1,206 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import concurrent.futures
+import os
+import sys
+import time
+
+from . import convert
+from .fileio import open_source, sniff_format, write_atomic, write_if_changed
+from .journal import Journal
+from .parser import create_timestamp
+
+# Which files to pick up, and which extension to give the converted file,
+# depending on the output format.
+INPUT_EXTENSIONS = {'nml': ('.json', '.cmsk'), 'catmaid': ('.nml', '.cmsk'),
+                    'binary': ('.nml', '.json')}
+OUTPUT_EXTENSIONS = {'nml': '.nml', 'catmaid': '.json', 'binary': '.cmsk'}
+# Journal of the files converted so far, in the output directory. Like
+# temporary files, it is hidden, so it is never picked up as input.
+JOURNAL = '.cmutil-journal'
+
+
+def output_path(source, output_directory, output_format, level=None):
+    """Returns the path of the converted file for `source', e.g. a.nml,
+    or a.lod0.nml, a.lod1.nml, ... for each level of detail."""
+    name = os.path.splitext(os.path.basename(source))[0]
+    if level is not None:
+        name += '.lod{}'.format(level)
+    return os.path.join(output_directory, name + OUTPUT_EXTENSIONS[output_format])
+
+
+def convert_file(source, outputs, output_format, user_id=None,
+                 is_pyknossos=False, timestamp=None, deterministic=False,
+                 tolerances=(None,), intern_labels=False, transform=None):
+    """Converts a single file and atomically writes the result. This runs
+    inside the worker processes of `watch'.
+
+    :param list outputs: Output file for each tolerance
+    :param str timestamp: Creation time; the current time if None
+    :param bool deterministic: If true, outputs whose content would not
+        change are not rewritten
+    :returns: Paths of the output files
+    :rtype: list
+    """
+    with open_source(source) as chunks:
+        input_format, chunks = sniff_format(chunks)
+        results = convert.convert_levels(
+            chunks, output_format, tolerances, user_id,
+            timestamp or create_timestamp(), is_pyknossos, intern_labels,
+            input_format=input_format, transform=transform)
+    for output, result in zip(outputs, results):
+        if deterministic:
+            write_if_changed(output, result)
+        else:
+            write_atomic(output, result)
+    return outputs
+
+
+def scan(directory, extensions):
+    """Returns a dict mapping each candidate file in `directory' to a
+    signature that changes whenever the file is written to.
+
+    Hidden files are skipped, since editors and our own atomic writes use
+    them as temporary files.
+    """
+    files = {}
+    for entry in os.scandir(directory):
+        if (entry.name.startswith('.')
+                or not entry.name.endswith(extensions)
+                or not entry.is_file()):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def watch(directory, output_directory, output_format, user_id=None,
+          is_pyknossos=False, workers=None, interval=1.0, resume=False,
+          timestamp=None, deterministic=False, tolerances=(None,),
+          intern_labels=False, transform=None):
+    """Watches `directory' and converts every new or changed file, until
+    interrupted.
+
+    The directory is polled every `interval' seconds. A file is only
+    converted once its size and modification time were the same for two
+    consecutive scans, so that files which are still being written are not
+    picked up half-way. Conversions run on a pool of `workers' processes,
+    and at most twice as many files are queued at once.
+
+    Every converted file is recorded in a journal in the output directory,
+    which keeps only the last conversion of each file.
+
+    :param str directory: Directory to watch
+    :param str output_directory: Directory to write converted files to
+    :param str output_format: Either 'nml', 'catmaid' or 'binary'
+    :param bool resume: If true, files that the journal lists are only
+        converted again if they changed since
+    :param tolerances: One output is written per tolerance (see
+        `convert.convert_levels'), named like in `output_path'
+
+    The other parameters are the options of the conversion, see
+    `convert_file'.
+    """
+    extensions = INPUT_EXTENSIONS[output_format]
+    workers = workers or os.cpu_count() or 1
+    tolerances = list(tolerances)
+    levels = [None] if len(tolerances) == 1 else range(len(tolerances))
+    options = dict(user_id=user_id, is_pyknossos=is_pyknossos,
+                   timestamp=timestamp, deterministic=deterministic,
+                   tolerances=tolerances, intern_labels=intern_labels,
+                   transform=transform)
+
+    # Signatures of files that were already converted, and of files that
+    # were seen during the last scan.
+    converted = {}
+    last_seen = {}
+    running = {}
+
+    journal = Journal(os.path.join(output_directory, JOURNAL),
+                      {'watch': os.path.abspath(directory),
+                       'convert': output_format, 'user': user_id,
+                       'pyknossos': is_pyknossos, 'timestamp': timestamp,
+                       'deterministic': deterministic,
+                       'simplify': tolerances, 'intern_labels': intern_labels,
+                       'scale': transform and transform.scale,
+                       'offset': transform and transform.offset},
+                      resume, key='file')
+    for entry in journal.entries:
+        converted[entry['file']] = tuple(entry['signature'])
+
+    with journal, concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers) as pool:
+        try:
+            while True:
+                deadline = time.monotonic() + interval
+                current = scan(directory, extensions)
+
+                for path, signature in current.items():
+                    if (len(running) >= 2 * workers
+                            or path in running.values()
+                            or converted.get(path) == signature
+                            or last_seen.get(path) != signature):
+                        continue
+                    outputs = [output_path(path, output_directory,
+                                           output_format, level)
+                               for level in levels]
+                    future = pool.submit(convert_file, path, outputs,
+                                         output_format, **options)
+                    running[future] = path
+                    converted[path] = signature
+
+                last_seen = current
+
+                # Report finished conversions until it's time for the next scan
+                while running:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    done, _ = concurrent.futures.wait(
+                        running, timeout=remaining,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        path = running.pop(future)
+                        if _report(path, future):
+                            journal.record(file=path,
+                                           signature=converted[path],
+                                           outputs=future.result())
+                time.sleep(max(0, deadline - time.monotonic()))
+        except KeyboardInterrupt:
+            pass
+
+
+def _report(path, future):
+    """Prints the outcome of a conversion, and tells whether it succeeded."""
+    try:
+        print('{} -> {}'.format(path, ', '.join(future.result())),
+              file=sys.stderr)
+    except Exception as error:
+        print('{}: {}'.format(path, error), file=sys.stderr)
+        return False
+    return True
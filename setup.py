@@ -8,4 +8,5 @@ setup(name='cmutil',
       author_email='',
       license='',
       packages=['cmutil'],
-      install_requires=['declxml'])
+      install_requires=['declxml'],
+      extras_require={'lxml': ['lxml>=4.5'], 'numpy': ['numpy']})
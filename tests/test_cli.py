@@ -0,0 +1,71 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NML = b'''<?xml version="1.0" ?>
+<things>
+ <thing id="4">
+  <nodes>
+   <node id="1" radius="1.5" x="10" y="10" z="10"/>
+   <node id="2" radius="1.5" x="11" y="12" z="10"/>
+   <node id="3" radius="1.5" x="12" y="10" z="10"/>
+  </nodes>
+  <edges>
+   <edge source="1" target="2"/>
+   <edge source="2" target="3"/>
+  </edges>
+ </thing>
+ <comments>
+  <comment node="3" content="ending"/>
+ </comments>
+ <branchpoints>
+  <branchpoint id="2"/>
+ </branchpoints>
+</things>
+'''
+
+
+def run(*arguments):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    subprocess.run([sys.executable, '-m', 'cmutil'] + list(arguments),
+                   env=env, check=True)
+
+
+def test_compressed_binary_round_trip(tmp_path):
+    source = tmp_path / 'in.nml'
+    source.write_bytes(NML)
+    for name in ('out.cmsk', 'out.cmsk.gz'):
+        run('-convert', 'binary', str(source), '-o', str(tmp_path / name))
+        run('-convert', 'nml', str(tmp_path / name),
+            '-o', str(tmp_path / (name + '.nml')))
+    # Compressed files can't be memory-mapped, but read the same
+    assert (tmp_path / 'out.cmsk.gz').read_bytes()[:2] == b'\x1f\x8b'
+    assert ((tmp_path / 'out.cmsk.gz.nml').read_bytes()
+            == (tmp_path / 'out.cmsk.nml').read_bytes())
+    assert b'ending' in (tmp_path / 'out.cmsk.gz.nml').read_bytes()
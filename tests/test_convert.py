@@ -0,0 +1,83 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+import json
+
+import pytest
+
+from cmutil import convert
+
+PYKNOSSOS_NML = b'''<?xml version="1.0" ?>
+<things>
+ <thing id="1.0" color.r="1.0" color.g="0.0" color.b="0.0">
+  <nodes>
+   <node id="1" radius="1.5" x="10.0" y="10.0" z="10.0" comment="soma"/>
+   <node id="2" radius="1.5" x="11.0" y="10.5" z="10.0"/>
+  </nodes>
+  <edges>
+   <edge source="1" target="2"/>
+  </edges>
+ </thing>
+ <thing id="2.0">
+  <nodes>
+   <node id="3" x="20.0" y="20.0" z="20.0"/>
+  </nodes>
+  <edges/>
+ </thing>
+ <comments>
+  <comment node="3" content="ending"/>
+ </comments>
+</things>
+'''
+
+
+def test_pyknossos_to_catmaid():
+    # PyKNOSSOS thing IDs are floats
+    objects = json.loads(convert.convert(
+        PYKNOSSOS_NML, 'catmaid', 7, '2020-01-01T00:00:00Z',
+        is_pyknossos=True))
+    by_model = {}
+    for obj in objects:
+        by_model.setdefault(obj['model'], []).append(obj)
+
+    neurons = [obj for obj in by_model['catmaid.classinstance']
+               if obj['fields']['class_column'] == 47]
+    # Thing ID 1.0 is taken by node 1, so the neurons get new IDs
+    assert len(neurons) == 2
+    assert sorted(node['pk'] for node in by_model['catmaid.treenode']) == [1, 2, 3]
+    pks = [obj['pk'] for obj in objects]
+    assert len(pks) == len(set(pks))
+    labels = {obj['fields']['name'] for obj in by_model['catmaid.classinstance']
+              if obj['fields']['class_column'] == 48}
+    assert labels == {'soma', 'ending'}
+
+
+def test_select_missing_things():
+    with pytest.raises(convert.ThingsNotFound) as error:
+        convert.load_nml(PYKNOSSOS_NML, 'nml', is_pyknossos=True,
+                         thing_ids=[999, 1000])
+    assert str(error.value) == 'No thing with ID 999, 1000'
+    nml = convert.load_nml(PYKNOSSOS_NML, 'nml', is_pyknossos=True,
+                           thing_ids=[2, 999])
+    assert [thing['id'] for thing in nml['things']] == [2]
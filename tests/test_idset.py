@@ -0,0 +1,51 @@
+# This file is part of cmutil.
+#
+# Copyright (C) 2018 ariadne-service gmbh
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# ariadne-service gmbh ariadne.ai
+# Sebastian Spaar sebastian.spaar@ariadne.ai
+
+
+from cmutil.idset import IdSet, CHUNK_SIZE, DENSE
+
+
+def test_floats_count_as_ints():
+    ids = IdSet([1, 2.0, 2.5])
+    assert 2 in ids and 2.0 in ids and 1.0 in ids
+    assert 2.5 in ids and 3 not in ids and 3.5 not in ids
+    assert len(ids) == 3
+    assert list(ids) == [1, 2.0, 2.5]
+    assert ids.max() == 2.5
+
+
+def test_sparse_and_dense_chunks():
+    ids = IdSet(range(0, 100 * CHUNK_SIZE, CHUNK_SIZE))
+    assert all(type(chunk) is set for chunk in ids._chunks.values())
+    ids = IdSet(range(DENSE + 1))
+    assert all(type(chunk) is bytearray for chunk in ids._chunks.values())
+    assert list(ids) == list(range(DENSE + 1))
+    assert ids.next_free(0) == DENSE + 1
+
+
+def test_next_free():
+    ids = IdSet([1, 2, 3, CHUNK_SIZE])
+    assert ids.next_free() == 4
+    assert ids.next_free(CHUNK_SIZE) == CHUNK_SIZE + 1
+    ids = IdSet([CHUNK_SIZE * 3])
+    assert ids.next_free(0) == 0